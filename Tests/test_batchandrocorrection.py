@@ -9,7 +9,7 @@ import unittest
 sys.path.append("..")
 import nPYc
 from generateTestDataset import generateTestDataset
-from nPYc.enumerations import SampleType
+from nPYc.enumerations import SampleType, AssayRole
 
 
 class test_rocorrection(unittest.TestCase):
@@ -57,6 +57,213 @@ class test_rocorrection(unittest.TestCase):
 			numpy.testing.assert_array_almost_equal(correctedDataER.intensityData, expectedCorrectedERDataIntensity, err_msg="Corrected intensities are not equal")
 
 
+	def test_correctMSDataset_vectorised(self):
+		"""
+		Check that the vectorised LOWESS engine matches fitting features one by one.
+		"""
+		correctedDataV = nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=False, engine='vectorised')
+		correctedDataS = nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=False, engine='statsmodels')
+
+		numpy.testing.assert_allclose(correctedDataV.fit, correctedDataS.fit, rtol=1e-7, err_msg="Vectorised and per-feature fits not equal.")
+
+		numpy.testing.assert_allclose(correctedDataV.intensityData, correctedDataS.intensityData, rtol=1e-7, err_msg="Vectorised and per-feature corrected data not equal.")
+
+	def test_correctMSDataset_tasks(self):
+		"""
+		Check that splitting batches into feature blocks for the workers does not change the result.
+		"""
+		import copy
+
+		msData = copy.deepcopy(self.msData)
+		msData.sampleMetadata['Correction Batch'] = numpy.where(msData.sampleMetadata['Run Order'] < self.noSamp / 3, 1., 2.)
+		msData.sampleMetadata.loc[0, 'Correction Batch'] = numpy.nan
+
+		correctedDataS = nPYc.batchAndROCorrection.correctMSdataset(msData, parallelise=False)
+
+		for chunkSize in [1, 7, 1000]:
+			with self.subTest(msg='chunkSize=%i' % chunkSize):
+				correctedDataP = nPYc.batchAndROCorrection.correctMSdataset(msData, parallelise=True, nJobs=2, chunkSize=chunkSize)
+
+				numpy.testing.assert_array_almost_equal(correctedDataP.fit, correctedDataS.fit, err_msg="Serial and parallel fits not equal.")
+
+				numpy.testing.assert_array_almost_equal(correctedDataP.intensityData, correctedDataS.intensityData, err_msg="Serial and parallel corrected data not equal.")
+
+	def test_correctMSDataset_outOfCore(self):
+		"""
+		Check that correcting blocks of features from and to memory-mapped files matches correcting in memory.
+		"""
+		import copy
+		import os
+		import tempfile
+
+		correctedDataS = nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=False)
+
+		with tempfile.TemporaryDirectory() as tmpdirname:
+			msData = copy.deepcopy(self.msData)
+			numpy.save(os.path.join(tmpdirname, 'raw.npy'), msData.intensityData)
+			msData.intensityData = numpy.load(os.path.join(tmpdirname, 'raw.npy'), mmap_mode='r')
+
+			for parallelise in [False, True]:
+				with self.subTest(msg='parallelise=%s' % parallelise):
+					outputPath = os.path.join(tmpdirname, 'corrected%s.npy' % parallelise)
+
+					correctedDataM = nPYc.batchAndROCorrection.correctMSdataset(msData, parallelise=parallelise, memmapPath=outputPath, blockSize=7)
+
+					self.assertIsInstance(correctedDataM.intensityData, numpy.memmap)
+					numpy.testing.assert_array_almost_equal(correctedDataM.intensityData, correctedDataS.intensityData)
+					numpy.testing.assert_array_almost_equal(numpy.load(outputPath), correctedDataS.intensityData)
+					numpy.testing.assert_array_almost_equal(correctedDataM.fit, correctedDataS.fit)
+
+					del correctedDataM
+
+			with self.subTest(msg='One worker pool for all blocks'):
+				from unittest.mock import patch
+				import nPYc.batchAndROCorrection._batchAndROCorrection as batchAndROCorrection
+
+				outputPath = os.path.join(tmpdirname, 'correctedPool.npy')
+				with patch.object(batchAndROCorrection, '_workerPool', wraps=batchAndROCorrection._workerPool) as workerPool:
+					correctedDataM = nPYc.batchAndROCorrection.correctMSdataset(msData, parallelise=True, nJobs=2, memmapPath=outputPath, blockSize=7)
+
+				self.assertEqual(workerPool.call_count, 1)
+				numpy.testing.assert_array_almost_equal(correctedDataM.intensityData, correctedDataS.intensityData)
+				numpy.testing.assert_array_almost_equal(correctedDataM.fit, correctedDataS.fit)
+
+				del correctedDataM
+
+			del msData
+
+	def test_correctMSdataset_excludeFailures(self):
+		"""
+		Features whose fit fails in any batch are masked, with the reason recorded.
+		"""
+		import copy
+
+		msData = copy.deepcopy(self.msData)
+		msData.sampleMetadata['Correction Batch'] = numpy.where(msData.sampleMetadata['Run Order'] < self.noSamp / 2, 1., 2.)
+		referenceSamples = msData.sampleMetadata['SampleType'].values == SampleType.StudyPool
+
+		# Flat zero trend in batch 2
+		msData._intensityData[referenceSamples & (msData.sampleMetadata['Correction Batch'].values == 2), 1] = 0
+
+		with self.subTest(msg='Masked'):
+			correctedData = nPYc.batchAndROCorrection.correctMSdataset(msData, parallelise=False)
+
+			self.assertFalse(correctedData.featureMask[1])
+			self.assertEqual(correctedData.featureMetadata.loc[1, 'Exclusion Details'], 'Correction failure: non-positive fit in batch 2')
+			self.assertEqual(sum(correctedData.featureMask), sum(numpy.all(numpy.isfinite(correctedData.intensityData) & (numpy.asarray(correctedData.fit) > 0), axis=0)))
+
+		with self.subTest(msg='Previous exclusions are kept'):
+			msData.featureMetadata['Exclusion Details'] = ''
+			msData.featureMetadata.loc[1, 'Exclusion Details'] = 'User Excluded'
+
+			correctedData = nPYc.batchAndROCorrection.correctMSdataset(msData, parallelise=False)
+
+			self.assertEqual(correctedData.featureMetadata.loc[1, 'Exclusion Details'], 'User Excluded AND Correction failure: non-positive fit in batch 2')
+
+		with self.subTest(msg='Not excluded'):
+			correctedData = nPYc.batchAndROCorrection.correctMSdataset(msData, parallelise=False, excludeFailures=False)
+
+			self.assertTrue(correctedData.featureMask[1])
+
+	def test_correctMSdataset_float32(self):
+		"""
+		Single precision correction stays within the documented tolerance of double precision.
+		"""
+		with self.subTest(msg='LOWESS'):
+			correctedData64 = nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=False)
+			correctedData32 = nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=False, dtype=numpy.float32)
+
+			self.assertEqual(correctedData32.intensityData.dtype, numpy.float32)
+			self.assertEqual(correctedData32.fit.dtype, numpy.float32)
+			self.assertEqual(correctedData32._correctionState['parameters']['dtype'], numpy.float32)
+
+			numpy.testing.assert_allclose(correctedData32.intensityData, correctedData64.intensityData, rtol=1e-5)
+			numpy.testing.assert_allclose(numpy.asarray(correctedData32.fit), numpy.asarray(correctedData64.fit), rtol=1e-5)
+
+		with self.subTest(msg='Parallel'):
+			correctedDataP = nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=True, dtype=numpy.float32)
+
+			self.assertEqual(correctedDataP.intensityData.dtype, numpy.float32)
+			numpy.testing.assert_allclose(correctedDataP.intensityData, correctedData32.intensityData, rtol=1e-6)
+
+		with self.subTest(msg='SavitzkyGolay'):
+			correctedData64 = nPYc.batchAndROCorrection.correctMSdataset(self.msData, method='SavitzkyGolay', parallelise=False)
+			correctedData32 = nPYc.batchAndROCorrection.correctMSdataset(self.msData, method='SavitzkyGolay', parallelise=False, dtype=numpy.float32)
+
+			fit64 = numpy.asarray(correctedData64.fit)
+			scale = numpy.max(numpy.abs(fit64), axis=0)
+			self.assertTrue(numpy.all(numpy.abs(numpy.asarray(correctedData32.fit) - fit64) < 1e-5 * scale))
+
+			awayFromZero = numpy.abs(fit64) > 0.1 * scale
+			numpy.testing.assert_allclose(correctedData32.intensityData[awayFromZero], correctedData64.intensityData[awayFromZero], rtol=1e-5)
+
+	def test_correctMSdataset_timings(self):
+		"""
+		Stage timings are logged as JSON, and returned on request.
+		"""
+		import json
+
+		for parallelise in [False, True]:
+			with self.subTest(msg='parallelise=%s' % parallelise):
+				(correctedData, timings) = nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=parallelise, returnTimings=True)
+
+				self.assertEqual(timings['samples'], self.noSamp)
+				self.assertEqual(timings['features'], self.noFeat)
+				self.assertGreater(timings['seconds'], 0)
+				self.assertGreaterEqual(timings['seconds'], sum(timings['stages'].values()))
+				for stage in ['reassembly', 'compression', 'failureChecks', 'copy']:
+					self.assertIn(stage, timings['stages'])
+
+				if parallelise:
+					self.assertIn('workers', timings['stages'])
+					self.assertIn('smoothing', timings['workerStages'])
+					self.assertEqual(sum(worker['features'] for worker in timings['workers']), self.noFeat * len(set(self.msData.sampleMetadata['Correction Batch'].dropna())))
+				else:
+					self.assertIn('smoothing', timings['stages'])
+					self.assertEqual(timings['workers'], [])
+
+				(_, message) = correctedData.Attributes['Log'][-1]
+				prefix = 'Batch and run order correction timings: '
+				self.assertTrue(message.startswith(prefix))
+				self.assertEqual(json.loads(message[len(prefix):]), json.loads(json.dumps(timings)))
+
+		with self.subTest(msg='Default return'):
+			self.assertIsInstance(nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=False), nPYc.MSDataset)
+
+		with self.subTest(msg='Raises'):
+			self.assertRaises(TypeError, nPYc.batchAndROCorrection.correctMSdataset, self.msData, returnTimings=1)
+
+	def test_correctMSdataset_raises_engine(self):
+
+		self.assertRaises(ValueError, nPYc.batchAndROCorrection.correctMSdataset, self.msData, engine='R')
+
+	def test_correctMSdataset_raises_jobs(self):
+
+		with self.subTest(msg='nJobs'):
+			self.assertRaises(TypeError, nPYc.batchAndROCorrection.correctMSdataset, self.msData, nJobs=0)
+			self.assertRaises(TypeError, nPYc.batchAndROCorrection.correctMSdataset, self.msData, nJobs=1.5)
+
+		with self.subTest(msg='chunkSize'):
+			self.assertRaises(TypeError, nPYc.batchAndROCorrection.correctMSdataset, self.msData, chunkSize=0)
+
+		with self.subTest(msg='robustIterations'):
+			self.assertRaises(TypeError, nPYc.batchAndROCorrection.correctMSdataset, self.msData, robustIterations=-1)
+			self.assertRaises(TypeError, nPYc.batchAndROCorrection.correctMSdataset, self.msData, robustIterations=1.5)
+
+		with self.subTest(msg='dtype'):
+			self.assertRaises(ValueError, nPYc.batchAndROCorrection.correctMSdataset, self.msData, dtype=numpy.float16)
+			self.assertRaises(ValueError, nPYc.batchAndROCorrection.correctMSdataset, self.msData, dtype=int)
+
+		with self.subTest(msg='Out of core'):
+			from nPYc.utilities.normalisation import TotalAreaNormaliser
+
+			self.assertRaises(TypeError, nPYc.batchAndROCorrection.correctMSdataset, self.msData, memmapPath=1)
+			self.assertRaises(TypeError, nPYc.batchAndROCorrection.correctMSdataset, self.msData, memmapPath='corrected.npy', blockSize=0)
+
+			self.msData.Normalisation = TotalAreaNormaliser()
+			self.assertRaises(ValueError, nPYc.batchAndROCorrection.correctMSdataset, self.msData, memmapPath='corrected.npy')
+
+
 class test_rocorrection_synthetic(unittest.TestCase):
 
 	def setUp(self):
@@ -107,6 +314,127 @@ class test_rocorrection_synthetic(unittest.TestCase):
 		numpy.testing.assert_array_almost_equal(self.testD, fit)
 		numpy.testing.assert_array_almost_equal(numpy.std(corrected), 0.)
 
+	def test_doLOESScorrectionVectorised_synthetic(self):
+		"""
+		Vectorised fits should match statsmodels for each column, including where reference samples contain outliers or missing values.
+		"""
+		noFeatures = 5
+		QCdata = numpy.tile(self.testD[self.testSRmask], (noFeatures, 1)).T * numpy.linspace(1, 2, noFeatures)
+		QCdata = QCdata + numpy.random.randn(*QCdata.shape) * 0.1
+		QCdata[3, 1] = QCdata[3, 1] * 10
+		QCdata[4, 2] = numpy.nan
+		data = numpy.tile(self.testD, (noFeatures, 1)).T
+
+		corrected, fit = nPYc.batchAndROCorrection._batchAndROCorrection.doLOESScorrectionVectorised(QCdata,
+																								   self.testRO[self.testSRmask],
+																								   data,
+																								   self.testRO,
+																								   window=11)
+
+		for i in range(noFeatures):
+			expectedCorrected, expectedFit = nPYc.batchAndROCorrection._batchAndROCorrection.doLOESScorrection(QCdata[:, i],
+																											  self.testRO[self.testSRmask],
+																											  data[:, i],
+																											  self.testRO,
+																											  window=11)
+
+			numpy.testing.assert_allclose(fit[:, i], expectedFit, rtol=1e-7)
+			numpy.testing.assert_allclose(corrected[:, i], expectedCorrected, rtol=1e-7)
+
+	def test_doLOESScorrectionVectorised_windows(self):
+		"""
+		Vectorised fits should match statsmodels in small windows, where neighbourhoods are often left without weight, with and without tied run orders.
+		"""
+		noFeatures = 50
+		noReferences = 30
+		randomState = numpy.random.RandomState(2)
+
+		QCdata = randomState.lognormal(size=(noReferences, noFeatures))
+		QCdata[randomState.randint(noReferences, size=noFeatures), numpy.arange(noFeatures)] *= 50
+		data = numpy.tile(self.testD, (noFeatures, 1)).T
+
+		for tied in [False, True]:
+			# Irregularly spaced reference samples, drawn with replacement from a narrow range to tie run orders
+			if tied:
+				runOrder = numpy.sort(randomState.choice(self.testRO[:noReferences], size=noReferences))
+			else:
+				runOrder = numpy.sort(randomState.choice(self.testRO, size=noReferences, replace=False))
+
+			for window in range(3, 8):
+				for robustIterations in [0, 1, 3]:
+					with self.subTest(msg='tied=%s, window=%i, robustIterations=%i' % (tied, window, robustIterations)):
+						corrected, fit = nPYc.batchAndROCorrection._batchAndROCorrection.doLOESScorrectionVectorised(QCdata, runOrder, data, self.testRO, window=window, robustIterations=robustIterations)
+
+						for i in range(noFeatures):
+							expectedCorrected, expectedFit = nPYc.batchAndROCorrection._batchAndROCorrection.doLOESScorrection(QCdata[:, i], runOrder, data[:, i], self.testRO, window=window, robustIterations=robustIterations)
+
+							numpy.testing.assert_allclose(fit[:, i], expectedFit, rtol=1e-7)
+							numpy.testing.assert_allclose(corrected[:, i], expectedCorrected, rtol=1e-7)
+
+	def test_doLOESScorrection_robustIterations(self):
+		"""
+		Vectorised fits should match statsmodels for any number of robustifying iterations, and iterating should resist bad injections.
+		"""
+		noFeatures = 5
+		QCrunOrder = self.testRO[self.testSRmask]
+		QCdata = numpy.tile(self.testD[self.testSRmask], (noFeatures, 1)).T * numpy.linspace(1, 2, noFeatures)
+		QCdata = QCdata + numpy.random.randn(*QCdata.shape) * 0.1
+		data = numpy.tile(self.testD, (noFeatures, 1)).T
+
+		# Bad injection
+		QCdata[10, :] = QCdata[10, :] * 10
+
+		for robustIterations in [0, 1, 5]:
+			with self.subTest(msg='%i iterations' % robustIterations):
+				corrected, fit = nPYc.batchAndROCorrection._batchAndROCorrection.doLOESScorrectionVectorised(QCdata, QCrunOrder, data, self.testRO, window=11, robustIterations=robustIterations)
+
+				for i in range(noFeatures):
+					expectedCorrected, expectedFit = nPYc.batchAndROCorrection._batchAndROCorrection.doLOESScorrection(QCdata[:, i], QCrunOrder, data[:, i], self.testRO, window=11, robustIterations=robustIterations)
+
+					numpy.testing.assert_allclose(fit[:, i], expectedFit, rtol=1e-7)
+					numpy.testing.assert_allclose(corrected[:, i], expectedCorrected, rtol=1e-7)
+
+		with self.subTest(msg='Outlier resistance'):
+			clean = numpy.tile(self.testD[self.testSRmask], (noFeatures, 1)).T * numpy.linspace(1, 2, noFeatures)
+			atOutlier = QCrunOrder[10]
+
+			# Window wide enough for the outlier's neighbours to outnumber it
+			(_, plainFit) = nPYc.batchAndROCorrection._batchAndROCorrection.doLOESScorrectionVectorised(QCdata, QCrunOrder, data, self.testRO, window=21, robustIterations=0)
+			(_, robustFit) = nPYc.batchAndROCorrection._batchAndROCorrection.doLOESScorrectionVectorised(QCdata, QCrunOrder, data, self.testRO, window=21, robustIterations=3)
+
+			expected = clean[10, :]
+			plainError = numpy.abs(plainFit[self.testRO == atOutlier, :] - expected)
+			robustError = numpy.abs(robustFit[self.testRO == atOutlier, :] - expected)
+
+			self.assertTrue(numpy.all(robustError < plainError / 10))
+
+	def test_doSavitzkyGolayCorrection_columns(self):
+		"""
+		Filtering all columns together should match the per-feature Savitzky-Golay algorithm applied to each column.
+		"""
+		from scipy.signal import savgol_filter
+
+		noFeatures = 4
+		QCdata = numpy.tile(self.testD[self.testSRmask], (noFeatures, 1)).T + numpy.random.randn(sum(self.testSRmask), noFeatures)
+		data = numpy.tile(self.testD, (noFeatures, 1)).T
+
+		corrected, fit = nPYc.batchAndROCorrection._batchAndROCorrection.doSavitzkyGolayCorrection(QCdata,
+																								  self.testRO[self.testSRmask],
+																								  data,
+																								  self.testRO,
+																								  window=11)
+
+		QCrunorder = self.testRO[self.testSRmask]
+		sortedRO = numpy.argsort(QCrunorder)
+		for i in range(noFeatures):
+			# Reference implementation, one feature at a time
+			z = savgol_filter(QCdata[sortedRO, i], 11, 3)
+			expectedFit = numpy.interp(self.testRO, QCrunorder[sortedRO], z)
+			expectedCorrected = numpy.divide(data[:, i], expectedFit) * numpy.median(QCdata[:, i])
+
+			numpy.testing.assert_allclose(fit[:, i], expectedFit)
+			numpy.testing.assert_allclose(corrected[:, i], expectedCorrected)
+
 	def test_batchCorrection_synthetic(self):
 
 		# We need at least two features - pick which randomly
@@ -131,6 +459,343 @@ class test_rocorrection_synthetic(unittest.TestCase):
 		numpy.testing.assert_array_almost_equal(numpy.std(corrected), 0.)
 
 
+class test_correctionFit(unittest.TestCase):
+	"""
+	Test compact storage of correction fits.
+	"""
+
+	def setUp(self):
+		self.noSamp = numpy.random.randint(100, high=300, size=None)
+		self.noFeat = numpy.random.randint(10, high=50, size=None)
+
+		self.runOrder = numpy.random.permutation(self.noSamp).astype(float)
+		self.batchList = numpy.where(self.runOrder < self.noSamp / 2, 1., 2.)
+		self.batchList[0] = numpy.nan
+		self.referenceSamples = numpy.zeros(self.noSamp, dtype=bool)
+		self.referenceSamples[::5] = True
+
+		# Trends linear between reference samples are stored exactly
+		self.fits = numpy.full((self.noSamp, self.noFeat), numpy.nan)
+		for batch in [1., 2.]:
+			batchMask = self.batchList == batch
+			QC = batchMask & self.referenceSamples
+			order = numpy.argsort(self.runOrder[QC])
+			for feature in range(self.noFeat):
+				self.fits[batchMask, feature] = numpy.interp(self.runOrder[batchMask], self.runOrder[QC][order], numpy.random.lognormal(size=sum(QC))[order])
+
+	def test_correctionFit(self):
+		from nPYc.batchAndROCorrection import CorrectionFit
+
+		fit = CorrectionFit.fromDense(self.fits, self.runOrder, self.referenceSamples, self.batchList)
+
+		with self.subTest(msg='Dense fit'):
+			self.assertEqual(fit.shape, self.fits.shape)
+			numpy.testing.assert_allclose(numpy.asarray(fit), self.fits, rtol=1e-12)
+			self.assertEqual(len(fit._dense), 0)
+			self.assertLess(fit.nbytes, self.fits.nbytes)
+
+		with self.subTest(msg='Single features'):
+			numpy.testing.assert_allclose(fit[:, 3], self.fits[:, 3], rtol=1e-12)
+			numpy.testing.assert_allclose(fit[[5, 2], 3], self.fits[[5, 2], 3], rtol=1e-12)
+			numpy.testing.assert_allclose(fit.toArray([1, 3]), self.fits[:, [1, 3]], rtol=1e-12)
+
+		with self.subTest(msg='Masks'):
+			sampleMask = numpy.random.random(self.noSamp) > 0.3
+			featureMask = numpy.random.random(self.noFeat) > 0.3
+
+			masked = fit[sampleMask, :][:, featureMask]
+
+			self.assertIsInstance(masked, CorrectionFit)
+			numpy.testing.assert_allclose(numpy.asarray(masked), self.fits[sampleMask, :][:, featureMask], rtol=1e-12)
+
+		with self.subTest(msg='Fits not reproduced by the knots'):
+			fits = numpy.copy(self.fits)
+			fits[1, 4] = -1
+
+			fit = CorrectionFit.fromDense(fits, self.runOrder, self.referenceSamples, self.batchList)
+
+			self.assertEqual(list(fit._dense.keys()), [4])
+			numpy.testing.assert_allclose(numpy.asarray(fit), fits, rtol=1e-12)
+
+	def test_correctMSdataset_fit(self):
+		"""
+		Check applyMasks slices the compact fit as it would the dense one.
+		"""
+		msData = generateTestDataset(self.noSamp, self.noFeat, dtype='MSDataset')
+		correctedData = nPYc.batchAndROCorrection.correctMSdataset(msData, parallelise=False)
+
+		fits = numpy.asarray(correctedData.fit)
+
+		correctedData.sampleMask = numpy.random.random(self.noSamp) > 0.3
+		correctedData.featureMask = numpy.random.random(self.noFeat) > 0.3
+		expected = fits[correctedData.sampleMask, :][:, correctedData.featureMask]
+
+		correctedData.applyMasks()
+
+		numpy.testing.assert_allclose(numpy.asarray(correctedData.fit), expected, rtol=1e-12)
+
+
+class test_fitCache(unittest.TestCase):
+	"""
+	Test reuse of run-order correction fits.
+	"""
+
+	def setUp(self):
+		self.noFeat = numpy.random.randint(10, high=50, size=None)
+		self.msData = generateTestDataset(300, self.noFeat, dtype='MSDataset')
+
+		nPYc.batchAndROCorrection.fitCache.clear()
+
+	def tearDown(self):
+		nPYc.batchAndROCorrection.fitCache.clear()
+
+	def test_fitCache_eviction(self):
+		from nPYc.batchAndROCorrection import FitCache
+
+		cache = FitCache(maxBytes=3 * 8 * 10)
+		values = [numpy.random.random(10) for i in range(4)]
+		keys = [FitCache.key(value, numpy.arange(10), ('LOWESS', 11, 'statsmodels')) for value in values]
+
+		for (key, value) in zip(keys[:3], values[:3]):
+			cache.put(key, value)
+
+		# Touch the first entry, so the second is least recently used
+		numpy.testing.assert_array_equal(cache.get(keys[0]), values[0])
+		cache.put(keys[3], values[3])
+
+		self.assertEqual(len(cache), 3)
+		self.assertIsNone(cache.get(keys[1]))
+		numpy.testing.assert_array_equal(cache.get(keys[3]), values[3])
+		self.assertLessEqual(cache.nbytes, cache.maxBytes)
+
+		with self.subTest(msg='Parameters are part of the key'):
+			self.assertNotEqual(keys[0], FitCache.key(values[0], numpy.arange(10), ('LOWESS', 13, 'statsmodels')))
+
+	def test_fitCache_correctMSdataset(self):
+		from nPYc.batchAndROCorrection._batchAndROCorrection import _batchCorrection
+
+		fitCache = nPYc.batchAndROCorrection.fitCache
+		fitCache.maxBytes = 0
+		expected = nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=False)
+		fitCache.maxBytes = 2**28
+
+		with self.subTest(msg='Fits from the assessment report are reused'):
+			referenceSamples = (self.msData.sampleMetadata['SampleType'].values == SampleType.StudyPool) & (self.msData.sampleMetadata['AssayRole'].values == AssayRole.PrecisionReference)
+			parameters = {'window': 11, 'method': 'LOWESS', 'align': 'median', 'cacheFits': True}
+
+			_batchCorrection(self.msData.intensityData[:, 0], self.msData.sampleMetadata['Run Order'].values, referenceSamples, self.msData.sampleMetadata['Correction Batch'].values, range(0, 1), parameters, 0)
+			noCached = len(fitCache)
+
+			fitCache.hits = 0
+			correctedData = nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=False)
+
+			self.assertEqual(fitCache.hits, noCached)
+			numpy.testing.assert_array_equal(correctedData.intensityData, expected.intensityData)
+
+		for parallelise in [False, True]:
+			with self.subTest(msg='Cached fits, parallelise=%s' % parallelise):
+				correctedData = nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=parallelise)
+
+				numpy.testing.assert_array_equal(correctedData.intensityData, expected.intensityData)
+				numpy.testing.assert_array_equal(numpy.asarray(correctedData.fit), numpy.asarray(expected.fit))
+
+		with self.subTest(msg='Vectorised engine does not use the cache'):
+			fitCache.hits = 0
+			fitCache.misses = 0
+			nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=False, engine='vectorised')
+
+			self.assertEqual(fitCache.hits + fitCache.misses, 0)
+
+		with self.subTest(msg='Correction adds no fits'):
+			fitCache.clear()
+			for parallelise in [False, True]:
+				nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=parallelise)
+
+				self.assertEqual(len(fitCache), 0)
+				self.assertEqual(fitCache.misses, 0)
+
+
+class test_correctMSdatasets(unittest.TestCase):
+	"""
+	Test correcting datasets sharing an injection sequence together.
+	"""
+
+	def setUp(self):
+		import copy
+
+		self.noSamp = numpy.random.randint(100, high=300, size=None)
+
+		self.msDataPos = generateTestDataset(self.noSamp, numpy.random.randint(10, high=50, size=None), dtype='MSDataset')
+		self.msDataNeg = generateTestDataset(self.noSamp, numpy.random.randint(10, high=50, size=None), dtype='MSDataset')
+		self.msDataNeg.sampleMetadata = copy.deepcopy(self.msDataPos.sampleMetadata)
+
+	def test_correctMSdatasets(self):
+
+		for (engine, parallelise) in [('statsmodels', False), ('vectorised', False), ('vectorised', True)]:
+			with self.subTest(msg='engine=%s, parallelise=%s' % (engine, parallelise)):
+				correctedData = nPYc.batchAndROCorrection.correctMSdatasets([self.msDataPos, self.msDataNeg], engine=engine, parallelise=parallelise)
+
+				self.assertEqual(len(correctedData), 2)
+				for (data, corrected) in zip([self.msDataPos, self.msDataNeg], correctedData):
+					expected = nPYc.batchAndROCorrection.correctMSdataset(data, engine=engine, parallelise=False)
+
+					numpy.testing.assert_allclose(corrected.intensityData, expected.intensityData)
+					numpy.testing.assert_allclose(numpy.asarray(corrected.fit), numpy.asarray(expected.fit))
+					numpy.testing.assert_array_equal(corrected.featureMask, expected.featureMask)
+
+	def test_correctMSdatasets_raises(self):
+
+		with self.subTest(msg='Not a list of datasets'):
+			self.assertRaises(TypeError, nPYc.batchAndROCorrection.correctMSdatasets, self.msDataPos)
+			self.assertRaises(TypeError, nPYc.batchAndROCorrection.correctMSdatasets, [])
+
+		with self.subTest(msg='Different run order'):
+			self.msDataNeg.sampleMetadata['Run Order'] = self.msDataNeg.sampleMetadata['Run Order'].values[::-1]
+			self.assertRaises(ValueError, nPYc.batchAndROCorrection.correctMSdatasets, [self.msDataPos, self.msDataNeg])
+
+		with self.subTest(msg='Different samples'):
+			msData = generateTestDataset(self.noSamp + 1, 10, dtype='MSDataset')
+			self.assertRaises(ValueError, nPYc.batchAndROCorrection.correctMSdatasets, [self.msDataPos, msData])
+
+
+class test_correctNewBatches(unittest.TestCase):
+	"""
+	Test extending a correction to newly acquired batches.
+	"""
+
+	def setUp(self):
+		import copy
+
+		self.noFeat = numpy.random.randint(10, high=50, size=None)
+		self.msData = generateTestDataset(400, self.noFeat, dtype='MSDataset')
+
+		self.msDataFirstBatch = copy.deepcopy(self.msData)
+		self.msDataFirstBatch.sampleMask = (self.msDataFirstBatch.sampleMetadata['Correction Batch'] != 2).values
+		self.msDataFirstBatch.applyMasks()
+
+	def test_correctNewBatches(self):
+
+		for align in ['median', 'mean', 'no']:
+			with self.subTest(msg='Matches full correction, align=%s' % align):
+				correctedFirstBatch = nPYc.batchAndROCorrection.correctMSdataset(self.msDataFirstBatch, parallelise=False, align=align)
+
+				correctedIncremental = nPYc.batchAndROCorrection.correctNewBatches(self.msData, correctedFirstBatch, parallelise=False)
+				correctedFull = nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=False, align=align)
+
+				numpy.testing.assert_allclose(correctedIncremental.intensityData, correctedFull.intensityData)
+				numpy.testing.assert_allclose(correctedIncremental.fit, correctedFull.fit)
+
+		with self.subTest(msg='Nothing new to correct'):
+			correctedFull = nPYc.batchAndROCorrection.correctMSdataset(self.msData, parallelise=False)
+			correctedIncremental = nPYc.batchAndROCorrection.correctNewBatches(self.msData, correctedFull, parallelise=False)
+
+			numpy.testing.assert_allclose(correctedIncremental.intensityData, correctedFull.intensityData)
+
+	def test_correctNewBatches_excludeFailures(self):
+		"""
+		Features whose fit fails in a new or an earlier batch are masked, as in a full correction.
+		"""
+		import copy
+
+		msData = copy.deepcopy(self.msData)
+		referenceSamples = msData.sampleMetadata['SampleType'].values == SampleType.StudyPool
+		batchList = msData.sampleMetadata['Correction Batch'].values
+
+		# Flat zero trends in the first batch for feature 0, and in the new batch for feature 1
+		msData._intensityData[referenceSamples & (batchList == 1), 0] = 0
+		msData._intensityData[referenceSamples & (batchList == 2), 1] = 0
+
+		msDataFirstBatch = copy.deepcopy(msData)
+		msDataFirstBatch.sampleMask = batchList != 2
+		msDataFirstBatch.applyMasks()
+
+		for excludeFailures in [True, False]:
+			with self.subTest(msg='excludeFailures=%s' % excludeFailures):
+				correctedFirstBatch = nPYc.batchAndROCorrection.correctMSdataset(msDataFirstBatch, parallelise=False, excludeFailures=excludeFailures)
+
+				correctedIncremental = nPYc.batchAndROCorrection.correctNewBatches(msData, correctedFirstBatch, parallelise=False)
+				correctedFull = nPYc.batchAndROCorrection.correctMSdataset(msData, parallelise=False, excludeFailures=excludeFailures)
+
+				numpy.testing.assert_array_equal(correctedIncremental.featureMask, correctedFull.featureMask)
+				self.assertEqual(list(correctedIncremental.featureMetadata['Exclusion Details']), list(correctedFull.featureMetadata['Exclusion Details']))
+				numpy.testing.assert_allclose(correctedIncremental.intensityData, correctedFull.intensityData)
+				self.assertEqual(sum(~correctedIncremental.featureMask), 2 if excludeFailures else 0)
+
+	def test_correctNewBatches_raises(self):
+
+		with self.subTest(msg='Not a corrected dataset'):
+			self.assertRaises(ValueError, nPYc.batchAndROCorrection.correctNewBatches, self.msData, self.msDataFirstBatch)
+
+		with self.subTest(msg='Samples added to a corrected batch'):
+			import copy
+			correctedFirstBatch = nPYc.batchAndROCorrection.correctMSdataset(self.msDataFirstBatch, parallelise=False)
+			msData = copy.deepcopy(self.msData)
+			msData.sampleMetadata['Correction Batch'] = 1
+
+			self.assertRaises(ValueError, nPYc.batchAndROCorrection.correctNewBatches, msData, correctedFirstBatch)
+
+
+class test_optimiseCorrection(unittest.TestCase):
+	"""
+	Test the search for run-order correction windows.
+	"""
+
+	def setUp(self):
+		self.noFeat = numpy.random.randint(10, high=50, size=None)
+		self.msData = generateTestDataset(300, self.noFeat, dtype='MSDataset')
+		self.windows = [5, 11, 21]
+
+	def test_optimiseCorrection(self):
+
+		with self.subTest(msg='Dataset-wide window'):
+			window, rsds = nPYc.batchAndROCorrection.optimiseCorrection(self.msData, windows=self.windows, parallelise=False)
+
+			self.assertIn(window, self.windows)
+			self.assertEqual(rsds.shape, (len(self.windows), self.noFeat))
+			self.assertEqual(window, self.windows[numpy.argmin(numpy.median(rsds, axis=1))])
+
+		with self.subTest(msg='Per-feature windows'):
+			windows, rsds = nPYc.batchAndROCorrection.optimiseCorrection(self.msData, windows=self.windows, perFeature=True, parallelise=False)
+
+			self.assertEqual(windows.shape, (self.noFeat,))
+			numpy.testing.assert_array_equal(windows, numpy.array(self.windows)[numpy.argmin(rsds, axis=0)])
+
+		with self.subTest(msg='Parallel scoring'):
+			windowP, rsdsP = nPYc.batchAndROCorrection.optimiseCorrection(self.msData, windows=self.windows, parallelise=True)
+			windowS, rsdsS = nPYc.batchAndROCorrection.optimiseCorrection(self.msData, windows=self.windows, parallelise=False)
+
+			self.assertEqual(windowP, windowS)
+			numpy.testing.assert_allclose(rsdsP, rsdsS)
+
+		with self.subTest(msg='Savitzky-Golay'):
+			window, rsds = nPYc.batchAndROCorrection.optimiseCorrection(self.msData, windows=self.windows, method='SavitzkyGolay', parallelise=False)
+
+			self.assertIn(window, self.windows)
+
+	def test_optimiseCorrection_trend(self):
+		"""
+		Over-smoothing a strong non-linear trend leaves it in the data, so the widest window should not be selected.
+		"""
+		runOrder = self.msData.sampleMetadata['Run Order'].values
+		trend = 2 + numpy.sin(runOrder / runOrder.max() * 4 * numpy.pi)
+		self.msData._intensityData = numpy.outer(trend, numpy.ones(self.noFeat)) * (1 + numpy.random.randn(300, self.noFeat) * 0.01)
+
+		window, rsds = nPYc.batchAndROCorrection.optimiseCorrection(self.msData, windows=[5, 11, 301], parallelise=False)
+
+		self.assertNotEqual(window, 301)
+
+	def test_optimiseCorrection_raises(self):
+
+		with self.subTest(msg='Object type'):
+			self.assertRaises(TypeError, nPYc.batchAndROCorrection.optimiseCorrection, 's')
+
+		with self.subTest(msg='Window type'):
+			self.assertRaises(TypeError, nPYc.batchAndROCorrection.optimiseCorrection, self.msData, windows=[5, 1.5])
+
+		with self.subTest(msg='Method'):
+			self.assertRaises(ValueError, nPYc.batchAndROCorrection.optimiseCorrection, self.msData, method=None)
+
+
 class test_batchcorrection(unittest.TestCase):
 	"""
 	Test alignment of batch offsets
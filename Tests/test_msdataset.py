@@ -3,6 +3,7 @@ import pandas
 import numpy
 import sys
 import unittest
+import unittest.mock
 from datetime import datetime
 from pandas.testing import assert_frame_equal, assert_series_equal
 import os
@@ -89,6 +90,99 @@ class test_msdataset_synthetic(unittest.TestCase):
 				msData.rsdSP
 
 
+	def test_rsd_cache(self):
+
+		from nPYc.utilities import rsd
+
+		msData = generateTestDataset(20, 50, dtype='MSDataset')
+		expected = rsd(msData._intensityData[(msData.sampleMetadata['AssayRole'] == AssayRole.PrecisionReference).values & (msData.sampleMetadata['SampleType'] == SampleType.StudyPool).values])
+
+		with unittest.mock.patch('nPYc.objects._msDataset.rsd', side_effect=rsd) as rsdMock:
+			with self.subTest(msg='Repeated requests'):
+				numpy.testing.assert_array_equal(msData.rsdSP, expected)
+				rsdSP = msData.rsdSP
+				rsdSP[:] = 0
+				numpy.testing.assert_array_equal(msData.rsdSP, expected)
+				self.assertEqual(rsdMock.call_count, 1)
+
+			with self.subTest(msg='Study samples'):
+				msData.rsdSS
+				msData.rsdSS
+				self.assertEqual(rsdMock.call_count, 2)
+
+			with self.subTest(msg='Sample mask'):
+				msData.sampleMask[numpy.where(msData.sampleMetadata['AssayRole'] == AssayRole.PrecisionReference)[0][0]] = False
+				self.assertFalse(numpy.array_equal(msData.rsdSP, expected, equal_nan=True))
+				self.assertEqual(rsdMock.call_count, 3)
+				msData.initialiseMasks()
+
+			with self.subTest(msg='Sample roles'):
+				msData.sampleMetadata.loc[0, 'AssayRole'] = AssayRole.Assay
+				msData.rsdSP
+				self.assertEqual(rsdMock.call_count, 4)
+
+			with self.subTest(msg='Intensity data'):
+				msData.intensityData = msData._intensityData * 2
+				msData.rsdSP
+				self.assertEqual(rsdMock.call_count, 5)
+
+			with self.subTest(msg='Normalisation'):
+				msData.Normalisation = nPYc.utilities.normalisation.TotalAreaNormaliser()
+				msData.rsdSP
+				self.assertEqual(rsdMock.call_count, 6)
+
+	def test_blank_filter_cache(self):
+
+		from nPYc.utilities._filters import blankFilter
+
+		msData = generateTestDataset(20, 50, dtype='MSDataset')
+		msData.sampleMetadata.loc[0:3, 'SampleType'] = SampleType.ProceduralBlank
+		msData.sampleMetadata.loc[0:3, 'AssayRole'] = AssayRole.Assay
+		msData._intensityData[0:4, :] = msData._intensityData[4:, :].mean(axis=0)
+
+		with unittest.mock.patch('nPYc.objects._msDataset.blankFilter', side_effect=blankFilter) as filterMock:
+			with self.subTest(msg='Repeated requests'):
+				expected = msData._blankFilter(1.5)[0]
+				numpy.testing.assert_array_equal(msData._blankFilter(1.5)[0], expected)
+				self.assertEqual(filterMock.call_count, 1)
+
+			with self.subTest(msg='Intensity data'):
+				intensityData = msData._intensityData.copy()
+				intensityData[4:, :] = 0
+				msData.intensityData = intensityData
+				self.assertFalse(any(msData._blankFilter(1.5)[0]))
+				self.assertEqual(filterMock.call_count, 2)
+
+			with self.subTest(msg='Sample mask'):
+				msData.sampleMask[0:4] = False
+				msData._blankFilter(1.5)
+				self.assertEqual(filterMock.call_count, 3)
+
+	def test_pickle(self):
+
+		import pickle
+
+		msData = generateTestDataset(20, 50, dtype='MSDataset')
+		msData.Attributes['corrMethod'] = 'pearson'
+		msData.sampleMetadata['Dilution'] = numpy.linspace(1, 100, msData.noSamples)
+		msData.sampleMetadata['Dilution Series'] = 1
+		msData.sampleMetadata.loc[0:9, 'AssayRole'] = AssayRole.LinearityReference
+		msData.sampleMetadata.loc[0:9, 'SampleType'] = SampleType.StudyPool
+		expected = msData.correlationToDilution
+
+		with self.subTest(msg='With cached statistics'):
+			unpickled = pickle.loads(pickle.dumps(msData))
+			numpy.testing.assert_array_equal(unpickled.correlationToDilution, expected)
+			numpy.testing.assert_array_equal(unpickled.rsdSP, msData.rsdSP)
+
+		with self.subTest(msg='Pickled without caches'):
+			state = msData.__getstate__()
+			self.assertNotIn('_statisticsCache', state)
+			unpickled = nPYc.MSDataset.__new__(nPYc.MSDataset)
+			unpickled.__setstate__(state)
+			del unpickled.correlationToDilution
+			numpy.testing.assert_array_equal(unpickled.correlationToDilution, expected)
+
 	def test_getsamplemetadatafromfilename(self):
 		"""
 		Test we are parsing NPC MS filenames correctly (PCSOP.081).
@@ -578,6 +672,8 @@ class test_msdataset_synthetic(unittest.TestCase):
 											   'artifactualFilter': False,'blankFilter':True}, **dict(blankThreshold=0.5))
 
 			numpy.testing.assert_array_equal(expectedFeatureMask, msData.featureMask)
+			self.assertEqual(msData.Attributes['filterParameters']['blankThreshold'], 0.5)
+			numpy.testing.assert_allclose(msData.featureMetadata['blankRatio'].values, msData.featureMetadata['blankValue'].values / numpy.mean(msData.intensityData[(msData.sampleMetadata['SampleType'] == SampleType.StudySample).values & (msData.sampleMetadata['AssayRole'] == AssayRole.Assay).values, :], axis=0))
 
 		with self.subTest(msg='No blank filter'):
 			expectedFeatureMask = numpy.array([True, False, False, False, True], dtype=bool)
@@ -595,7 +691,7 @@ class test_msdataset_synthetic(unittest.TestCase):
 			msData.updateMasks(featureFilters={'rsdFilter':True, 'correlationToDilutionFilter':True, 'varianceRatioFilter':True,
 											   'artifactualFilter': True,'blankFilter':True})
 
-			assert_frame_equal(expectedTempArtifactualLinkageMatrix, msData._tempArtifactualLinkageMatrix)
+			assert_frame_equal(expectedTempArtifactualLinkageMatrix, msData._tempArtifactualLinkageMatrix[['node1', 'node2']])
 
 		with self.subTest(msg='Altered withArtifactualFiltering parameters'):
 			expectedArtifactualLinkageMatrix = pandas.DataFrame(data=[[0,1]],columns=['node1','node2'])
@@ -609,7 +705,7 @@ class test_msdataset_synthetic(unittest.TestCase):
 			self.assertEqual(msData.Attributes['filterParameters']['deltaMzArtifactual'], 300)
 			self.assertEqual(msData.Attributes['filterParameters']['overlapThresholdArtifactual'], 0.1)
 			self.assertEqual(msData.Attributes['filterParameters']['corrThresholdArtifactual'], 0.2)
-			assert_frame_equal(expectedArtifactualLinkageMatrix, msData._artifactualLinkageMatrix)
+			assert_frame_equal(expectedArtifactualLinkageMatrix, msData._artifactualLinkageMatrix[['node1', 'node2']])
 
 		with self.subTest(msg='withArtifactualFiltering=None, Attribute[artifactualFilter]=False'):
 			msData2 = copy.deepcopy(msData)
@@ -631,7 +727,7 @@ class test_msdataset_synthetic(unittest.TestCase):
 			msData2.updateMasks(featureFilters={'rsdFilter': True, 'correlationToDilutionFilter': True, 'varianceRatioFilter': True,
 											   'artifactualFilter': True,'blankFilter':True})
 
-			assert_frame_equal(expectedTempArtifactualLinkageMatrix, msData2._tempArtifactualLinkageMatrix)
+			assert_frame_equal(expectedTempArtifactualLinkageMatrix, msData2._tempArtifactualLinkageMatrix[['node1', 'node2']])
 
 
 	def test_updateMasks_samples(self):
@@ -789,6 +885,53 @@ class test_msdataset_synthetic(unittest.TestCase):
 			numpy.testing.assert_array_almost_equal(correlations, _vcorrcoef(dataset.intensityData, dataset.sampleMetadata['Dilution'].values))
 
 
+	def test_correlationToDilutionConfidence(self):
+
+		noSamp = numpy.random.randint(30, high=60, size=None)
+		noFeat = numpy.random.randint(50, high=100, size=None)
+
+		dataset = generateTestDataset(noSamp, noFeat, dtype='MSDataset', sop='GenericMS')
+
+		dataset.sampleMetadata['SampleType'] = nPYc.enumerations.SampleType.StudyPool
+		dataset.sampleMetadata['AssayRole'] = nPYc.enumerations.AssayRole.LinearityReference
+		dataset.sampleMetadata['Well'] = 1
+		dataset.sampleMetadata['Dilution'] = numpy.tile([1, 2, 5, 10, 20], noSamp)[:noSamp]
+		dataset.sampleMetadata['Dilution Series'] = numpy.arange(noSamp) % 2
+		dataset._intensityData[:, 0] = dataset.sampleMetadata['Dilution'].values * 100
+
+		confidence = dataset.correlationToDilutionConfidence(bootstrap=200, permutations=200, randomSeed=1)
+
+		with self.subTest(msg='Checking correlations'):
+			numpy.testing.assert_array_almost_equal(confidence['correlationToDilution'].values, dataset.correlationToDilution)
+
+		with self.subTest(msg='Checking intervals and p-values'):
+			self.assertTrue(all(confidence['correlationToDilutionLower'] <= confidence['correlationToDilutionUpper']))
+			self.assertTrue(all((confidence['correlationToDilutionPValue'] > 0) & (confidence['correlationToDilutionPValue'] <= 1)))
+			self.assertAlmostEqual(confidence['correlationToDilutionLower'].iloc[0], 1)
+			self.assertAlmostEqual(confidence['correlationToDilutionPValue'].iloc[0], 1 / 201)
+
+		with self.subTest(msg='Checking seeded resamples are repeated'):
+			pandas.testing.assert_frame_equal(confidence, dataset.correlationToDilutionConfidence(bootstrap=200, permutations=200, randomSeed=1, parallelise=False))
+
+		with self.subTest(msg='Checking bootstrap only'):
+			self.assertEqual(list(dataset.correlationToDilutionConfidence(bootstrap=10, permutations=0).columns),
+							 ['correlationToDilution', 'correlationToDilutionLower', 'correlationToDilutionUpper'])
+
+		with self.subTest(msg='Checking updateMasks'):
+			dataset.updateMasks(filterSamples=False, featureFilters={'rsdFilter': False, 'varianceRatioFilter': False}, corrThreshold=0, corrPValue=0.05, corrResamples=200, corrRandomSeed=1)
+
+			expected = (confidence['correlationToDilution'].values >= 0) & (confidence['correlationToDilutionPValue'].values <= 0.05)
+			numpy.testing.assert_array_equal(dataset.featureMask, expected)
+			numpy.testing.assert_array_equal(dataset.featureMetadata['correlationToDilutionPValue'].values, confidence['correlationToDilutionPValue'].values)
+			self.assertEqual(dataset.Attributes['filterParameters']['corrPValue'], 0.05)
+
+		with self.subTest(msg='Checking bad parameters'):
+			self.assertRaises(ValueError, dataset.correlationToDilutionConfidence, confidence=1.5)
+			self.assertRaises(ValueError, dataset.correlationToDilutionConfidence, bootstrap=-1)
+			self.assertRaises(TypeError, dataset.correlationToDilutionConfidence, permutations=1.5)
+			self.assertRaises(ValueError, dataset.updateMasks, corrConfidence=2)
+			self.assertRaises(TypeError, dataset.updateMasks, corrResamples='1000')
+
 	def test_correlateToDilution_raises(self):
 
 		noSamp = numpy.random.randint(30, high=500, size=None)
@@ -2368,14 +2511,14 @@ class test_msdataset_artifactual_filtering(unittest.TestCase):
 		result_artifactualLinkageMatrix = pandas.DataFrame(
 			[[5, 6], [7, 8], [9, 10], [11, 12], [13, 14], [13, 15], [13, 16], [14, 15], [14, 16], [15, 16]],
 			index=[1, 2, 3, 4, 5, 6, 7, 8, 9, 10], columns=['node1', 'node2'])
-		assert_frame_equal(self.msData.artifactualLinkageMatrix, result_artifactualLinkageMatrix)
-		assert_frame_equal(self.msData._artifactualLinkageMatrix, result_artifactualLinkageMatrix)
+		assert_frame_equal(self.msData.artifactualLinkageMatrix[['node1', 'node2']], result_artifactualLinkageMatrix)
+		assert_frame_equal(self.msData._artifactualLinkageMatrix[['node1', 'node2']], result_artifactualLinkageMatrix)
 
 		## _tempArtifactualLinkageMatrix (not filtered by correlation)
 		result_tempArtifactualLinkageMatrix = pandas.DataFrame(
 			[[3, 4], [5, 6], [7, 8], [9, 10], [11, 12], [13, 14], [13, 15], [13, 16], [14, 15], [14, 16], [15, 16]],
 			index=[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10], columns=['node1', 'node2'])
-		assert_frame_equal(self.msData._tempArtifactualLinkageMatrix, result_tempArtifactualLinkageMatrix)
+		assert_frame_equal(self.msData._tempArtifactualLinkageMatrix[['node1', 'node2']], result_tempArtifactualLinkageMatrix)
 
 		## artifactualFilter()
 		# default msData.featureMask
@@ -2407,6 +2550,28 @@ class test_msdataset_artifactual_filtering(unittest.TestCase):
 						msg='_artifactualLinkageMatrix hasnt been reset by deepcopy')
 
 
+	def test_pickle_artifactualFilter(self):
+		"""
+		Ensure datasets pickled without the artifactual candidate pairs recalculate them
+		"""
+		import pickle
+
+		expected = self.msData.artifactualLinkageMatrix.copy()
+
+		with self.subTest(msg='With candidate pairs'):
+			unpickled = pickle.loads(pickle.dumps(self.msData))
+			del unpickled.artifactualLinkageMatrix
+			assert_frame_equal(unpickled.artifactualLinkageMatrix, expected)
+
+		with self.subTest(msg='Pickled without candidate pairs'):
+			state = self.msData.__getstate__()
+			self.assertNotIn('_artifactualCandidateKey', state)
+			state['_artifactualLinkageMatrix'] = pandas.DataFrame(None)
+			unpickled = nPYc.MSDataset.__new__(nPYc.MSDataset)
+			unpickled.__setstate__(state)
+			assert_frame_equal(unpickled.artifactualLinkageMatrix, expected)
+
+
 	def test_deleter_artifactualFilter(self):
 		"""
 		Ensure variables necessary to artifactual filtering are reset when a deepcopy is employed
@@ -2436,14 +2601,14 @@ class test_msdataset_artifactual_filtering(unittest.TestCase):
 		updatedRes_artifactualLinkageMatrix = pandas.DataFrame(
 			[[11, 12], [13, 14], [13, 15], [13, 16], [14, 15], [14, 16], [15, 16]], index=[1, 2, 3, 4, 5, 6, 7],
 			columns=['node1', 'node2'])
-		assert_frame_equal(self.msData3.artifactualLinkageMatrix, updatedRes_artifactualLinkageMatrix)
-		assert_frame_equal(self.msData3._artifactualLinkageMatrix, updatedRes_artifactualLinkageMatrix)
+		assert_frame_equal(self.msData3.artifactualLinkageMatrix[['node1', 'node2']], updatedRes_artifactualLinkageMatrix)
+		assert_frame_equal(self.msData3._artifactualLinkageMatrix[['node1', 'node2']], updatedRes_artifactualLinkageMatrix)
 
 		## _tempArtifactualLinkageMatrix (not filtered by correlation)
 		updatedRes_tempArtifactualLinkageMatrix = pandas.DataFrame(
 			[[5, 6], [11, 12], [13, 14], [13, 15], [13, 16], [14, 15], [14, 16], [15, 16]],
 			index=[0, 1, 2, 3, 4, 5, 6, 7], columns=['node1', 'node2'])
-		assert_frame_equal(self.msData3._tempArtifactualLinkageMatrix, updatedRes_tempArtifactualLinkageMatrix)
+		assert_frame_equal(self.msData3._tempArtifactualLinkageMatrix[['node1', 'node2']], updatedRes_tempArtifactualLinkageMatrix)
 
 		## artifactualFilter()
 		# default self.featureMask
@@ -2478,14 +2643,14 @@ class test_msdataset_artifactual_filtering(unittest.TestCase):
 		# _artifactualLinkageMatrix, artifactualLinkageMatrix are modified
 		sampleMaskRes_artifactualLinkageMatrix = pandas.DataFrame([[14, 15], [14, 16], [15, 16]], index=[8, 9, 10],
 																  columns=['node1', 'node2'])
-		assert_frame_equal(self.msData4.artifactualLinkageMatrix, sampleMaskRes_artifactualLinkageMatrix)
-		assert_frame_equal(self.msData4._artifactualLinkageMatrix, sampleMaskRes_artifactualLinkageMatrix)
+		assert_frame_equal(self.msData4.artifactualLinkageMatrix[['node1', 'node2']], sampleMaskRes_artifactualLinkageMatrix)
+		assert_frame_equal(self.msData4._artifactualLinkageMatrix[['node1', 'node2']], sampleMaskRes_artifactualLinkageMatrix)
 
 		# _tempArtifactualLinkageMatrix (not filtered by correlation) is not changed
 		sampleMaskRes_tempArtifactualLinkageMatrix = pandas.DataFrame(
 			[[3, 4], [5, 6], [7, 8], [9, 10], [11, 12], [13, 14], [13, 15], [13, 16], [14, 15], [14, 16], [15, 16]],
 			index=[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10], columns=['node1', 'node2'])
-		assert_frame_equal(self.msData4._tempArtifactualLinkageMatrix, sampleMaskRes_tempArtifactualLinkageMatrix)
+		assert_frame_equal(self.msData4._tempArtifactualLinkageMatrix[['node1', 'node2']], sampleMaskRes_tempArtifactualLinkageMatrix)
 
 		##
 		# featureMask, remove sample 12 15 16
@@ -2498,13 +2663,196 @@ class test_msdataset_artifactual_filtering(unittest.TestCase):
 		# _artifactualLinkageMatrix, artifactualLinkageMatrix are modified
 		featMaskRes_artifactualLinkageMatrix = pandas.DataFrame([[5, 6], [7, 8], [9, 10], [12, 13]], index=[1, 2, 3, 4],
 																columns=['node1', 'node2'])
-		assert_frame_equal(self.msData5.artifactualLinkageMatrix, featMaskRes_artifactualLinkageMatrix)
-		assert_frame_equal(self.msData5._artifactualLinkageMatrix, featMaskRes_artifactualLinkageMatrix)
+		assert_frame_equal(self.msData5.artifactualLinkageMatrix[['node1', 'node2']], featMaskRes_artifactualLinkageMatrix)
+		assert_frame_equal(self.msData5._artifactualLinkageMatrix[['node1', 'node2']], featMaskRes_artifactualLinkageMatrix)
 
 		# _tempArtifactualLinkageMatrix (not filtered by correlation) is changed
 		featMaskRes_tempArtifactualLinkageMatrix = pandas.DataFrame([[3, 4], [5, 6], [7, 8], [9, 10], [12, 13]],
 																	index=[0, 1, 2, 3, 4], columns=['node1', 'node2'])
-		assert_frame_equal(self.msData5._tempArtifactualLinkageMatrix, featMaskRes_tempArtifactualLinkageMatrix)
+		assert_frame_equal(self.msData5._tempArtifactualLinkageMatrix[['node1', 'node2']], featMaskRes_tempArtifactualLinkageMatrix)
+
+
+class test_msdataset_artifactual_synthetic(unittest.TestCase):
+	"""
+	Compare feature matching for artifactual filtering to an exhaustive comparison of all features.
+	"""
+
+	def setUp(self):
+		noFeat = numpy.random.randint(100, high=300, size=None)
+
+		self.msData = generateTestDataset(10, noFeat, dtype='MSDataset')
+		self.msData.featureMetadata = pandas.DataFrame({'Feature Name': ['Feature %i' % i for i in range(noFeat)],
+														'Retention Time': numpy.round(numpy.random.uniform(0, 1, noFeat), 2),
+														'm/z': numpy.round(numpy.random.uniform(100, 100 + noFeat * 0.001, noFeat), 3),
+														'Peak Width': numpy.round(numpy.random.uniform(0.01, 0.2, noFeat), 3)})
+		# Missing values, zero width, duplicated features, and a pair exactly deltaMZ apart
+		self.msData.featureMetadata.loc[0, 'm/z'] = numpy.nan
+		self.msData.featureMetadata.loc[1, 'Peak Width'] = numpy.nan
+		self.msData.featureMetadata.loc[2, 'Peak Width'] = 0
+		self.msData.featureMetadata.loc[3, ['Retention Time', 'm/z', 'Peak Width']] = self.msData.featureMetadata.loc[2, ['Retention Time', 'm/z', 'Peak Width']].values
+		self.msData.featureMetadata.loc[5, ['Retention Time', 'm/z', 'Peak Width']] = self.msData.featureMetadata.loc[4, ['Retention Time', 'm/z', 'Peak Width']].values
+		self.msData.featureMetadata.loc[5, 'm/z'] = self.msData.featureMetadata.loc[4, 'm/z'] + 0.005
+
+		self.msData.Attributes['featureFilters']['artifactualFilter'] = True
+		self.msData.Attributes['filterParameters']['deltaMzArtifactual'] = 0.005
+		self.msData.Attributes['filterParameters']['overlapThresholdArtifactual'] = 50
+		self.msData.Attributes['filterParameters']['corrThresholdArtifactual'] = 0.9
+
+	def test_artifactualLinkageMatrix_matching(self):
+
+		featureMetadata = self.msData.featureMetadata
+		deltaMZ = self.msData.Attributes['filterParameters']['deltaMzArtifactual']
+		deltaOverlap = self.msData.Attributes['filterParameters']['overlapThresholdArtifactual']
+
+		expected = list()
+		for i in range(featureMetadata.shape[0]):
+			for j in range(i + 1, featureMetadata.shape[0]):
+				halfWidth = (featureMetadata.loc[i, 'Peak Width'] + featureMetadata.loc[j, 'Peak Width']) / 2
+				distance = abs(featureMetadata.loc[i, 'Retention Time'] - featureMetadata.loc[j, 'Retention Time'])
+				if (abs(featureMetadata.loc[i, 'm/z'] - featureMetadata.loc[j, 'm/z']) <= deltaMZ) and (distance <= halfWidth) and (halfWidth > 0) and ((halfWidth - distance) / halfWidth * 100 >= deltaOverlap):
+					expected.append([i, j])
+		expected = pandas.DataFrame(expected, columns=['node1', 'node2'], dtype='int64')
+
+		self.msData.artifactualLinkageMatrix
+
+		assert_frame_equal(self.msData._tempArtifactualLinkageMatrix[['node1', 'node2']], expected)
+
+	def test_artifactualLinkageMatrix_correlation(self):
+
+		self.msData._intensityData[:, 6] = 1
+
+		linkage = self.msData.artifactualLinkageMatrix
+		candidates = self.msData._tempArtifactualLinkageMatrix
+
+		expected = numpy.array([numpy.corrcoef(self.msData.intensityData[:, node1], self.msData.intensityData[:, node2])[0, 1] for (node1, node2) in zip(candidates['node1'], candidates['node2'])])
+		numpy.testing.assert_allclose(candidates['Correlation'].values, expected, rtol=1e-10, atol=1e-12)
+
+		assert_frame_equal(linkage, candidates.loc[candidates['Correlation'] >= self.msData.Attributes['filterParameters']['corrThresholdArtifactual'], ])
+
+	def test_artifactualLinkageMatrix_thresholds(self):
+
+		self.msData.artifactualLinkageMatrix
+		candidates = self.msData._artifactualCandidateEdges
+
+		parameters = [(0.002, 50, 0.9), (0.005, 80, 0.9), (0.005, 50, 0.5), (0.001, 90, 0.95)]
+		for (deltaMZ, deltaOverlap, corrThreshold) in parameters:
+			with self.subTest(deltaMZ=deltaMZ, deltaOverlap=deltaOverlap, corrThreshold=corrThreshold):
+				self.msData.Attributes['filterParameters']['deltaMzArtifactual'] = deltaMZ
+				self.msData.Attributes['filterParameters']['overlapThresholdArtifactual'] = deltaOverlap
+				self.msData.Attributes['filterParameters']['corrThresholdArtifactual'] = corrThreshold
+				self.msData.updateArtifactualLinkageMatrix()
+
+				# Tighter thresholds filter the stored candidates, and match pairs found from scratch
+				self.assertIs(self.msData._artifactualCandidateEdges, candidates)
+
+				expectedData = copy.deepcopy(self.msData)
+				expected = expectedData.artifactualLinkageMatrix
+
+				assert_frame_equal(self.msData._tempArtifactualLinkageMatrix, expectedData._tempArtifactualLinkageMatrix)
+				assert_frame_equal(self.msData.artifactualLinkageMatrix[['node1', 'node2']], expected[['node1', 'node2']])
+
+		with self.subTest(msg='Wider deltaMZ'):
+			self.msData.Attributes['filterParameters']['deltaMzArtifactual'] = 0.01
+			self.msData.updateArtifactualLinkageMatrix()
+
+			self.assertIsNot(self.msData._artifactualCandidateEdges, candidates)
+			self.assertGreaterEqual(self.msData._artifactualCandidateEdges.shape[0], candidates.shape[0])
+
+	def test_artifactualLinkageMatrix_applyMasks(self):
+
+		self.msData.initialiseMasks()
+		self.msData.Attributes['filterParameters']['corrThresholdArtifactual'] = 0
+		noFeat = self.msData.noFeatures
+
+		masks = [('Features', numpy.random.rand(noFeat) > 0.3, numpy.ones(10, dtype=bool)),
+				 ('Samples', numpy.ones(noFeat, dtype=bool), numpy.array([True, False] * 5)),
+				 ('Both', numpy.random.rand(noFeat) > 0.3, numpy.array([False, True] * 5))]
+		for (name, featureMask, sampleMask) in masks:
+			with self.subTest(msg=name):
+				msData = copy.deepcopy(self.msData)
+				msData.artifactualLinkageMatrix
+
+				# Searching again would only look for pairs within the tighter deltaMZ
+				msData.Attributes['filterParameters']['deltaMzArtifactual'] = 0.004
+				msData.featureMask = featureMask
+				msData.sampleMask = sampleMask
+				msData.applyMasks()
+
+				linkage = msData.artifactualLinkageMatrix
+				self.assertEqual(msData._artifactualCandidateKey[1], 0.005)
+
+				expectedData = copy.deepcopy(msData)
+				expected = expectedData.artifactualLinkageMatrix
+
+				assert_frame_equal(msData._tempArtifactualLinkageMatrix, expectedData._tempArtifactualLinkageMatrix)
+				assert_frame_equal(linkage, expected)
+
+		with self.subTest(msg='Features edited before masking'):
+			msData = copy.deepcopy(self.msData)
+			msData.artifactualLinkageMatrix
+
+			# Pairs found for the old m/z must not be carried over
+			msData.featureMetadata['m/z'] = msData.featureMetadata['m/z'].values[::-1]
+			msData.featureMask = masks[0][1]
+			msData.applyMasks()
+
+			linkage = msData.artifactualLinkageMatrix
+
+			expectedData = copy.deepcopy(msData)
+			del expectedData.artifactualLinkageMatrix
+			expected = expectedData.artifactualLinkageMatrix
+
+			assert_frame_equal(linkage, expected)
+
+	def test_artifactualFilter(self):
+
+		noFeat = self.msData.noFeatures
+		self.msData.Attributes['filterParameters']['corrThresholdArtifactual'] = 0
+		# Ties in intensity keep the first feature
+		self.msData._intensityData[:, 5] = self.msData._intensityData[:, 4]
+
+		featureMask = numpy.random.rand(noFeat) > 0.2
+		featureMask[[4, 5]] = True
+		linkage = self.msData.artifactualLinkageMatrix
+		linkage = linkage[featureMask[linkage['node1'].values] & featureMask[linkage['node2'].values]]
+		meanIntensity = self.msData.intensityData.mean(axis=0)
+
+		# Group linked features by following their links
+		neighbours = dict()
+		for (node1, node2) in zip(linkage['node1'], linkage['node2']):
+			neighbours.setdefault(node1, set()).add(node2)
+			neighbours.setdefault(node2, set()).add(node1)
+
+		expected = copy.deepcopy(featureMask)
+		seen = set()
+		for node in sorted(neighbours):
+			if node in seen:
+				continue
+			cluster = {node}
+			toVisit = [node]
+			while toVisit:
+				for neighbour in neighbours[toVisit.pop()] - cluster:
+					cluster.add(neighbour)
+					toVisit.append(neighbour)
+			seen |= cluster
+
+			cluster = sorted(cluster)
+			expected[cluster] = False
+			expected[cluster[numpy.argmax(meanIntensity[cluster])]] = True
+
+		numpy.testing.assert_array_equal(self.msData.artifactualFilter(featMask=featureMask), expected)
+
+		with self.subTest(msg='Feature mask'):
+			self.msData.featureMask = featureMask
+			numpy.testing.assert_array_equal(self.msData.artifactualFilter(), expected)
+
+	def test_artifactualLinkageMatrix_nomatches(self):
+
+		self.msData.Attributes['filterParameters']['deltaMzArtifactual'] = -1
+
+		self.msData.artifactualLinkageMatrix
+
+		assert_frame_equal(self.msData._tempArtifactualLinkageMatrix[['node1', 'node2']], pandas.DataFrame({'node1': numpy.array([], dtype='int64'), 'node2': numpy.array([], dtype='int64')}))
 
 
 class test_msdataset_initialiseFromCSV(unittest.TestCase):
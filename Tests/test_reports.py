@@ -758,6 +758,50 @@ class test_reports_modules(unittest.TestCase):
 					self.assertTrue(os.path.exists(report[groupName][plotName]))
 
 
+	def test_reports_featureSelectionCounts(self):
+
+		from nPYc.reports._generateReportMS import _featureSelectionCounts
+
+		noFeat = numpy.random.randint(200, high=400, size=None)
+
+		dataset = generateTestDataset(20, noFeat, dtype='MSDataset')
+		dataset.featureMetadata = pandas.DataFrame({'Feature Name': ['Feature %i' % i for i in range(noFeat)],
+													'Retention Time': numpy.round(numpy.random.uniform(0, 1, noFeat), 2),
+													'm/z': numpy.round(numpy.random.uniform(100, 100 + noFeat * 0.001, noFeat), 3),
+													'Peak Width': numpy.round(numpy.random.uniform(0.01, 0.2, noFeat), 3)})
+		dataset.Attributes['featureFilters']['artifactualFilter'] = True
+		dataset.Attributes['filterParameters']['deltaMzArtifactual'] = 0.005
+		dataset.Attributes['filterParameters']['overlapThresholdArtifactual'] = 20
+		dataset.Attributes['filterParameters']['corrThresholdArtifactual'] = 0
+
+		correlation = numpy.random.uniform(0.4, 1, noFeat)
+		correlation[0] = numpy.nan
+		rsdSP = numpy.random.uniform(0, 60, noFeat)
+		rsdSP[[1, 2]] = [numpy.nan, 5]
+		featureMask = numpy.random.rand(noFeat) > 0.1
+
+		rsdVals = numpy.array([5, 10, 15, 20, 25, 30, 35, 40, 45, 50])
+		rVals = numpy.array([0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1])
+
+		linkage = dataset.artifactualLinkageMatrix
+		node1 = linkage['node1'].values
+		node2 = linkage['node2'].values
+
+		expected = numpy.zeros((len(rVals), len(rsdVals)), dtype=int)
+		expectedArtifactual = numpy.zeros((len(rVals), len(rsdVals)), dtype=int)
+		for (i, rVal) in enumerate(rVals):
+			for (j, rsdVal) in enumerate(rsdVals):
+				passMask = (correlation >= rVal) & (rsdSP <= rsdVal) & featureMask
+				expected[i, j] = sum(passMask)
+				expectedArtifactual[i, j] = sum(dataset.artifactualFilter(featMask=passMask))
+
+		with self.subTest(msg='Without artifactual filtering'):
+			numpy.testing.assert_array_equal(_featureSelectionCounts(correlation, rsdSP, featureMask, rVals, rsdVals), expected)
+
+		with self.subTest(msg='With artifactual filtering'):
+			self.assertGreater(len(node1), 0)
+			numpy.testing.assert_array_equal(_featureSelectionCounts(correlation, rsdSP, featureMask, rVals, rsdVals, node1=node1, node2=node2), expectedArtifactual)
+
 	def test_reports_generatefeaturereport_filterUnits(self):
 
 		from nPYc.reports._generateFeatureDistributionReport import generateFeatureDistributionReport
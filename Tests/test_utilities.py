@@ -84,6 +84,111 @@ class test_utilities_internal(unittest.TestCase):
 		with self.subTest(msg='Testing Pearson Correlation'):
 			numpy.testing.assert_allclose(pearson, pearson_scipy, err_msg='Pearson Correlation output does not equal scipy.')
 
+	def test_correlation_subsets(self):
+		"""
+		Check _vcorrcoefSubsets matches _vcorrcoef for each subset of samples, and _rankColumns matches scipy's rankdata.
+		"""
+
+		xdim = numpy.random.randint(20,50)
+		ydim = numpy.random.randint(70,300)
+
+		X = numpy.random.normal(size=(xdim, ydim))
+		X[:, 1] = numpy.round(X[:, 1])
+		y = numpy.random.randint(1, 6, size=xdim)
+
+		sampleMasks = list()
+		for i in range(3):
+			sampleMask = numpy.ones(xdim, dtype=bool)
+			sampleMask[numpy.random.randint(0, xdim, size=numpy.random.randint(2, int(xdim / 2)))] = False
+			sampleMasks.append(sampleMask)
+		featureMask = numpy.ones(ydim, dtype=bool)
+		featureMask[numpy.random.randint(1, ydim, size=numpy.random.randint(2, int(ydim / 2)))] = False
+
+		for method in ['pearson', 'spearman']:
+			correlations = nPYc.utilities._internal._vcorrcoefSubsets(X, y, sampleMasks, method=method, featureMask=featureMask, blockSize=17)
+
+			with self.subTest(msg='Testing %s Correlation' % method):
+				self.assertEqual(correlations.shape, (len(sampleMasks), sum(featureMask)))
+				for (i, sampleMask) in enumerate(sampleMasks):
+					numpy.testing.assert_allclose(correlations[i, :], nPYc.utilities._internal._vcorrcoef(X, y, method=method, sampleMask=sampleMask, featureMask=featureMask))
+
+		ranks = numpy.zeros_like(X)
+		for i in range(ydim):
+			ranks[:, i] = scipy.stats.rankdata(X[:, i])
+
+		with self.subTest(msg='Testing ranks'):
+			numpy.testing.assert_array_equal(nPYc.utilities._internal._rankColumns(X), ranks)
+
+	def test_correlation_resampled(self):
+		"""
+		Check bootstrap and permutation correlations match _vcorrcoef on each resample, and their averages over subsets.
+		"""
+
+		xdim = numpy.random.randint(10,30)
+		ydim = numpy.random.randint(20,50)
+		noResamples = 20
+
+		X = numpy.random.normal(size=(xdim, ydim))
+		X[:, 1] = numpy.round(X[:, 1])
+		y = numpy.random.randint(1, 6, size=xdim)
+
+		indices = numpy.random.randint(0, xdim, size=(noResamples, xdim))
+		counts = numpy.zeros((noResamples, xdim))
+		numpy.add.at(counts, (numpy.arange(noResamples)[:, numpy.newaxis], indices), 1)
+		permutations = numpy.array([numpy.random.permutation(xdim) for i in range(noResamples)])
+
+		for method in ['pearson', 'spearman']:
+			with self.subTest(msg='Testing %s bootstrap' % method):
+				expected = numpy.array([nPYc.utilities._internal._vcorrcoef(X[index, :], y[index], method=method) for index in indices])
+				numpy.testing.assert_allclose(nPYc.utilities._internal._bootstrapCorrelations(X, y, counts, method=method), expected, atol=1e-12)
+
+			with self.subTest(msg='Testing %s constant in a resample' % method):
+				# Drawing only the samples at 0.1 leaves a rounding residue in the covariance
+				correlations = nPYc.utilities._internal._bootstrapCorrelations(numpy.array([[0.1], [0.1], [0.1], [0.7], [0.3]]), numpy.arange(1., 6.), numpy.array([[0, 3, 2, 0, 0]]), method=method)
+				numpy.testing.assert_array_equal(correlations, [[0]])
+
+			with self.subTest(msg='Testing %s permutations' % method):
+				expected = numpy.array([nPYc.utilities._internal._vcorrcoef(X, y[permutation], method=method) for permutation in permutations])
+				numpy.testing.assert_allclose(nPYc.utilities._internal._permutationCorrelations(X, y, permutations, method=method), expected, atol=1e-12)
+
+		sampleMasks = [numpy.arange(xdim) % 2 == 0, numpy.arange(xdim) % 2 == 1]
+		resampled = nPYc.utilities._internal._vcorrcoefResampled(X, y, sampleMasks, bootstrap=50, permutations=50, randomSeed=1, parallelise=True, nJobs=2, blockSize=7)
+
+		with self.subTest(msg='Testing averages over subsets'):
+			numpy.testing.assert_allclose(resampled['correlation'], numpy.mean(nPYc.utilities._internal._vcorrcoefSubsets(X, y, sampleMasks), axis=0), atol=1e-12)
+			self.assertTrue(all(resampled['lower'] <= resampled['upper']))
+			self.assertTrue(all((resampled['pValue'] > 0) & (resampled['pValue'] <= 1)))
+
+		with self.subTest(msg='Testing blocks'):
+			single = nPYc.utilities._internal._vcorrcoefResampled(X, y, sampleMasks, bootstrap=50, permutations=50, randomSeed=1)
+			for key in single.keys():
+				numpy.testing.assert_allclose(resampled[key], single[key], atol=1e-12)
+
+	def test_blocks(self):
+		"""
+		Check the shared block size and worker count helpers.
+		"""
+		import os
+
+		with self.subTest(msg='Block size'):
+			self.assertEqual(nPYc.utilities._internal._blockSize(100), nPYc.utilities._internal._BLOCKVALUES // 100)
+			self.assertEqual(nPYc.utilities._internal._blockSize(100, 7), 7)
+			self.assertEqual(nPYc.utilities._internal._blockSize(nPYc.utilities._internal._BLOCKVALUES * 2), 1)
+
+		with self.subTest(msg='Workers'):
+			cores = os.cpu_count()
+			self.assertEqual(nPYc.utilities._internal._noWorkers(), max(cores - 1, 1))
+			self.assertEqual(nPYc.utilities._internal._noWorkers(-1), cores)
+			self.assertEqual(nPYc.utilities._internal._noWorkers(2), 2)
+			self.assertRaises(TypeError, nPYc.utilities._internal._noWorkers, 0)
+			self.assertRaises(TypeError, nPYc.utilities._internal._noWorkers, True)
+
+		with self.subTest(msg='Map blocks'):
+			blocks = [slice(start, start + 3) for start in range(0, 10, 3)]
+			expected = [block.start for block in blocks]
+			self.assertEqual(nPYc.utilities._internal._mapBlocks(lambda block: block.start, blocks), expected)
+			self.assertEqual(nPYc.utilities._internal._mapBlocks(lambda block: block.start, blocks, parallelise=True, nJobs=2), expected)
+
 	def test_copybackingfiles(self):
 		"""
 		Check files are copied to the location specified (we trust the shutil.copy call to preserve contents).
@@ -241,6 +346,77 @@ class test_utilities_ms(unittest.TestCase):
 		self.assertRaises(TypeError, nPYc.utilities.rsdsBySampleType, 'Not a Dataset')
 		self.assertRaises(KeyError, nPYc.utilities.rsdsBySampleType, nPYc.Dataset(), useColumn='Not There')
 
+	def test_groupedStatistics(self):
+
+		from generateTestDataset import generateTestDataset
+
+		noSamp = numpy.random.randint(100, high=500, size=None)
+		noFeat = numpy.random.randint(200, high=400, size=None)
+
+		data = generateTestDataset(noSamp, noFeat)
+		data.sampleMetadata.loc[0, 'SampleType'] = numpy.nan
+		data.sampleMask[1] = False
+
+		statistics = nPYc.utilities.groupedStatistics(data, ['SampleType', 'AssayRole'], statistics=['count', 'mean', 'std', 'rsd', 'median', 'sequentialPrecision'], percentiles=[5, 95])
+
+		with self.subTest(msg='Groups'):
+			groups = data.sampleMetadata.loc[data.sampleMask & data.sampleMetadata['SampleType'].notnull().values, ['SampleType', 'AssayRole']].drop_duplicates()
+			self.assertEqual(statistics.shape[0], groups.shape[0] * noFeat)
+			numpy.testing.assert_array_equal(statistics['Feature Name'].values[:noFeat], data.featureMetadata['Feature Name'].values)
+
+		for ((sampleType, assayRole), group) in statistics.groupby(['SampleType', 'AssayRole'], sort=False):
+			with self.subTest(sampleType=sampleType, assayRole=assayRole):
+				mask = (data.sampleMetadata['SampleType'].values == sampleType) & (data.sampleMetadata['AssayRole'].values == assayRole) & data.sampleMask
+				intensityData = data.intensityData[mask, :]
+
+				self.assertTrue(all(group['Samples'] == sum(mask)))
+				numpy.testing.assert_array_equal(group['count'].values, numpy.full(noFeat, sum(mask)))
+				numpy.testing.assert_allclose(group['mean'].values, numpy.mean(intensityData, axis=0))
+				numpy.testing.assert_allclose(group['std'].values, numpy.std(intensityData, axis=0))
+				numpy.testing.assert_array_equal(group['rsd'].values, nPYc.utilities.rsd(intensityData))
+				numpy.testing.assert_allclose(group['median'].values, numpy.median(intensityData, axis=0))
+				numpy.testing.assert_array_equal(group['sequentialPrecision'].values, nPYc.utilities.sequentialPrecision(intensityData))
+				numpy.testing.assert_allclose(group['percentile 95'].values, numpy.percentile(intensityData, 95, axis=0))
+
+		with self.subTest(msg='Parallel'):
+			parallelStatistics = nPYc.utilities.groupedStatistics(data, ['SampleType', 'AssayRole'], statistics=['count', 'mean', 'std', 'rsd', 'median', 'sequentialPrecision'], percentiles=[5, 95], parallelise=True, nJobs=2, blockSize=50)
+			pandas.testing.assert_frame_equal(parallelStatistics, statistics)
+
+		with self.subTest(msg='By group'):
+			groupStatistics = nPYc.utilities.groupedStatistics(data, ['SampleType', 'AssayRole'], statistics=['count', 'rsd'], percentiles=[95], byGroup=True)
+			self.assertEqual(len(groupStatistics), statistics.shape[0] // noFeat)
+			for ((sampleType, assayRole), values) in groupStatistics.items():
+				mask = (data.sampleMetadata['SampleType'].values == sampleType) & (data.sampleMetadata['AssayRole'].values == assayRole) & data.sampleMask
+				numpy.testing.assert_array_equal(values['count'], numpy.full(noFeat, sum(mask)))
+				numpy.testing.assert_array_equal(values['rsd'], nPYc.utilities.rsd(data.intensityData[mask, :]))
+				numpy.testing.assert_allclose(values['percentile 95'], numpy.percentile(data.intensityData[mask, :], 95, axis=0))
+
+			groupStatistics = nPYc.utilities.groupedStatistics(data, 'SampleType', statistics=['rsd'], byGroup=True)
+			for (sampleType, values) in groupStatistics.items():
+				mask = (data.sampleMetadata['SampleType'].values == sampleType) & data.sampleMask
+				numpy.testing.assert_array_equal(values['rsd'], nPYc.utilities.rsd(data.intensityData[mask, :]))
+
+		with self.subTest(msg='Minimum samples'):
+			statistics = nPYc.utilities.groupedStatistics(data, 'SampleType', statistics=['rsd'], minSamples=noSamp)
+			self.assertEqual(statistics.shape[0], 0)
+
+	def test_groupedStatistics_raises(self):
+
+		from generateTestDataset import generateTestDataset
+
+		data = generateTestDataset(10, 10)
+
+		self.assertRaises(TypeError, nPYc.utilities.groupedStatistics, 'Not a Dataset', 'SampleType')
+		self.assertRaises(KeyError, nPYc.utilities.groupedStatistics, data, 'Not There')
+		self.assertRaises(ValueError, nPYc.utilities.groupedStatistics, data, 'SampleType', statistics=['Not a statistic'])
+		self.assertRaises(ValueError, nPYc.utilities.groupedStatistics, data, 'SampleType', percentiles=[101])
+		self.assertRaises(ValueError, nPYc.utilities.groupedStatistics, data, 'SampleType', minSamples=0)
+		self.assertRaises(TypeError, nPYc.utilities.groupedStatistics, data, 'SampleType', parallelise=True, nJobs=0)
+		self.assertRaises(TypeError, nPYc.utilities.groupedStatistics, data, 'SampleType', parallelise=True, nJobs=1.5)
+
+		# Negative numbers of threads count back from the number of cores, as in correction
+		pandas.testing.assert_frame_equal(nPYc.utilities.groupedStatistics(data, 'SampleType', parallelise=True, nJobs=-1, blockSize=2), nPYc.utilities.groupedStatistics(data, 'SampleType'))
+
 	def test_inferBatches(self):
 
 		from generateTestDataset import generateTestDataset
@@ -495,6 +671,50 @@ class test_utilities_filters(unittest.TestCase):
 			numpy.testing.assert_array_equal(blankMaskObtained, expected)
 
 
+	def test_blank_filter_blocks(self):
+
+		(expectedMask, expectedP95) = nPYc.utilities._filters.blankFilter(self.msData, threshold=2.)
+
+		with self.subTest(msg='Blank levels'):
+			numpy.testing.assert_array_equal(expectedP95, numpy.percentile(self.msData.intensityData[5:, :], 95, axis=0))
+
+		with self.subTest(msg='Ratios'):
+			(mask, p95, ratio) = nPYc.utilities._filters.blankFilter(self.msData, threshold=2., withRatio=True)
+			numpy.testing.assert_array_equal(mask, expectedMask)
+			numpy.testing.assert_allclose(ratio, expectedP95 / numpy.mean(self.msData.intensityData[:5, :], axis=0))
+
+		with self.subTest(msg='Approximate'):
+			(mask, p95) = nPYc.utilities._filters.blankFilter(self.msData, threshold=2., approximate=True)
+			numpy.testing.assert_array_equal(p95, numpy.max(self.msData.intensityData[5:, :], axis=0))
+
+		with tempfile.TemporaryDirectory() as tmpdirname:
+			path = os.path.join(tmpdirname, 'intensityData.npy')
+			numpy.save(path, self.msData.intensityData)
+
+			msData = copy.deepcopy(self.msData)
+			msData.intensityData = numpy.load(path, mmap_mode='r')
+
+			with self.subTest(msg='Memory-mapped intensities'):
+				(mask, p95) = nPYc.utilities._filters.blankFilter(msData, threshold=2., blockSize=2)
+				numpy.testing.assert_array_equal(mask, expectedMask)
+				numpy.testing.assert_array_equal(p95, expectedP95)
+
+			del msData
+
+		with self.subTest(msg='Missing values in many blanks'):
+			noBlanks = 100
+			msData = copy.deepcopy(self.msData)
+			msData.sampleMetadata = pandas.concat([self.msData.sampleMetadata.iloc[:5], self.msData.sampleMetadata.iloc[[5] * noBlanks]], ignore_index=True)
+			blanks = numpy.random.RandomState(42).uniform(0, 10, (noBlanks, 3))
+			blanks[10, 0] = numpy.nan
+			msData.intensityData = numpy.vstack([self.msData.intensityData[:5, :], blanks])
+			msData.initialiseMasks()
+
+			(mask, p95) = nPYc.utilities._filters.blankFilter(msData, threshold=2.)
+
+			numpy.testing.assert_array_equal(p95, numpy.percentile(blanks, 95, axis=0))
+			numpy.testing.assert_array_equal(mask, [False, True, True])
+
 	def test_blank_filter_raises(self):
 		msData = nPYc.MSDataset('', fileType='empty')
 
@@ -1,5 +1,7 @@
 """
 """
-from ._batchAndROCorrection import correctMSdataset
+from ._batchAndROCorrection import correctMSdataset, correctMSdatasets, correctNewBatches, optimiseCorrection
+from ._correctionFit import CorrectionFit
+from ._fitCache import FitCache, fitCache
 
-__all__ = ['correctMSdataset']
+__all__ = ['correctMSdataset', 'correctMSdatasets', 'correctNewBatches', 'optimiseCorrection', 'CorrectionFit', 'FitCache', 'fitCache']
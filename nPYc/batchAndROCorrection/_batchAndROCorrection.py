@@ -3,6 +3,7 @@
 
 import types
 import numpy
+import pandas
 import scipy
 import warnings
 from scipy.signal import savgol_filter
@@ -12,34 +13,235 @@ import logging
 from scipy.signal import savgol_filter
 import time
 import sys
+import os
 import copy
+import contextlib
+import json
 from datetime import datetime, timedelta
 from ..objects._msDataset import MSDataset
 from ..enumerations import AssayRole, SampleType
+from ._sharedArray import _SharedArray, _attachSharedArray, _noWorkers, _workerPool
+from ._lowess import _lowessOperator, _interpolationWeights, _interpolate
+from ._correctionFit import CorrectionFit
+from ._fitCache import fitCache
+from ._stageTimer import stageTimer
 
 
-def correctMSdataset(data, window=11, method='LOWESS', align='median', parallelise=True, excludeFailures=True, correctionSampleType=SampleType.StudyPool):
+def correctMSdataset(data, window=11, method='LOWESS', align='median', parallelise=True, excludeFailures=True, correctionSampleType=SampleType.StudyPool, engine='statsmodels', nJobs=None, chunkSize=None, memmapPath=None, blockSize=1000, dtype=float, robustIterations=3, returnTimings=False):
 	"""
 	Conduct run-order correction and batch alignment on the :py:class:`~nPYc.objects.MSDataset` instance *data*, returning a new instance with corrected intensity values.
 
 	Sample are seperated into batches acording to the *'Correction Batch'* column in *data.sampleMetadata*.
 
+	The trend lines fitted are attached to the output as *fit*, a :py:class:`~nPYc.batchAndROCorrection.CorrectionFit` storing them at the reference samples of each batch only.
+
+	Setting *dtype* to :py:class:`numpy.float32` corrects in single precision, halving the memory needed for the corrected intensities and fits. Trends are still fitted through the reference samples in double precision, and only interpolated and divided out in single precision, so with LOWESS corrected intensities and fits differ from those in double precision by less than 1e-5 (relative, typically around 5e-7). Savitzky-Golay trends are not clipped at zero, for them the same bound holds for the fits relative to the largest fitted value of each feature, but corrected intensities lose precision where the trend approaches zero.
+
+	LOWESS trends are made resistant to outlying reference samples, such as bad injections, by *robustIterations* rounds of bisquare reweighting: after each fit every reference sample is weighted down by the size of its residual for that feature, and the trend refitted. With the vectorised engine, all features in a batch are reweighted and refitted together, so each round costs a few passes over the neighbourhood of each reference sample whatever the number of features. Setting *robustIterations* to 0 fits plain LOWESS.
+
+	The time spent in each stage of the correction (smoothing the reference samples, interpolating and dividing out the fits, alignment, moving data to and from the worker processes, compressing fits, and copying *data*), the features corrected per second by each worker, and peak memory use are recorded in *Attributes['Log']* of the output as JSON, and returned as a dictionary if *returnTimings* is ``True``. Worker stage times are summed over workers.
+
+	If *memmapPath* is given, correction runs out of core: features are read from *data* and corrected *blockSize* at a time, and the corrected intensities written to a ``.npy`` file at *memmapPath*, which backs the *intensityData* of the output. Memory used is then bounded by the block size rather than the size of the dataset. To also avoid loading the input, *data.intensityData* may itself be a memory-mapped array (see :py:func:`numpy.load`), out of core correction is not supported for datasets with a normalisation applied.
+
 	:param data: MSDataset object with measurements to be corrected
 	:type data: MSDataset
 	:param int window: When calculating trends, consider this many reference samples, centred on the current position
 	:param str method: Correction method, one of 'LOWESS' (default), 'SavitzkyGolay' or None for no correction
 	:param str align: Average calculation of batch and feature intensity for correction, one of 'median' (default) or 'mean'
 	:param bool parallelise: If ``True``, use multiple cores
-	:param bool excludeFailures: If ``True``, remove features where a correct fit could not be calculated from the dataset
+	:param bool excludeFailures: If ``True``, mask features where a correct fit could not be calculated in any batch (non-finite or non-positive fits, or non-finite or negative corrected intensities), recording the reason in *featureMetadata['Exclusion Details']*
 	:param enum correctionSampleType: Which SampleType to use for the correction, default SampleType.StudyPool
-	:return: Duplicate of *data*, with run-order correction applied
-	:rtype: MSDataset
+	:param str engine: LOWESS implementation, one of 'statsmodels' (default) to fit each feature separately, or 'vectorised' to fit all features in a batch together
+	:param nJobs: Number of worker processes when *parallelise* is ``True``, by default one less than the number of CPU cores, negative values count back from the number of cores
+	:type nJobs: None or int
+	:param chunkSize: Number of features corrected in each task queued to the workers, by default enough to give each worker around four tasks per batch
+	:type chunkSize: None or int
+	:param memmapPath: If ``None`` correct in memory, otherwise the path of a ``.npy`` file to write corrected intensities to
+	:type memmapPath: None or str
+	:param int blockSize: Number of features corrected at a time when correcting out of core
+	:param dtype: Precision to correct in, :py:class:`numpy.float64` (default) or :py:class:`numpy.float32`
+	:param int robustIterations: Number of bisquare robustifying iterations when fitting LOWESS trends, default 3
+	:param bool returnTimings: If ``True`` also return the timings of the correction
+	:return: Duplicate of *data*, with run-order correction applied, and if *returnTimings* is ``True`` a dictionary of timings
+	:rtype: MSDataset or tuple(MSDataset, dict)
 	"""
-	import copy
+	from ..utilities.normalisation import NullNormaliser
+
+	startTime = time.perf_counter()
+	stageTimer.reset()
 
 	# Check inputs
 	if not isinstance(data, MSDataset):
 		raise TypeError("data must be a MSDataset instance")
+	_checkCorrectionArguments(window, method, align, parallelise, excludeFailures, correctionSampleType, engine, nJobs, chunkSize, dtype, robustIterations)
+	if (memmapPath is not None) and not isinstance(memmapPath, str):
+		raise TypeError('memmapPath must be None or a str')
+	if not isinstance(blockSize, int) & (blockSize > 0):
+		raise TypeError('blockSize must be a positive integer')
+	if (memmapPath is not None) and not isinstance(data.Normalisation, NullNormaliser):
+		raise ValueError('Out of core correction is not supported for normalised datasets')
+	if not isinstance(returnTimings, bool):
+		raise TypeError('returnTimings must be a boolean')
+
+	runOrder = data.sampleMetadata['Run Order'].values
+	referenceSamples = (data.sampleMetadata['SampleType'].values == correctionSampleType) & (data.sampleMetadata['AssayRole'].values == AssayRole.PrecisionReference)
+	batchList = data.sampleMetadata['Correction Batch'].values
+
+	if memmapPath is None:
+		intensityData = data.intensityData
+		correctedIntensity = None
+		blockSize = max(intensityData.shape[1], 1)
+	else:
+		# Read blocks straight from the (possibly memory-mapped) intensities
+		intensityData = data._intensityData
+		correctedIntensity = numpy.lib.format.open_memmap(memmapPath, mode='w+', dtype=dtype, shape=intensityData.shape)
+
+	fits = list()
+	failures = list()
+	with warnings.catch_warnings(), contextlib.ExitStack() as stack:
+		warnings.simplefilter('ignore', category=RuntimeWarning)
+
+		corrector = None
+		if parallelise and (memmapPath is not None) and (intensityData.shape[1] > blockSize):
+			# Start the workers and shared blocks once, and pass every block of features through them
+			corrector = stack.enter_context(_ParallelCorrection((intensityData.shape[0], blockSize), numpy.dtype(dtype), runOrder, referenceSamples, batchList,
+																 {'window': window, 'method': method, 'align': align, 'engine': engine, 'featureAverage': None, 'dtype': numpy.dtype(dtype), 'robustIterations': robustIterations},
+																 nJobs))
+
+		for start in range(0, max(intensityData.shape[1], 1), blockSize):
+			block = slice(start, start + blockSize)
+
+			correctedP = _batchCorrectionHead(numpy.asarray(intensityData[:, block]),
+											  runOrder,
+											  referenceSamples,
+											  batchList,
+											  window=window,
+											  method=method,
+											  align=align,
+											  parallelise=parallelise,
+											  engine=engine,
+											  nJobs=nJobs,
+											  chunkSize=chunkSize,
+											  dtype=dtype,
+											  robustIterations=robustIterations,
+											  corrector=corrector)
+
+			if correctedIntensity is None:
+				correctedIntensity = correctedP[0]
+			else:
+				correctedIntensity[:, block] = correctedP[0]
+			with stageTimer.stage('compression'):
+				fits.append(CorrectionFit.fromDense(correctedP[1], runOrder, referenceSamples, batchList))
+			if excludeFailures:
+				with stageTimer.stage('failureChecks'):
+					failures.append(_correctionFailures(intensityData[:, block], correctedP[0], correctedP[1], batchList, method))
+
+			del correctedP
+
+	if memmapPath is not None:
+		correctedIntensity.flush()
+
+	if excludeFailures:
+		failures = numpy.concatenate(failures)
+	else:
+		failures = None
+
+	correctedData = _correctedDataset(data, correctedIntensity, CorrectionFit.concatenate(fits), failures, window, method, align, correctionSampleType, engine, dtype, robustIterations)
+
+	timings = stageTimer.summary(intensityData.shape[0], intensityData.shape[1], time.perf_counter() - startTime)
+	correctedData.Attributes['Log'].append([datetime.now(), 'Batch and run order correction timings: %s' % (json.dumps(timings))])
+
+	if returnTimings:
+		return correctedData, timings
+
+	return correctedData
+
+
+def correctMSdatasets(datasets, window=11, method='LOWESS', align='median', parallelise=True, excludeFailures=True, correctionSampleType=SampleType.StudyPool, engine='statsmodels', nJobs=None, chunkSize=None, dtype=float, robustIterations=3):
+	"""
+	Correct several :py:class:`~nPYc.objects.MSDataset` instances acquired in the same injection sequence, such as positive and negative ionisation modes, together.
+
+	The datasets must have identical *'Run Order'* and *'Correction Batch'* columns, and the same reference samples, so that trends are fitted through the same positions in every dataset. Features from all datasets are then corrected in a single run, sharing one pool of workers, with the LOWESS neighbourhoods of each batch built once. Each dataset is corrected exactly as by :py:func:`correctMSdataset`.
+
+	:param list datasets: MSDataset objects with measurements to be corrected
+	:param int window: When calculating trends, consider this many reference samples, centred on the current position
+	:param str method: Correction method, one of 'LOWESS' (default), 'SavitzkyGolay' or None for no correction
+	:param str align: Average calculation of batch and feature intensity for correction, one of 'median' (default) or 'mean'
+	:param bool parallelise: If ``True``, use multiple cores
+	:param bool excludeFailures: If ``True``, mask features where a correct fit could not be calculated in any batch, see :py:func:`correctMSdataset`
+	:param enum correctionSampleType: Which SampleType to use for the correction, default SampleType.StudyPool
+	:param str engine: LOWESS implementation, one of 'statsmodels' (default) or 'vectorised'
+	:param nJobs: Number of worker processes, see :py:func:`correctMSdataset`
+	:type nJobs: None or int
+	:param chunkSize: Number of features corrected in each task, see :py:func:`correctMSdataset`
+	:type chunkSize: None or int
+	:param dtype: Precision to correct in, see :py:func:`correctMSdataset`
+	:param int robustIterations: Number of bisquare robustifying iterations when fitting LOWESS trends, see :py:func:`correctMSdataset`
+	:return: Duplicates of each of *datasets*, with run-order correction applied
+	:rtype: list[MSDataset,]
+	:raises ValueError: If the datasets do not share the same run order, batches, and reference samples
+	"""
+	# Check inputs
+	if not isinstance(datasets, (list, tuple)) or (len(datasets) == 0) or not all(isinstance(data, MSDataset) for data in datasets):
+		raise TypeError("datasets must be a list of MSDataset instances")
+	_checkCorrectionArguments(window, method, align, parallelise, excludeFailures, correctionSampleType, engine, nJobs, chunkSize, dtype, robustIterations)
+
+	runOrder = datasets[0].sampleMetadata['Run Order'].values
+	referenceSamples = (datasets[0].sampleMetadata['SampleType'].values == correctionSampleType) & (datasets[0].sampleMetadata['AssayRole'].values == AssayRole.PrecisionReference)
+	batchList = datasets[0].sampleMetadata['Correction Batch'].values
+
+	for data in datasets[1:]:
+		if data.noSamples != datasets[0].noSamples:
+			raise ValueError('datasets must contain the same samples')
+		if not numpy.array_equal(data.sampleMetadata['Run Order'].values, runOrder):
+			raise ValueError('datasets must share the same \'Run Order\'')
+		if not numpy.array_equal(data.sampleMetadata['Correction Batch'].values.astype(float), batchList.astype(float), equal_nan=True):
+			raise ValueError('datasets must share the same \'Correction Batch\'')
+		if not numpy.array_equal((data.sampleMetadata['SampleType'].values == correctionSampleType) & (data.sampleMetadata['AssayRole'].values == AssayRole.PrecisionReference), referenceSamples):
+			raise ValueError('datasets must share the same reference samples')
+
+	# Correct features from all datasets side by side
+	intensityData = [data.intensityData for data in datasets]
+	bounds = numpy.cumsum([0] + [X.shape[1] for X in intensityData])
+
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', category=RuntimeWarning)
+
+		(correctedIntensity, fits) = _batchCorrectionHead(numpy.concatenate(intensityData, axis=1, dtype=dtype),
+														  runOrder,
+														  referenceSamples,
+														  batchList,
+														  window=window,
+														  method=method,
+														  align=align,
+														  parallelise=parallelise,
+														  engine=engine,
+														  nJobs=nJobs,
+														  chunkSize=chunkSize,
+														  dtype=dtype,
+														  robustIterations=robustIterations)
+
+	correctedDatasets = list()
+	for (i, data) in enumerate(datasets):
+		block = slice(bounds[i], bounds[i + 1])
+
+		if excludeFailures:
+			failures = _correctionFailures(intensityData[i], correctedIntensity[:, block], fits[:, block], batchList, method)
+		else:
+			failures = None
+
+		correctedDatasets.append(_correctedDataset(data,
+												   correctedIntensity[:, block].copy(),
+												   CorrectionFit.fromDense(fits[:, block], runOrder, referenceSamples, batchList),
+												   failures, window, method, align, correctionSampleType, engine, dtype, robustIterations))
+
+	return correctedDatasets
+
+
+def _checkCorrectionArguments(window=11, method='LOWESS', align='median', parallelise=True, excludeFailures=True, correctionSampleType=SampleType.StudyPool, engine='statsmodels', nJobs=None, chunkSize=None, dtype=float, robustIterations=3):
+	"""
+	Validate the correction parameters shared by the correction functions, each passing those it accepts.
+	"""
 	if not isinstance(window, int) & (window>0):
 		raise TypeError('window must be a positive integer')
 	if method is not None:
@@ -53,28 +255,248 @@ def correctMSdataset(data, window=11, method='LOWESS', align='median', paralleli
 		raise TypeError("excludeFailures must be a boolean")
 	if not isinstance(correctionSampleType,SampleType):
 		raise TypeError("correctionType must be a SampleType")
+	if not isinstance(engine, str) & (engine in {'statsmodels', 'vectorised'}):
+		raise ValueError('engine must be == statsmodels or vectorised')
+	if (nJobs is not None) and not (isinstance(nJobs, int) & (nJobs != 0)):
+		raise TypeError('nJobs must be None or a non-zero integer')
+	if (chunkSize is not None) and not (isinstance(chunkSize, int) & (chunkSize > 0)):
+		raise TypeError('chunkSize must be None or a positive integer')
+	_checkDtype(dtype)
+	if not isinstance(robustIterations, int) or isinstance(robustIterations, bool) or (robustIterations < 0):
+		raise TypeError('robustIterations must be a non-negative integer')
+
+
+def _checkDtype(dtype):
+	"""
+	Raise an error unless *dtype* is a floating point precision correction can be carried out in.
+	"""
+	try:
+		dtype = numpy.dtype(dtype)
+	except TypeError:
+		raise TypeError('dtype must be numpy.float32 or numpy.float64')
+	if dtype not in {numpy.dtype(numpy.float32), numpy.dtype(numpy.float64)}:
+		raise ValueError('dtype must be numpy.float32 or numpy.float64')
 
-	with warnings.catch_warnings():
-		warnings.simplefilter('ignore', category=RuntimeWarning)
 
-		correctedP = _batchCorrectionHead(data.intensityData,
-									 data.sampleMetadata['Run Order'].values,
-									 (data.sampleMetadata['SampleType'].values == correctionSampleType) & (data.sampleMetadata['AssayRole'].values == AssayRole.PrecisionReference),
-									 data.sampleMetadata['Correction Batch'].values,
-									 window=window,
-									 method=method,
-									 align=align,
-									 parallelise=parallelise)
+def _correctedDataset(data, correctedIntensity, fit, failures, window, method, align, correctionSampleType, engine, dtype=float, robustIterations=3, state=None, message='Batch and run order correction applied'):
+	"""
+	Duplicate *data* with corrected intensities and fits, masking features listed in *failures* (unless ``None``).
+
+	The state needed by :py:func:`correctNewBatches` is attached, initialised from *data* unless *state* is given, and *message* logged.
+	"""
+	import copy
+
+	# Do not copy the intensities about to be replaced
+	with stageTimer.stage('copy'):
+		correctedData = copy.deepcopy(data, {id(data._intensityData): None})
+	correctedData.intensityData = correctedIntensity
+	correctedData.fit = fit
+
+	if failures is not None:
+		failed = failures != ''
+
+		if 'Exclusion Details' not in correctedData.featureMetadata:
+			correctedData.featureMetadata['Exclusion Details'] = ''
 
-	correctedData = copy.deepcopy(data)
-	correctedData.intensityData = correctedP[0]
-	correctedData.fit = correctedP[1]
-	correctedData.Attributes['Log'].append([datetime.now(),'Batch and run order correction applied'])
+		if numpy.any(failed):
+			details = correctedData.featureMetadata['Exclusion Details'].values.astype(object)
+			for i in numpy.where(failed)[0]:
+				message = 'Correction failure: ' + failures[i]
+				details[i] = message if (pandas.isnull(details[i]) or details[i] == '') else details[i] + ' AND ' + message
+
+			correctedData.featureMetadata['Exclusion Details'] = details
+			correctedData.featureMask[failed] = False
+
+	if state is None:
+		state = _initialiseCorrectionState(data, window, method, align, correctionSampleType, engine, dtype, robustIterations, failures is not None)
+	correctedData._correctionState = state
+	correctedData.Attributes['Log'].append([datetime.now(), message])
 
 	return correctedData
 
 
-def _batchCorrectionHead(data, runOrder, referenceSamples, batchList, window=11, method='LOWESS', align='median', parallelise=True, savePlots=False):
+def correctNewBatches(data, correctedData, parallelise=True, nJobs=None, chunkSize=None):
+	"""
+	Extend a correction made with :py:func:`correctMSdataset` to batches acquired since, correcting only the new batches.
+
+	*data* holds the raw measurements for all samples acquired so far, *correctedData* the output of an earlier correction of a subset of them. Samples are matched on *'Sample File Name'*, and every sample in a batch already corrected must be present in *correctedData*. New batches (values of *'Correction Batch'* not previously seen) are corrected with the parameters used for *correctedData*, and aligned to an overall reference sample average updated from the new reference samples only. Samples from earlier batches are carried over from *correctedData*, rescaled to the updated average, so the result matches a full correction of *data*. If *correctedData* was corrected with *excludeFailures*, the correction of every batch is checked again and features failing in any are masked.
+
+	:param data: MSDataset object with measurements for all samples acquired so far
+	:type data: MSDataset
+	:param correctedData: Output of :py:func:`correctMSdataset` or :py:func:`correctNewBatches` for the earlier batches
+	:type correctedData: MSDataset
+	:param bool parallelise: If ``True``, use multiple cores
+	:param nJobs: Number of worker processes, see :py:func:`correctMSdataset`
+	:type nJobs: None or int
+	:param chunkSize: Number of features corrected in each task, see :py:func:`correctMSdataset`
+	:type chunkSize: None or int
+	:return: Duplicate of *data*, with run-order correction applied
+	:rtype: MSDataset
+	:raises ValueError: If *correctedData* cannot be extended to *data*
+	"""
+	# Check inputs
+	if not isinstance(data, MSDataset):
+		raise TypeError("data must be a MSDataset instance")
+	if not isinstance(correctedData, MSDataset):
+		raise TypeError("correctedData must be a MSDataset instance")
+	_checkCorrectionArguments(parallelise=parallelise, nJobs=nJobs, chunkSize=chunkSize)
+	if not hasattr(correctedData, '_correctionState'):
+		raise ValueError('correctedData was not generated by correctMSdataset')
+
+	state = correctedData._correctionState
+	parameters = state['parameters']
+
+	if (data.noFeatures != correctedData.noFeatures) or (state['featureAverage'].shape[0] != data.noFeatures):
+		raise ValueError('Features in data and correctedData differ, re-run correctMSdataset')
+
+	sampleNames = data.sampleMetadata['Sample File Name'].values
+	previousIndex = pandas.Index(correctedData.sampleMetadata['Sample File Name'].values).get_indexer(sampleNames)
+	inPrevious = previousIndex >= 0
+
+	batchList = data.sampleMetadata['Correction Batch'].values.astype(float)
+	previousBatch = numpy.isin(batchList, state['batches'])
+	newBatch = ~previousBatch & ~numpy.isnan(batchList)
+
+	if numpy.any(previousBatch & ~inPrevious):
+		raise ValueError('Samples have been added to batches that were already corrected, re-run correctMSdataset')
+
+	referenceSamples = (data.sampleMetadata['SampleType'].values == parameters['correctionSampleType']) & (data.sampleMetadata['AssayRole'].values == AssayRole.PrecisionReference)
+
+	intensityData = data.intensityData
+	oldAverage = state['featureAverage']
+	state = _updateCorrectionState(state, intensityData[referenceSamples & ~inPrevious, :], sampleNames[referenceSamples & ~inPrevious], batchList[newBatch])
+
+	dtype = parameters.get('dtype', float)
+	correctedIntensity = numpy.array(intensityData, dtype=dtype)
+	fits = numpy.full(intensityData.shape, numpy.nan, dtype=dtype)
+
+	# Earlier batches only need rescaling to the updated average
+	if parameters['align'] != 'no':
+		scale = state['featureAverage'] / oldAverage
+	else:
+		scale = numpy.ones(intensityData.shape[1])
+	correctedIntensity[previousBatch, :] = correctedData.intensityData[previousIndex[previousBatch], :] * scale
+	fits[previousBatch, :] = numpy.asarray(correctedData.fit[previousIndex[previousBatch], :])
+
+	if numpy.any(newBatch):
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', category=RuntimeWarning)
+
+			correctedP = _batchCorrectionHead(intensityData[newBatch, :],
+											  data.sampleMetadata['Run Order'].values[newBatch],
+											  referenceSamples[newBatch],
+											  batchList[newBatch],
+											  window=parameters['window'],
+											  method=parameters['method'],
+											  align=parameters['align'],
+											  parallelise=parallelise,
+											  engine=parameters['engine'],
+											  featureAverage=state['featureAverage'],
+											  nJobs=nJobs,
+											  chunkSize=chunkSize,
+											  dtype=dtype,
+											  robustIterations=parameters.get('robustIterations', 3))
+
+		correctedIntensity[newBatch, :] = correctedP[0]
+		fits[newBatch, :] = correctedP[1]
+
+	# Check all batches, so features failing in earlier ones stay masked
+	if parameters.get('excludeFailures', True):
+		with stageTimer.stage('failureChecks'):
+			failures = _correctionFailures(intensityData, correctedIntensity, fits, batchList, parameters['method'])
+	else:
+		failures = None
+
+	with stageTimer.stage('compression'):
+		fit = CorrectionFit.fromDense(fits, data.sampleMetadata['Run Order'].values, referenceSamples, batchList)
+
+	message = 'Batch and run order correction applied to new batches: %s' % (', '.join(str(batch) for batch in numpy.unique(batchList[newBatch])))
+
+	return _correctedDataset(data, correctedIntensity, fit, failures, parameters['window'], parameters['method'], parameters['align'], parameters['correctionSampleType'], parameters['engine'],
+							 dtype, parameters.get('robustIterations', 3), state=state, message=message)
+
+
+def _correctionFailures(data, corrected, fits, batchList, method):
+	"""
+	Check the correction of each column of the *n* × *k* block *data* for failures in any batch.
+
+	Fits are failed where they are not finite or not positive, and corrected intensities where they are not finite or are negative, but were finite or positive before correction.
+
+	:return: *k* element array describing the failures of each feature, ``''`` where correction succeeded
+	:rtype: numpy.ndarray
+	"""
+	data = numpy.asarray(data)
+	reasons = numpy.full(data.shape[1], '', dtype=object)
+
+	for batch in sorted(batch for batch in set(batchList) if not numpy.isnan(batch)):
+		batchMask = numpy.squeeze(numpy.asarray(batchList == batch, 'bool'))
+		batchData = data[batchMask, :]
+		batchCorrected = corrected[batchMask, :]
+
+		checks = list()
+		failed = numpy.zeros(data.shape[1], dtype=bool)
+
+		# Fits are not calculated if no run-order correction is applied
+		if method is not None:
+			batchFits = fits[batchMask, :]
+			nonFinite = numpy.any(~numpy.isfinite(batchFits), axis=0)
+			nonPositive = numpy.any(batchFits <= 0, axis=0) & ~nonFinite
+			checks.extend([('non-finite fit', nonFinite), ('non-positive fit', nonPositive)])
+			failed = nonFinite | nonPositive
+
+		nonFinite = numpy.any(~numpy.isfinite(batchCorrected) & numpy.isfinite(batchData), axis=0) & ~failed
+		negative = numpy.any((batchCorrected < 0) & (batchData >= 0), axis=0) & ~failed & ~nonFinite
+		checks.extend([('non-finite corrected intensities', nonFinite), ('negative corrected intensities', negative)])
+
+		for (reason, flagged) in checks:
+			for i in numpy.where(flagged)[0]:
+				reasons[i] = '%s%s%s in batch %g' % (reasons[i], ', ' if reasons[i] else '', reason, batch)
+
+	return reasons
+
+
+def _initialiseCorrectionState(data, window, method, align, correctionSampleType, engine, dtype=float, robustIterations=3, excludeFailures=True):
+	"""
+	Record what is needed to extend a correction of *data* to further batches with :py:func:`correctNewBatches`.
+	"""
+	state = dict()
+	state['parameters'] = {'window': window, 'method': method, 'align': align, 'correctionSampleType': correctionSampleType, 'engine': engine, 'dtype': dtype, 'robustIterations': robustIterations, 'excludeFailures': excludeFailures}
+	state['batches'] = numpy.array([], dtype=float)
+	state['referenceSamples'] = numpy.array([], dtype=object)
+	state['count'] = 0
+	state['sum'] = numpy.zeros(data.noFeatures)
+	state['referenceData'] = numpy.zeros((0, data.noFeatures))
+	state['featureAverage'] = numpy.full(data.noFeatures, numpy.nan)
+
+	referenceSamples = (data.sampleMetadata['SampleType'].values == correctionSampleType) & (data.sampleMetadata['AssayRole'].values == AssayRole.PrecisionReference)
+	batchList = data.sampleMetadata['Correction Batch'].values.astype(float)
+
+	return _updateCorrectionState(state, data.intensityData[referenceSamples, :], data.sampleMetadata['Sample File Name'].values[referenceSamples], batchList[~numpy.isnan(batchList)])
+
+
+def _updateCorrectionState(state, referenceData, referenceSamples, batches):
+	"""
+	Return a copy of *state* updated with the raw measurements of reference samples not seen before, and the batches corrected.
+
+	The overall mean is kept as a running sum and count, the overall median requires the reference sample measurements themselves, which are retained.
+	"""
+	state = dict(state)
+	state['batches'] = numpy.union1d(state['batches'], batches)
+	state['referenceSamples'] = numpy.concatenate((state['referenceSamples'], numpy.asarray(referenceSamples, dtype=object)))
+
+	align = state['parameters']['align']
+	if align == 'mean':
+		state['count'] = state['count'] + referenceData.shape[0]
+		state['sum'] = state['sum'] + numpy.sum(referenceData, axis=0)
+		state['featureAverage'] = state['sum'] / state['count']
+	elif align == 'median':
+		state['referenceData'] = numpy.concatenate((state['referenceData'], referenceData), axis=0)
+		state['featureAverage'] = numpy.median(state['referenceData'], axis=0)
+
+	return state
+
+
+def _batchCorrectionHead(data, runOrder, referenceSamples, batchList, window=11, method='LOWESS', align='median', parallelise=True, savePlots=False, engine='statsmodels', featureAverage=None, nJobs=None, chunkSize=None, dtype=float, robustIterations=3, corrector=None):
 	"""
 	Conduct run-order correction and batch alignment.
 
@@ -89,6 +511,17 @@ def _batchCorrectionHead(data, runOrder, referenceSamples, batchList, window=11,
 	:param int window: When calculating trends, use a consider this many reference samples, centred on the current position
 	:param str method: Correction method, one of 'LOWESS' (default), 'SavitzkyGolay' or None for no correction
 	:param str align: Average calculation of batch and feature intensity for correction, one of 'median' (default) or 'mean'
+	:param str engine: LOWESS implementation, one of 'statsmodels' (default) or 'vectorised'
+	:param featureAverage: If ``None`` align batches to the average of all reference samples in *data*, otherwise to the *m* values supplied
+	:type featureAverage: None or numpy.ndarray
+	:param nJobs: Number of worker processes when *parallelise* is ``True``, by default one less than the number of CPU cores
+	:type nJobs: None or int
+	:param chunkSize: Number of features in each (batch, feature block) task queued to the workers
+	:type chunkSize: None or int
+	:param dtype: Precision of the corrected values and fits returned, :py:class:`numpy.float64` (default) or :py:class:`numpy.float32`
+	:param int robustIterations: Number of bisquare robustifying iterations when fitting LOWESS trends
+	:param corrector: If *parallelise* is ``True``, a :py:class:`_ParallelCorrection` to run the tasks on, if ``None`` one is started for this call
+	:type corrector: None or _ParallelCorrection
 	"""
 	# Validate inputs
 	if not isinstance(data, numpy.ndarray):
@@ -99,80 +532,192 @@ def _batchCorrectionHead(data, runOrder, referenceSamples, batchList, window=11,
 		raise TypeError('referenceSamples must be a numpy array')
 	if not isinstance(batchList, numpy.ndarray):
 		raise TypeError('batchList must be a numpy array')
-	if not isinstance(window, int) & (window>0):
-		raise TypeError('window must be a positive integer')
-	if method is not None:
-		if not isinstance(method, str) & (method in {'LOWESS', 'SavitzkyGolay'}):
-			raise ValueError('method must be == LOWESS or SavitzkyGolay')	
-	if not isinstance(align, str) & (align in {'mean', 'median', 'no'}):
-			raise ValueError('align must be == mean, median or no')
-	if not isinstance(parallelise, bool):
-		raise TypeError('parallelise must be True or False')
 	if not isinstance(savePlots, bool):
 		raise TypeError('savePlots must be True or False')
+	_checkCorrectionArguments(window=window, method=method, align=align, parallelise=parallelise, engine=engine, nJobs=nJobs, chunkSize=chunkSize, dtype=dtype, robustIterations=robustIterations)
+
+	data = numpy.asarray(data, dtype=dtype)
 
 	# Store paramaters in a dict to avoid arg lists going out of control
 	parameters = dict()
 	parameters['window'] = window
 	parameters['method'] = method
 	parameters['align'] = align
+	parameters['engine'] = engine
+	parameters['featureAverage'] = featureAverage
+	parameters['dtype'] = numpy.dtype(dtype)
+	parameters['robustIterations'] = robustIterations
 
 	if parallelise:
-		# Set up multiprocessing enviroment
-		import multiprocessing
-		
-		# Generate an index and set up pool
-		# Use one less workers than CPU cores
-		if multiprocessing.cpu_count()-1 <= 0:
-			cores = 1
-		else: 
-			cores = multiprocessing.cpu_count()-1
+		# Get overall average intensity once, so tasks covering single batches can align to it
+		if featureAverage is not None:
+			pass
+		elif align == 'mean':
+			parameters['featureAverage'] = numpy.mean(data[referenceSamples, :], axis=0)
+		elif align == 'median':
+			parameters['featureAverage'] = numpy.median(data[referenceSamples, :], axis=0)
+
+		if corrector is None:
+			with _ParallelCorrection(data.shape, data.dtype, runOrder, referenceSamples, batchList, parameters, nJobs) as corrector:
+				return corrector.correct(data, parameters['featureAverage'], chunkSize)
+
+		return corrector.correct(data, parameters['featureAverage'], chunkSize)
+
+	# Just run it
+	# Iterate over features in one batch and correct them
+	results = _batchCorrection(data,
+							   runOrder,
+							   referenceSamples,
+							   batchList,
+							   range(0, data.shape[1]), # All features
+							   parameters,
+							   0)
+
+	with stageTimer.stage('reassembly'):
+		correctedData = numpy.empty_like(data)
+		fits = numpy.empty_like(data)
+
+		# Extract return values from tuple
+		for (w, feature, fit) in results:
+			correctedData[:, w] = feature
+			fits[:, w] = fit
 
-		pool = multiprocessing.Pool(processes=cores)
+	return (correctedData, fits)
 
-		instances = range(0, cores)
 
-		# Break features into no cores chunks
-		featureIndex = _chunkMatrix(range(0, data.shape[1]), cores)
+class _ParallelCorrection:
+	"""
+	Pool of correction workers, and the shared blocks they read features from and write corrected features and fits to, started once and reused to correct successive blocks of up to *shape[1]* features.
+
+	Use as a context manager, on leaving the workers are joined and the shared blocks released.
+
+	:param tuple shape: Shape of the largest block of features to be corrected
+	:param dtype: Precision of the features corrected
+	:param numpy.ndarray runOrder: Run order of the samples
+	:param numpy.ndarray referenceSamples: Mask of the reference samples
+	:param numpy.ndarray batchList: Correction batch of each sample
+	:param dict parameters: Correction parameters, as assembled by :py:func:`_batchCorrectionHead`, the feature averages are supplied with each block
+	:param nJobs: Number of worker processes, see :py:func:`~nPYc.utilities._internal._noWorkers`
+	:type nJobs: None or int
+	"""
 
-		# run _batchCorection
-		##
-		# At present pickle args and returns and reassemble  after - possiblly share memory in the future.
-		##
-		results2 = [pool.apply_async(_batchCorrection, args=(data, runOrder, referenceSamples, batchList, featureIndex, parameters, w)) for w in instances]
+	def __init__(self, shape, dtype, runOrder, referenceSamples, batchList, parameters, nJobs=None):
 
-		results2 = [p.get(None) for p in results2]
+		self.batchList = batchList
+		self.noWorkers = _noWorkers(nJobs)
 
-		results = list()
-		# Unpack results
-		for instanceOutput in results2:
-			for item in instanceOutput:
-				results.append(item)
+		parameters = dict(parameters)
+		parameters['featureAverage'] = None
 
-		# Shut down the pool
-		pool.close()
+		with contextlib.ExitStack() as stack:
+			with stageTimer.stage('sharedMemory'):
+				self.sharedData = stack.enter_context(_SharedArray(shape, dtype=dtype))
+				self.sharedCorrected = stack.enter_context(_SharedArray(shape, dtype=dtype))
+				self.sharedFits = stack.enter_context(_SharedArray(shape, dtype=dtype))
+				self.sharedAverage = stack.enter_context(_SharedArray((shape[1],), dtype=dtype))
 
+			context = (self.sharedData.spec, self.sharedCorrected.spec, self.sharedFits.spec, self.sharedAverage.spec, runOrder, referenceSamples, batchList, parameters)
+			self.pool = stack.enter_context(_workerPool(nJobs, initializer=_initialiseBatchCorrectionWorker, initargs=(context,)))
 
-	else:
-		# Just run it
-		# Iterate over features in one batch and correct them
-		results = _batchCorrection(data, 
-								   runOrder,
-								   referenceSamples,
-								   batchList,
-								   range(0, data.shape[1]), # All features
-								   parameters,
-								   0)
-
-	correctedData = numpy.empty_like(data)
-	fits = numpy.empty_like(data)
-
-	# Extract return values from tuple
-	for (w, feature, fit) in results:
-		correctedData[:, w] = feature
-		fits[:, w] = fit
+			self._stack = stack.pop_all()
 
-	return (correctedData, fits)
+	def correct(self, data, featureAverage=None, chunkSize=None):
+		"""
+		Correct the block of features *data*, aligning batches to *featureAverage* if given.
+
+		:param numpy.ndarray data: *n* × *k* block of features, with *k* up to the width the workers were started for
+		:param featureAverage: *k* feature averages to align batches to, if ``None`` do not align
+		:type featureAverage: None or numpy.ndarray
+		:param chunkSize: Number of features in each (batch, feature block) task, by default enough to give each worker around four tasks per batch
+		:type chunkSize: None or int
+		:return: Tuple of (corrected data, fits)
+		:rtype: tuple
+		"""
+		noFeatures = data.shape[1]
+		if chunkSize is None:
+			# Aim for several tasks per worker in each batch, so workers finishing early can pick up the remainder
+			chunkSize = int(numpy.ceil(noFeatures / (4.0 * self.noWorkers)))
+		chunkSize = max(chunkSize, 1)
+
+		# Queue one task per batch and block of features, largest batches first
+		batches = [batch for batch in set(self.batchList) if not numpy.isnan(batch)]
+		batches.sort(key=lambda batch: numpy.sum(self.batchList == batch), reverse=True)
+		aligned = featureAverage is not None
+		tasks = [(batch, start, min(start + chunkSize, noFeatures), aligned) for batch in batches for start in range(0, noFeatures, chunkSize)]
+
+		# Tasks write their slices of the shared blocks in place
+		# Samples outside any batch are left uncorrected
+		with stageTimer.stage('sharedMemory'):
+			self.sharedData.array[:, :noFeatures] = data
+			self.sharedCorrected.array[:, :noFeatures] = data
+			self.sharedFits.array[:, :noFeatures] = numpy.nan
+			if aligned:
+				self.sharedAverage.array[:noFeatures] = featureAverage
+
+		with stageTimer.stage('workers'):
+			# Keep the times recorded by the workers
+			for (pid, taskFeatures, seconds, stages) in self.pool.imap_unordered(_batchCorrectionTask, tasks):
+				stageTimer.addWorker(pid, taskFeatures, seconds, stages)
+
+		with stageTimer.stage('reassembly'):
+			correctedData = numpy.array(self.sharedCorrected.array[:, :noFeatures], copy=True)
+			fits = numpy.array(self.sharedFits.array[:, :noFeatures], copy=True)
+
+		return (correctedData, fits)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		# Workers are joined (or terminated on error) before the shared blocks are unlinked
+		with stageTimer.stage('workers'):
+			return self._stack.__exit__(*args)
+
+
+# Shared blocks and inputs attached once per worker by _initialiseBatchCorrectionWorker
+_workerContext = dict()
+
+
+def _initialiseBatchCorrectionWorker(context):
+	"""
+	Attach a worker to the shared input and output blocks, the handles are held until the worker exits.
+
+	Workers inherit a copy of the parent's fit cache when forked.
+	"""
+	stageTimer.reset()
+
+	(dataSpec, correctedSpec, fitSpec, averageSpec, runOrder, referenceSamples, batchList, parameters) = context
+
+	(_workerContext['dataShm'], _workerContext['data']) = _attachSharedArray(dataSpec)
+	(_workerContext['correctedShm'], _workerContext['corrected']) = _attachSharedArray(correctedSpec)
+	(_workerContext['fitShm'], _workerContext['fits']) = _attachSharedArray(fitSpec)
+	(_workerContext['averageShm'], _workerContext['featureAverage']) = _attachSharedArray(averageSpec)
+	_workerContext['runOrder'] = runOrder
+	_workerContext['referenceSamples'] = referenceSamples
+	_workerContext['batchList'] = batchList
+	_workerContext['parameters'] = parameters
+
+
+def _batchCorrectionTask(task):
+	"""
+	Correct the samples in one batch for the features ``start:stop``, writing to the shared blocks attached by :py:func:`_initialiseBatchCorrectionWorker`, and return the process id, number of features, time taken, and stage times of the task.
+	"""
+	startTime = time.perf_counter()
+	(batch, start, stop, aligned) = task
+
+	batchMask = numpy.squeeze(numpy.asarray(_workerContext['batchList'] == batch, 'bool'))
+	parameters = _workerContext['parameters']
+
+	(corrected, fits) = _correctBatch(_workerContext['data'][batchMask, start:stop],
+									  _workerContext['runOrder'][batchMask],
+									  _workerContext['referenceSamples'][batchMask],
+									  parameters,
+									  _workerContext['featureAverage'][start:stop] if aligned else None)
+
+	_workerContext['corrected'][batchMask, start:stop] = corrected
+	_workerContext['fits'][batchMask, start:stop] = fits
+
+	return (os.getpid(), stop - start, time.perf_counter() - startTime, stageTimer.drain())
 
 
 def _batchCorrection(data, runOrder, QCsamples, batchList, featureIndex, parameters, w):
@@ -186,6 +731,22 @@ def _batchCorrection(data, runOrder, QCsamples, batchList, featureIndex, paramet
 	else:
 		featureList = range(0, len(featureIndex))
 
+	# Savitzky-Golay and vectorised LOWESS correct all features in a batch together
+	if (parameters['method'] == 'SavitzkyGolay') or (parameters.get('engine', 'statsmodels') == 'vectorised'):
+		if data.ndim == 1:
+			block = data[:, numpy.newaxis]
+		else:
+			block = data[:, featureList]
+
+		if parameters.get('featureAverage') is not None:
+			featureAverage = parameters['featureAverage'][featureList]
+		else:
+			featureAverage = None
+
+		(corrected, fits) = _batchCorrectionBlock(block, runOrder, QCsamples, batchList, parameters, featureAverage=featureAverage)
+
+		return [(i, corrected[:, j], fits[:, j]) for (j, i) in enumerate(featureList)]
+
 	# add results to this list:
 	results = list()
 	
@@ -204,7 +765,9 @@ def _batchCorrection(data, runOrder, QCsamples, batchList, featureIndex, paramet
 		batches = list(set(batchList))
 
 		# Get overall average intensity
-		if parameters['align'] == 'mean':
+		if parameters.get('featureAverage') is not None:
+			featureAverage = parameters['featureAverage'][i]
+		elif parameters['align'] == 'mean':
 			featureAverage = numpy.mean(feature[QCsamples])
 		elif parameters['align'] == 'median':
 			featureAverage = numpy.median(feature[QCsamples])
@@ -249,9 +812,76 @@ def _batchCorrection(data, runOrder, QCsamples, batchList, featureIndex, paramet
 	return results
 
 
+def _batchCorrectionBlock(data, runOrder, QCsamples, batchList, parameters, featureAverage=None):
+	"""
+	Batch and run-order correct all columns of the *n* × *k* array *data* together, returns a tuple of corrected values and fits.
+
+	If *featureAverage* is ``None`` batches are aligned to the average of the reference samples in *data*, otherwise to the *k* values supplied.
+	"""
+	dtype = parameters.get('dtype', numpy.dtype(float))
+	data = numpy.array(data, dtype=dtype)
+	fits = numpy.full(data.shape, numpy.nan, dtype=dtype)
+
+	# Get overall average intensity
+	if featureAverage is not None:
+		pass
+	elif parameters['align'] == 'mean':
+		featureAverage = numpy.mean(data[QCsamples, :], axis=0)
+	elif parameters['align'] == 'median':
+		featureAverage = numpy.median(data[QCsamples, :], axis=0)
+
+	for batch in set(batchList):
+		# Skip the NaN batch
+		if numpy.isnan(batch):
+			continue
+
+		batchMask = numpy.squeeze(numpy.asarray(batchList == batch, 'bool'))
+
+		(data[batchMask, :], fits[batchMask, :]) = _correctBatch(data[batchMask, :],
+																 runOrder[batchMask],
+																 QCsamples[batchMask],
+																 parameters,
+																 featureAverage)
+
+	return (data, fits)
+
+
+def _correctBatch(data, runOrder, QCsamples, parameters, featureAverage):
+	"""
+	Run-order correct the columns of the *n* × *k* array *data*, holding the samples of a single batch, and align them to *featureAverage*.
+
+	With the statsmodels LOWESS engine features are fitted one at a time, otherwise all together.
+	"""
+	dtype = parameters.get('dtype', numpy.dtype(float))
+	data = numpy.array(data, dtype=dtype)
+	fits = numpy.full(data.shape, numpy.nan, dtype=dtype)
+
+	if parameters['method'] is None:
+		pass
+	elif (parameters['method'] == 'LOWESS') and (parameters.get('engine', 'statsmodels') == 'statsmodels'):
+		for i in range(data.shape[1]):
+			(data[:, i], fits[:, i]) = runOrderCompensation(data[:, i], runOrder, QCsamples, parameters)
+	else:
+		(data, fits) = runOrderCompensation(data, runOrder, QCsamples, parameters)
+
+	# Correct batch average to overall feature average
+	with stageTimer.stage('alignment'):
+		if parameters['align'] == 'mean':
+			batchMean = numpy.mean(data[QCsamples, :], axis=0)
+		elif parameters['align'] == 'median':
+			batchMean = numpy.median(data[QCsamples, :], axis=0)
+		if parameters['align'] != 'no':
+			data = numpy.divide(data, batchMean)
+			data = numpy.multiply(data, featureAverage)
+
+	return (data, fits)
+
+
 def runOrderCompensation(data, runOrder, referenceSamples, parameters):
 	"""
 	Model and remove longitudinal effects.
+
+	Trends through the reference samples are looked up in :py:data:`~nPYc.batchAndROCorrection.fitCache`, and added to it if *parameters['cacheFits']* is ``True``.
 	"""
 
 	# Break the QCs out of the dataset
@@ -262,96 +892,310 @@ def runOrderCompensation(data, runOrder, referenceSamples, parameters):
 	# Optimisation of window would happen here.
 	window = parameters['window']
 	align = parameters['align']
-	if parameters['method'] == 'LOWESS':
-		(data, fit) = doLOESScorrection(QCdata, 
-										QCrunorder, 
-										data, 
-										runOrder,
-										align=align,
-										window=window)
-	elif parameters['method'] == 'SavitzkyGolay':
-		(data, fit) = doSavitzkyGolayCorrection(QCdata, 
-												QCrunorder, 
-												data, 
-												runOrder, 
-												window=window)
+	engine = parameters.get('engine', 'statsmodels')
+	robustIterations = parameters.get('robustIterations', 3)
+
+	with stageTimer.stage('smoothing'):
+		(knots, smoothed) = _smoothReferenceSamples(QCdata, QCrunorder, parameters['method'], window, engine=engine, robustIterations=robustIterations, cache=fitCache, cacheFits=parameters.get('cacheFits', False))
+
+	with stageTimer.stage('interpolation'):
+		if parameters['method'] == 'LOWESS':
+			(data, fit) = _applyFit(knots, smoothed, QCdata, data, runOrder, align=align, clip=True)
+		elif parameters['method'] == 'SavitzkyGolay':
+			(data, fit) = _applyFit(knots, smoothed, QCdata, data, runOrder, align='median', clip=False)
 
 	# Potentially exclude features with poor fits that retuned NaN &c here.
 	
 	return (data, fit)
 
 
-def doLOESScorrection(QCdata, QCrunorder, data, runorder, align='median', window=11):
+def doLOESScorrection(QCdata, QCrunorder, data, runorder, align='median', window=11, robustIterations=3):
 	"""
 	Fit a LOWESS regression to the data.
 	"""
-	# Convert window number of samples to fraction of the dataset:
-	noSamples = QCrunorder.shape
+	(knots, smoothed) = _smoothReferenceSamples(QCdata, QCrunorder, 'LOWESS', window, engine='statsmodels', robustIterations=robustIterations)
 
-	if noSamples == 0:
+	return _applyFit(knots, smoothed, QCdata, data, runorder, align=align, clip=True)
 
-		fit = numpy.zeros(shape=runorder.shape)
-		corrected = data
 
+def doLOESScorrectionVectorised(QCdata, QCrunorder, data, runorder, align='median', window=11, robustIterations=3):
+	"""
+	Fit LOWESS regressions to all columns of the data at once.
+
+	Equivalent to calling :py:func:`doLOESScorrection` on each column, but as all features share the same reference sample run order, the neighbourhood weights are calculated once and the local regressions solved for every feature as matrix products. Columns with non-finite reference values are fitted individually.
+
+	Each of the *robustIterations* bisquare reweighting rounds likewise updates the weights of every feature at once.
+	"""
+	(knots, smoothed) = _smoothReferenceSamples(QCdata, QCrunorder, 'LOWESS', window, engine='vectorised', robustIterations=robustIterations)
+
+	return _applyFit(knots, smoothed, QCdata, data, runorder, align=align, clip=True)
+
+
+def doSavitzkyGolayCorrection(QCdata, QCrunorder, data, runorder, window=11, polyOrder=3):
+	"""
+	Fit a Savitzky-Golay curve to the data.
+
+	*QCdata* and *data* may be vectors, or arrays with one column per feature, in which case all columns are filtered and interpolated together.
+	"""
+	(knots, smoothed) = _smoothReferenceSamples(QCdata, QCrunorder, 'SavitzkyGolay', window, polyOrder=polyOrder)
+
+	return _applyFit(knots, smoothed, QCdata, data, runorder, align='median', clip=False)
+
+
+def _smoothReferenceSamples(QCdata, QCrunorder, method, window, engine='statsmodels', polyOrder=3, robustIterations=3, cache=None, cacheFits=False):
+	"""
+	Smooth the reference sample intensities of each feature along the run order.
+
+	If *cache* is a :py:class:`~nPYc.batchAndROCorrection.FitCache` and features are fitted one at a time (LOWESS with the statsmodels engine), features fitted before are taken from it, and if *cacheFits* is ``True`` those fitted now are added. Features fitted together, by the vectorised engine or Savitzky-Golay filtering, are not cached.
+
+	:return: Tuple of (sorted reference sample run orders, *q* × *k* array of smoothed values at each)
+	:rtype: tuple
+	"""
+	QCdata = numpy.asarray(QCdata, dtype=float)
+	if QCdata.ndim == 1:
+		QCdata = QCdata[:, numpy.newaxis]
+
+	# Sort the array
+	sortedRO = numpy.argsort(QCrunorder, kind='stable')
+	knots = numpy.asarray(QCrunorder, dtype=float)[sortedRO]
+	QCdata = QCdata[sortedRO, :]
+
+	smoothed = numpy.empty(QCdata.shape)
+	if knots.shape[0] == 0:
+		return knots, smoothed
+
+	if method == 'SavitzkyGolay':
+		parameters = (method, window, polyOrder)
+	else:
+		parameters = (method, window, engine, robustIterations)
+
+	# Hash features only where fits are made one at a time, and may be cached or reused
+	if (method != 'LOWESS') or (engine == 'vectorised') or (cache is None) or (cache.maxBytes <= 0):
+		cache = None
+	elif not (cacheFits or len(cache)):
+		cache = None
+
+	if cache is not None:
+		keys = [cache.key(QCdata[:, i], knots, parameters) for i in range(QCdata.shape[1])]
+
+		missing = list()
+		for (i, key) in enumerate(keys):
+			cached = cache.get(key)
+			if cached is None:
+				missing.append(i)
+			else:
+				smoothed[:, i] = cached
 	else:
-		frac = window / float(numpy.squeeze(noSamples))
-		frac = min([1, frac])
+		keys = None
+		missing = list(range(QCdata.shape[1]))
+
+	if not missing:
+		return knots, smoothed
+
+	if method == 'SavitzkyGolay':
 		# actually do the work
-		z = lowess(QCdata, QCrunorder, frac=frac)
+		smoothed[:, missing] = savgol_filter(QCdata[:, missing], window, polyOrder, axis=0)
+
+	elif method == 'LOWESS':
+		# Convert window number of samples to fraction of the dataset:
+		frac = min([1, window / float(knots.shape[0])])
+
+		missingData = QCdata[:, missing]
+		fitted = numpy.empty(missingData.shape)
+
+		if engine == 'vectorised':
+			finite = numpy.all(numpy.isfinite(missingData), axis=0)
+			fitted[:, finite] = _lowessOperator(knots, frac).smooth(missingData[:, finite], iterations=robustIterations)
+		else:
+			finite = numpy.zeros(missingData.shape[1], dtype=bool)
+
+		# statsmodels drops missing values, fit these features (or all of them) one at a time
+		for i in numpy.where(~finite)[0]:
+			z = lowess(missingData[:, i], knots, frac=frac, it=robustIterations)
+			fitted[:, i] = numpy.interp(knots, z[:, 0], z[:, 1])
+
+		smoothed[:, missing] = fitted
+
+	if (keys is not None) and cacheFits:
+		for i in missing:
+			cache.put(keys[i], smoothed[:, i])
+
+	return knots, smoothed
+
+
+def _applyFit(knots, smoothed, QCdata, data, runorder, align='median', clip=True):
+	"""
+	Interpolate trends smoothed by :py:func:`_smoothReferenceSamples` to *runorder*, and divide them out of *data*.
+
+	:return: Tuple of (corrected data, fit), shaped as *data*
+	:rtype: tuple
+	"""
+	data = numpy.asarray(data)
+	if not numpy.issubdtype(data.dtype, numpy.floating):
+		data = data.astype(float)
+
+	squeeze = data.ndim == 1
+	if squeeze:
+		data = data[:, numpy.newaxis]
+		QCdata = numpy.asarray(QCdata)[:, numpy.newaxis]
+
+	if knots.shape[0] == 0:
+
+		fit = numpy.zeros(shape=data.shape, dtype=data.dtype)
+		corrected = data
+
+	else:
+		# Divide by fit, then rescale to batch median, at the precision of data
+		(lower, upper, weight) = _interpolationWeights(knots, runorder)
+		fit = _interpolate(smoothed.astype(data.dtype), lower, upper, weight.astype(data.dtype))
 
-		# Divide by fit, then rescale to batch median
-		fit = numpy.interp(runorder, z[:,0], z[:,1])
-	
 		# Fit can go negative if too many adjacent QC samples == 0; set any negative fit values to zero
-		fit[fit < 0] = 0
+		if clip:
+			fit[fit < 0] = 0
 
 		corrected = numpy.divide(data, fit)
 		if align == 'median':
-			corrected = numpy.multiply(corrected, numpy.median(QCdata))
+			corrected = numpy.multiply(corrected, numpy.median(QCdata, axis=0))
 		elif align == 'mean':
-			corrected = numpy.multiply(corrected, numpy.mean(QCdata))
+			corrected = numpy.multiply(corrected, numpy.mean(QCdata, axis=0))
+
+	if squeeze:
+		return corrected[:, 0], fit[:, 0]
 
 	return corrected, fit
 
 
-def doSavitzkyGolayCorrection(QCdata, QCrunorder, data, runorder, window=11, polyOrder=3):
+def optimiseCorrection(data, windows=range(5, 32, 2), method='LOWESS', align='median', perFeature=False, parallelise=True, correctionSampleType=SampleType.StudyPool, nJobs=None, robustIterations=3):
 	"""
-	Fit a Savitzky-Golay curve to the data.
+	Search for the run-order correction window that best removes trends from the reference samples in the :py:class:`~nPYc.objects.MSDataset` instance *data*.
+
+	Each candidate window is scored by the percentage :term:`RSD<Relative Standard Deviation>` of the reference samples after leave-one-out correction: every reference sample is corrected by a fit through the remaining reference samples of its batch, and batches are aligned as in :py:func:`correctMSdataset`. Windows that over-fit pull the curve towards each reference sample and score poorly once that sample is left out. Leave-one-out fits are obtained in closed form from a single smoothing pass per window (see :py:meth:`~nPYc.batchAndROCorrection._lowess._LOWESSOperator.smoothLeaveOneOut`), reference sample data are extracted, sorted and shared between candidates once.
+
+	:param data: MSDataset object with measurements to be corrected
+	:type data: MSDataset
+	:param windows: Candidate window sizes to score
+	:type windows: iterable of int
+	:param str method: Correction method, one of 'LOWESS' (default) or 'SavitzkyGolay'
+	:param str align: Average calculation of batch and feature intensity for correction, one of 'median' (default), 'mean' or 'no'
+	:param bool perFeature: If ``True`` return the best window for each feature, otherwise the single window minimising the median RSD across all features
+	:param bool parallelise: If ``True``, score candidate windows on multiple cores
+	:param enum correctionSampleType: Which SampleType to use for the correction, default SampleType.StudyPool
+	:param nJobs: Number of worker processes when *parallelise* is ``True``, see :py:func:`correctMSdataset`
+	:type nJobs: None or int
+	:param int robustIterations: Number of bisquare robustifying iterations when fitting LOWESS trends, see :py:func:`correctMSdataset`
+	:return: Tuple of (best window, either an int or an *m* vector of ints; *w* × *m* array of reference sample RSDs for each candidate window)
+	:rtype: tuple
 	"""
-	# Sort the array
-	sortedRO = numpy.argsort(QCrunorder)
-	sortedRO2 = QCrunorder[sortedRO]
-	QCdataSorted = QCdata[sortedRO]
+	from ..utilities import rsd
+
+	# Check inputs
+	if not isinstance(data, MSDataset):
+		raise TypeError("data must be a MSDataset instance")
+	windows = list(windows)
+	if len(windows) == 0:
+		raise TypeError('windows must be a list of positive integers')
+	for window in windows:
+		_checkCorrectionArguments(window=window)
+	# A window is only searched for if correcting
+	if method is None:
+		raise ValueError('method must be == LOWESS or SavitzkyGolay')
+	_checkCorrectionArguments(method=method, align=align, parallelise=parallelise, correctionSampleType=correctionSampleType, nJobs=nJobs, robustIterations=robustIterations)
+	if not isinstance(perFeature, bool):
+		raise TypeError("perFeature must be a boolean")
+
+	referenceSamples = (data.sampleMetadata['SampleType'].values == correctionSampleType) & (data.sampleMetadata['AssayRole'].values == AssayRole.PrecisionReference)
+	runOrder = data.sampleMetadata['Run Order'].values.astype(float)
+	batchList = data.sampleMetadata['Correction Batch'].values.astype(float)
+
+	# Extract the reference samples once, grouped by batch and sorted by run order
+	QCindex = list()
+	batchBounds = list()
+	for batch in numpy.unique(batchList[referenceSamples & ~numpy.isnan(batchList)]):
+		batchIndex = numpy.where(referenceSamples & (batchList == batch))[0]
+		batchIndex = batchIndex[numpy.argsort(runOrder[batchIndex], kind='stable')]
+
+		batchBounds.append((len(QCindex), len(QCindex) + len(batchIndex)))
+		QCindex.extend(batchIndex)
+
+	QCdata = data.intensityData[QCindex, :]
+	QCrunOrder = runOrder[QCindex]
 
-	# actually do the work
-	z = savgol_filter(QCdataSorted, window, polyOrder)
+	parameters = dict()
+	parameters['method'] = method
+	parameters['align'] = align
+	parameters['robustIterations'] = robustIterations
 
-	fit = numpy.interp(runorder, sortedRO2, z)
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', category=RuntimeWarning)
 
-	corrected = numpy.divide(data, fit)
-	corrected = numpy.multiply(corrected, numpy.median(QCdata))
+		if parallelise:
+			with _SharedArray.fromArray(QCdata) as sharedQCdata, _workerPool(nJobs) as pool:
+				results = [pool.apply_async(_optimiseCorrectionWorker, args=(sharedQCdata.spec, QCrunOrder, batchBounds, window, parameters)) for window in windows]
+				ratios = [p.get(None) for p in results]
+		else:
+			ratios = [_leaveOneOutRatios(QCdata, QCrunOrder, batchBounds, window, parameters) for window in windows]
 
-	return corrected, fit
+		rsds = numpy.array([rsd(ratio) for ratio in ratios])
 
+	if perFeature:
+		bestWindow = numpy.array(windows)[numpy.argmin(rsds, axis=0)]
+	else:
+		bestWindow = windows[int(numpy.argmin(numpy.median(rsds, axis=1)))]
 
-def optimiseCorrection(feature, optimise):
+	return bestWindow, rsds
+
+
+def _optimiseCorrectionWorker(QCdataSpec, QCrunOrder, batchBounds, window, parameters):
 	"""
-	Optimise the window function my mimising the output of `optimise(data)`
+	Score one candidate window on reference sample data held in shared memory.
+	"""
+	(QCdataShm, QCdata) = _attachSharedArray(QCdataSpec)
+
+	try:
+		ratios = _leaveOneOutRatios(QCdata, QCrunOrder, batchBounds, window, parameters)
+	finally:
+		del QCdata
+		QCdataShm.close()
+
+	return ratios
+
+
+def _leaveOneOutRatios(QCdata, QCrunOrder, batchBounds, window, parameters):
 	"""
-	pass
+	Ratio of each reference sample to its leave-one-out fit, normalised to the batch average as in batch alignment.
 
+	*QCdata* rows must be grouped by batch as listed in *batchBounds* and sorted by *QCrunOrder* within each batch.
+	"""
+	ratios = numpy.full(QCdata.shape, numpy.nan)
 
-##
-# Adapted from http://stackoverflow.com/questions/2130016/splitting-a-list-of-arbitrary-size-into-only-roughly-n-equal-parts
-## 
-def _chunkMatrix(seq, num):
-	avg = round(len(seq) / float(num))
-	out = []
-	last = 0.0
+	for (start, stop) in batchBounds:
+		batchData = numpy.asarray(QCdata[start:stop, :], dtype=float)
+		noSamples = stop - start
+
+		if parameters['method'] == 'LOWESS':
+			operator = _lowessOperator(QCrunOrder[start:stop], min(1, window / float(noSamples)))
+			estimates = operator.smoothLeaveOneOut(batchData, iterations=parameters.get('robustIterations', 3))
+			# Fit can go negative if too many adjacent QC samples == 0
+			estimates[estimates < 0] = 0
+
+		elif parameters['method'] == 'SavitzkyGolay':
+			# The filter cannot be fitted with fewer samples than the window
+			if (window > noSamples) or (window <= 3):
+				continue
+
+			# Savitzky-Golay is a linear smoother, so the leave-one-out estimates follow from its hat matrix
+			hat = savgol_filter(numpy.eye(noSamples), window, 3, axis=0)
+			leverage = numpy.diag(hat)[:, numpy.newaxis]
+			estimates = (hat @ batchData - leverage * batchData) / (1 - leverage)
+			estimates[numpy.squeeze(leverage, axis=1) >= 1 - 1e-10, :] = numpy.nan
+
+		batchRatios = batchData / estimates
+
+		if parameters['align'] == 'mean':
+			batchRatios = batchRatios / numpy.mean(batchRatios, axis=0)
+		elif parameters['align'] == 'median':
+			batchRatios = batchRatios / numpy.median(batchRatios, axis=0)
 
-	for i in range(0, num-1):
-		out.append(seq[int(last):int(last + avg)])
-		last += avg
-	out.append(seq[int(last):max(seq)+1])
+		ratios[start:stop, :] = batchRatios
 
-	return out
+	return ratios
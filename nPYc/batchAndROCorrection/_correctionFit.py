@@ -0,0 +1,208 @@
+"""
+Compact storage of the run-order correction trend lines fitted by :py:func:`~nPYc.batchAndROCorrection.correctMSdataset`.
+"""
+
+import numpy
+from ._lowess import _interpolationWeights, _interpolate
+
+
+class CorrectionFit:
+	"""
+	Run-order correction fits for an *n* × *m* dataset, stored as the fitted values at the reference samples of each batch.
+
+	Within a batch the fit for every sample is a linear interpolation between its values at the reference samples (the knots), so only the knots need to be kept. Dense fits are rebuilt on demand, and only for the samples and features requested:
+
+	* ``fit[:, 5]`` or ``fit[rows, 5]`` returns a numpy vector with the fit for feature 5
+	* ``fit[sampleMask, :]`` or ``fit[:, featureMask]`` returns a new :py:class:`CorrectionFit` holding the selection, so masks can be applied without expanding the fit
+	* :py:meth:`toArray`, or passing the object to :py:func:`numpy.asarray`, returns the full dense fit
+
+	Features whose fit cannot be reproduced from the knots (for instance where the trend was clipped at zero between two reference samples) are held densely.
+
+	Values are held, and dense fits rebuilt, in the precision of the fitted values (see the *dtype* argument of :py:func:`~nPYc.batchAndROCorrection.correctMSdataset`).
+
+	Instances are normally created from a dense fit with :py:meth:`fromDense`.
+
+	:param numpy.ndarray runOrder: *n* vector of sample run orders
+	:param numpy.ndarray batchIndex: *n* vector of the position in *knots* of the batch of each sample, -1 for samples not corrected
+	:param list knots: Sorted run orders of the reference samples in each batch
+	:param list values: Fitted values at the knots of each batch, one array with a column per feature for each batch
+	:param dict dense: Dense fits of features not represented by *knots*, *n* vectors keyed by feature index
+	:param int noFeatures: Number of features *m*
+	"""
+
+	def __init__(self, runOrder, batchIndex, knots, values, dense, noFeatures):
+
+		self._runOrder = numpy.asarray(runOrder, dtype=float)
+		self._batchIndex = numpy.asarray(batchIndex, dtype=int)
+		self._knots = knots
+		self._values = values
+		self._dense = dense
+		self._noFeatures = noFeatures
+
+	@classmethod
+	def fromDense(cls, fits, runOrder, referenceSamples, batchList):
+		"""
+		Compress the dense *n* × *m* array of fits returned by the correction.
+
+		:param numpy.ndarray fits: Dense fits, single or double precision
+		:param numpy.ndarray runOrder: *n* vector of sample run orders
+		:param numpy.ndarray referenceSamples: *n* element boolean array indicating the reference samples the correction was based on
+		:param numpy.ndarray batchList: *n* vector of correction batches
+		:return: Compact fit reproducing *fits*
+		:rtype: CorrectionFit
+		"""
+		fits = numpy.asarray(fits)
+		if fits.dtype != numpy.float32:
+			fits = fits.astype(float, copy=False)
+		runOrder = numpy.asarray(runOrder, dtype=float)
+		batchList = numpy.asarray(batchList, dtype=float)
+		referenceSamples = numpy.asarray(referenceSamples, dtype=bool)
+
+		batchIndex = numpy.full(runOrder.shape, -1, dtype=int)
+		knots = list()
+		values = list()
+
+		for (i, batch) in enumerate(numpy.unique(batchList[~numpy.isnan(batchList)])):
+			batchMask = batchList == batch
+			batchIndex[batchMask] = i
+
+			QCindex = numpy.where(batchMask & referenceSamples)[0]
+			QCindex = QCindex[numpy.argsort(runOrder[QCindex], kind='stable')]
+
+			knots.append(runOrder[QCindex])
+			values.append(fits[QCindex, :])
+
+		compactFit = cls(runOrder, batchIndex, knots, values, dict(), fits.shape[1])
+
+		# Keep features the knots do not reproduce as they are
+		reproduced = numpy.isclose(compactFit.toArray(), fits, rtol=max(1e-12, 10 * numpy.finfo(fits.dtype).eps), atol=0, equal_nan=True)
+		for feature in numpy.where(~numpy.all(reproduced, axis=0))[0]:
+			compactFit._dense[int(feature)] = fits[:, feature].copy()
+
+		return compactFit
+
+	@classmethod
+	def concatenate(cls, fits):
+		"""
+		Join fits for consecutive blocks of features of the same samples.
+
+		:param list fits: :py:class:`CorrectionFit` instances, all created for the same samples and batches
+		:return: Fit for all features, in the order given
+		:rtype: CorrectionFit
+		:raises ValueError: If the fits are not for the same samples
+		"""
+		first = fits[0]
+
+		for fit in fits[1:]:
+			if not (numpy.array_equal(fit._runOrder, first._runOrder) and numpy.array_equal(fit._batchIndex, first._batchIndex) and (len(fit._knots) == len(first._knots)) and all(numpy.array_equal(a, b) for (a, b) in zip(fit._knots, first._knots))):
+				raise ValueError('Fits must be for the same samples and batches')
+
+		values = [numpy.concatenate([fit._values[i] for fit in fits], axis=1) for i in range(len(first._knots))]
+
+		dense = dict()
+		offset = 0
+		for fit in fits:
+			for (feature, fitted) in fit._dense.items():
+				dense[feature + offset] = fitted
+			offset += fit._noFeatures
+
+		return cls(first._runOrder, first._batchIndex, first._knots, values, dense, offset)
+
+	@property
+	def shape(self):
+		"""Shape of the dense fit, (*n*, *m*)"""
+		return (self._runOrder.shape[0], self._noFeatures)
+
+	@property
+	def ndim(self):
+		return 2
+
+	@property
+	def dtype(self):
+		if self._values:
+			return self._values[0].dtype
+		if self._dense:
+			return next(iter(self._dense.values())).dtype
+		return numpy.dtype(float)
+
+	@property
+	def nbytes(self):
+		"""Bytes used to hold the fit"""
+		return sum(array.nbytes for array in [self._runOrder, self._batchIndex] + self._knots + self._values + list(self._dense.values()))
+
+	def __len__(self):
+		return self.shape[0]
+
+	def toArray(self, features=None):
+		"""
+		Rebuild the dense fit.
+
+		:param features: If ``None`` return all features, otherwise only the columns listed
+		:type features: None or list[int,]
+		:return: *n* × *m* array of fits, or *n* × *k* for *k* features requested
+		:rtype: numpy.ndarray
+		"""
+		if features is None:
+			features = numpy.arange(self._noFeatures)
+
+		return self._evaluate(numpy.arange(self.shape[0]), numpy.asarray(features, dtype=int))
+
+	def __array__(self, dtype=None):
+		if dtype is None:
+			return self.toArray()
+		return self.toArray().astype(dtype)
+
+	def __getitem__(self, key):
+
+		if not isinstance(key, tuple):
+			key = (key, slice(None))
+		if len(key) != 2:
+			raise IndexError('CorrectionFit is two-dimensional')
+
+		rows = numpy.arange(self.shape[0])[key[0]]
+		features = numpy.arange(self._noFeatures)[key[1]]
+
+		# Scalar indices ask for values, otherwise return the compact selection
+		if numpy.ndim(rows) == 0 or numpy.ndim(features) == 0:
+			return self._evaluate(numpy.atleast_1d(rows), numpy.atleast_1d(features))[(0 if numpy.ndim(rows) == 0 else slice(None), 0 if numpy.ndim(features) == 0 else slice(None))]
+
+		return self._select(rows, features)
+
+	def _evaluate(self, rows, features):
+		"""
+		Dense fit for the samples in *rows* and features in *features*.
+		"""
+		fits = numpy.full((rows.shape[0], features.shape[0]), numpy.nan, dtype=self.dtype)
+
+		batchIndex = self._batchIndex[rows]
+		runOrder = self._runOrder[rows]
+
+		for (i, knots) in enumerate(self._knots):
+			batchMask = batchIndex == i
+			if (knots.shape[0] == 0) or not numpy.any(batchMask):
+				continue
+
+			(lower, upper, weight) = _interpolationWeights(knots, runOrder[batchMask])
+			fits[batchMask, :] = _interpolate(self._values[i][:, features], lower, upper, weight.astype(self.dtype))
+
+		for (j, feature) in enumerate(features):
+			if feature in self._dense:
+				fits[:, j] = self._dense[feature][rows]
+
+		return fits
+
+	def _select(self, rows, features):
+		"""
+		New :py:class:`CorrectionFit` holding the samples in *rows* and features in *features*.
+		"""
+		# Drop batches no longer referenced
+		batches = numpy.unique(self._batchIndex[rows])
+		batches = batches[batches >= 0]
+		batchIndex = numpy.searchsorted(batches, self._batchIndex[rows])
+		batchIndex[self._batchIndex[rows] < 0] = -1
+
+		knots = [self._knots[i] for i in batches]
+		values = [self._values[i][:, features] for i in batches]
+		dense = {j: self._dense[feature][rows] for (j, feature) in enumerate(features) if feature in self._dense}
+
+		return CorrectionFit(self._runOrder[rows], batchIndex, knots, values, dense, features.shape[0])
@@ -0,0 +1,95 @@
+"""
+Cache of run-order correction fits, so features fitted once (for instance by the batch correction assessment report) are not refitted by :py:func:`~nPYc.batchAndROCorrection.correctMSdataset`.
+"""
+
+import hashlib
+from collections import OrderedDict
+import numpy
+
+
+class FitCache:
+	"""
+	Least recently used cache of the trend fitted through the reference samples of one feature in one batch.
+
+	Entries are keyed on a hash of the reference sample intensities and run orders, and the fitting parameters, and hold the fitted values at each reference sample. The oldest entries are evicted once the cached values exceed *maxBytes*, set *maxBytes* to 0 to disable caching.
+
+	Fits are only added by callers that will reuse them, such as the batch correction assessment report. Correction looks features up while the cache holds any fits, and only when fitting features one at a time, the vectorised engine does not use the cache. Correction workers inherit the cache of the parent process when forked, but add nothing to it.
+
+	:param int maxBytes: Memory available for cached fits
+	"""
+
+	def __init__(self, maxBytes=2**28):
+
+		self.maxBytes = maxBytes
+		"""Memory available for cached fits, in bytes"""
+
+		self._entries = OrderedDict()
+		self.nbytes = 0
+		"""Memory used by cached fits, in bytes"""
+		self.hits = 0
+		self.misses = 0
+
+	def __len__(self):
+		return len(self._entries)
+
+	@staticmethod
+	def key(QCdata, QCrunOrder, parameters):
+		"""
+		Key for the fit of one feature.
+
+		:param numpy.ndarray QCdata: Intensities of the reference samples, ordered as *QCrunOrder*
+		:param numpy.ndarray QCrunOrder: Run order of the reference samples
+		:param tuple parameters: Fitting parameters, must be hashable by :py:func:`repr`
+		:return: Digest identifying the fit
+		:rtype: bytes
+		"""
+		digest = hashlib.blake2b(digest_size=20)
+		digest.update(numpy.ascontiguousarray(QCdata, dtype=float).tobytes())
+		digest.update(numpy.ascontiguousarray(QCrunOrder, dtype=float).tobytes())
+		digest.update(repr(parameters).encode())
+
+		return digest.digest()
+
+	def get(self, key):
+		"""
+		Cached fit for *key*, or ``None`` if it has not been fitted.
+		"""
+		value = self._entries.get(key)
+
+		if value is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+			self._entries.move_to_end(key)
+
+		return value
+
+	def put(self, key, value):
+		"""
+		Cache the fit *value* under *key*, evicting the least recently used fits if needed.
+		"""
+		if (value.nbytes > self.maxBytes) or (key in self._entries):
+			return
+
+		value = numpy.array(value, dtype=float)
+		value.setflags(write=False)
+
+		self._entries[key] = value
+		self.nbytes += value.nbytes
+
+		while self.nbytes > self.maxBytes:
+			(_, evicted) = self._entries.popitem(last=False)
+			self.nbytes -= evicted.nbytes
+
+	def clear(self):
+		"""
+		Empty the cache.
+		"""
+		self._entries.clear()
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+
+
+fitCache = FitCache()
+"""Cache used by run-order correction"""
@@ -0,0 +1,280 @@
+"""
+Vectorised LOWESS smoothing of many features sharing the same sampling positions.
+
+The local regressions follow the algorithm used by :py:func:`statsmodels.nonparametric.lowess` (tricube neighbourhood weights, local linear fits and bisquare robustifying iterations), but as the neighbourhoods only depend on the run order of the reference samples they are calculated once, and each regression applied to every feature at once. Sums over a neighbourhood are accumulated in the order statsmodels uses, so that where a robustifying iteration hinges on round-off (for instance when most points are fitted exactly, and the median residual is zero) the same trend is found.
+"""
+
+import functools
+import numpy
+
+
+# Number of values in each array of neighbour weights, small enough to stay in cache
+_BLOCKVALUES = 2**14
+
+
+class _LOWESSOperator:
+	"""
+	Precomputed LOWESS neighbourhood weights for a set of sampling positions.
+
+	:param numpy.ndarray x: Positions (run order) of the reference samples, need not be sorted
+	:param float frac: Fraction of the points to consider in each local regression
+	"""
+
+	def __init__(self, x, frac):
+
+		x = numpy.asarray(x, dtype=float)
+
+		self.order = numpy.argsort(x)
+		"""Permutation sorting the positions supplied"""
+		self.x = x[self.order]
+		"""Sorted positions"""
+
+		n = self.x.shape[0]
+		k = int(frac * n + 1e-10)
+		k = min(max(k, 2), n)
+
+		# Each neighbourhood is the band of k points from left, with their tricube weights
+		self._left = numpy.zeros(n, dtype=int)
+		self._tricube = numpy.zeros((n, k))
+
+		left = 0
+		right = k
+		for i in range(n):
+			xval = self.x[i]
+
+			# Slide the window of k nearest neighbours along
+			while (right < n) and (xval > ((self.x[left] + self.x[right]) / 2.0)):
+				left += 1
+				right += 1
+
+			self._left[i] = left
+
+			# Where all neighbours are tied no point carries weight
+			radius = max(xval - self.x[left], self.x[right - 1] - xval)
+			if radius <= 0:
+				continue
+
+			dist = numpy.abs(self.x[left:right] - xval) / radius
+			tricube = 1.0 - dist * dist * dist
+			self._tricube[i] = tricube * tricube * tricube
+
+		# statsmodels fits the first of tied positions, and copies the result to the rest
+		self._firstTied = numpy.searchsorted(self.x, self.x, side='left')
+
+	@property
+	def size(self):
+		"""Number of sampling positions"""
+		return self.x.shape[0]
+
+	def smooth(self, Y, iterations=3):
+		"""
+		Smooth each column of *Y*.
+
+		:param numpy.ndarray Y: *q* × *m* array of values, rows ordered as the positions passed to the constructor
+		:param int iterations: Number of bisquare robustifying iterations
+		:return: *q* × *m* array of smoothed values, with rows ordered by sorted position (see :py:attr:`x`)
+		:rtype: numpy.ndarray
+		"""
+		Y = numpy.asarray(Y, dtype=float)[self.order]
+
+		residualWeights = numpy.ones_like(Y)
+
+		for iteration in range(iterations + 1):
+
+			fitted = self._fit(Y, residualWeights)
+
+			if iteration < iterations:
+				residualWeights = _bisquareWeights(Y, fitted)
+
+		return fitted
+
+	def smoothLeaveOneOut(self, Y, iterations=3):
+		"""
+		Leave-one-out estimates of each column of *Y* at every sampling position.
+
+		The estimate at each position is the local regression through its neighbours with that point excluded, obtained in closed form from the smoothed value and its leverage, :math:`\\hat{y}_{(-i)} = (\\hat{y}_i - h_{ii} y_i) / (1 - h_{ii})`. Where no estimate can be made (a point is its own only support) ``NaN`` is returned.
+
+		:param numpy.ndarray Y: *q* × *m* array of values, rows ordered as the positions passed to the constructor
+		:param int iterations: Number of bisquare robustifying iterations
+		:return: *q* × *m* array of leave-one-out estimates, with rows ordered by sorted position (see :py:attr:`x`)
+		:rtype: numpy.ndarray
+		"""
+		Y = numpy.asarray(Y, dtype=float)[self.order]
+
+		residualWeights = numpy.ones_like(Y)
+
+		for iteration in range(iterations):
+			residualWeights = _bisquareWeights(Y, self._fit(Y, residualWeights))
+
+		(fitted, leverage) = self._fit(Y, residualWeights, leverage=True)
+
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			estimates = (fitted - leverage * Y) / (1 - leverage)
+		estimates[leverage >= 1 - 1e-10] = numpy.nan
+
+		return estimates
+
+	def _fit(self, Y, residualWeights, leverage=False):
+		"""
+		Weighted local linear regression at each sampling position, for all columns of *Y* at once.
+
+		If *leverage* is ``True`` also return the weight of each point in its own fitted value.
+		"""
+		fitted = numpy.empty(Y.shape)
+		hat = numpy.empty(Y.shape)
+
+		# Weights are held for every neighbour at once, so work through blocks of columns that fit in cache
+		width = self._tricube.shape[1]
+		blockSize = max(_BLOCKVALUES // max(self.size, 1), 1)
+		for start in range(0, Y.shape[1], blockSize):
+			block = slice(start, start + blockSize)
+			(fitted[:, block], hat[:, block]) = self._fitBlock(Y[:, block], residualWeights[:, block], leverage)
+
+		if not leverage:
+			return fitted
+
+		return fitted, hat
+
+	def _fitBlock(self, Y, residualWeights, leverage):
+		"""
+		Regressions of :py:meth:`_fit` for a block of columns, as statsmodels calculates them.
+		"""
+		width = self._tricube.shape[1]
+		neighbours = [self._left + offset for offset in range(width)]
+		neighbourX = [self.x[rows, numpy.newaxis] for rows in neighbours]
+
+		weights = [self._tricube[:, offset, numpy.newaxis] * residualWeights[rows, :] for (offset, rows) in enumerate(neighbours)]
+
+		# Regress only where at least two neighbours carry weight
+		noWeights = numpy.zeros(Y.shape, dtype=int)
+		for weight in weights:
+			noWeights += weight > 1e-12
+		regressionFailed = noWeights < 2
+
+		sumWeights = _pairwiseSum(weights.__getitem__, width)
+
+		# Update in place, but in the same order of operations as statsmodels
+		with numpy.errstate(divide='ignore', invalid='ignore'):
+			meanX = numpy.zeros(Y.shape)
+			for (weight, x) in zip(weights, neighbourX):
+				weight /= sumWeights
+				meanX += weight * x
+
+			varX = numpy.zeros(Y.shape)
+			deviations = list()
+			for (weight, x) in zip(weights, neighbourX):
+				deviation = x - meanX
+				deviations.append(deviation)
+				varX += weight * (deviation * deviation)
+			numpy.fmax(varX, 1e-12, out=varX)
+
+			# Fitted values are the neighbours weighted by their projection onto the point being fitted
+			position = self.x[:, numpy.newaxis] - meanX
+			fitted = numpy.zeros(Y.shape)
+			hat = numpy.zeros(Y.shape)
+			for (weight, deviation, rows) in zip(weights, deviations, neighbours):
+				projection = position * deviation
+				projection /= varX
+				projection += 1.0
+				projection *= weight
+				fitted += projection * Y[rows, :]
+				if leverage:
+					isSelf = rows == numpy.arange(self.size)
+					hat[isSelf] = projection[isSelf]
+
+		# Where less than two points carry weight, fall back to the observed value (of the first of tied positions)
+		fitted[regressionFailed] = Y[self._firstTied, :][regressionFailed]
+		hat[regressionFailed] = 1
+
+		return fitted, hat
+
+
+def _pairwiseSum(term, count, start=0):
+	"""
+	Sum of *term(start)* to *term(start + count - 1)*, adding in the order :py:func:`numpy.sum` does along a contiguous axis, so that the result is identical.
+	"""
+	if count < 8:
+		total = 0.0
+		for i in range(start, start + count):
+			total = total + term(i)
+		return total
+
+	elif count <= 128:
+		partial = [term(start + i) for i in range(8)]
+		stop = count - (count % 8)
+		for i in range(8, stop, 8):
+			for j in range(8):
+				partial[j] = partial[j] + term(start + i + j)
+		total = ((partial[0] + partial[1]) + (partial[2] + partial[3])) + ((partial[4] + partial[5]) + (partial[6] + partial[7]))
+		for i in range(stop, count):
+			total = total + term(start + i)
+		return total
+
+	half = count // 2
+	half -= half % 8
+	return _pairwiseSum(term, half, start) + _pairwiseSum(term, count - half, start + half)
+
+
+def _lowessOperator(x, frac):
+	"""
+	:py:class:`_LOWESSOperator` for positions *x* and fraction *frac*, reusing operators built recently for the same arguments.
+	"""
+	return _cachedLOWESSOperator(numpy.ascontiguousarray(x, dtype=float).tobytes(), float(frac))
+
+
+@functools.lru_cache(maxsize=64)
+def _cachedLOWESSOperator(x, frac):
+
+	return _LOWESSOperator(numpy.frombuffer(x, dtype=float), frac)
+
+
+def _bisquareWeights(Y, fitted):
+	"""
+	Bisquare robustness weights from the residuals of each column, scaled by six times the median absolute residual.
+	"""
+	residuals = numpy.abs(Y - fitted)
+	median = numpy.median(residuals, axis=0)
+
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		scaled = numpy.where(median == 0, (residuals > 0).astype(float), residuals / (6.0 * median))
+
+	scaled = numpy.minimum(scaled, 1.0)
+
+	return (1 - scaled ** 2) ** 2
+
+
+def _interpolationWeights(xp, x):
+	"""
+	Indices and weights to linearly interpolate values known at sorted positions *xp* onto *x*, matching the behaviour of :py:func:`numpy.interp` (constant extrapolation beyond the ends).
+
+	:param numpy.ndarray xp: Sorted known positions
+	:param numpy.ndarray x: Positions to interpolate to
+	:return: Tuple of (lower index, upper index, weight of upper value)
+	:rtype: tuple
+	"""
+	xp = numpy.asarray(xp, dtype=float)
+	x = numpy.asarray(x, dtype=float)
+
+	if xp.shape[0] == 1:
+		zeros = numpy.zeros(x.shape, dtype=int)
+		return zeros, zeros, numpy.zeros(x.shape)
+
+	upper = numpy.clip(numpy.searchsorted(xp, x, side='right'), 1, xp.shape[0] - 1)
+	lower = upper - 1
+
+	span = xp[upper] - xp[lower]
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		weight = numpy.where(span > 0, (x - xp[lower]) / span, 0.)
+	weight = numpy.clip(weight, 0., 1.)
+
+	return lower, upper, weight
+
+
+def _interpolate(values, lower, upper, weight):
+	"""
+	Apply weights from :py:func:`_interpolationWeights` to each column of *values*.
+	"""
+	if values.ndim == 1:
+		return values[lower] * (1 - weight) + values[upper] * weight
+
+	return values[lower, :] * (1 - weight)[:, numpy.newaxis] + values[upper, :] * weight[:, numpy.newaxis]
@@ -0,0 +1,108 @@
+"""
+Helpers for running correction tasks on worker processes, and sharing numpy arrays with them without pickling.
+"""
+
+import contextlib
+import multiprocessing
+import numpy
+from multiprocessing import shared_memory
+from ..utilities._internal import _noWorkers
+
+
+class _SharedArray:
+	"""
+	A numpy array backed by a :py:class:`multiprocessing.shared_memory.SharedMemory` block.
+
+	The parent process creates the block and passes :py:attr:`spec` to workers, which call :py:func:`_attachSharedArray` to obtain a view of the same memory. Use as a context manager to ensure the block is released.
+
+	:param tuple shape: Shape of the array
+	:param dtype: numpy dtype of the array
+	"""
+
+	def __init__(self, shape, dtype=float):
+
+		dtype = numpy.dtype(dtype)
+		size = max(int(numpy.prod(shape)) * dtype.itemsize, 1)
+
+		self._shm = shared_memory.SharedMemory(create=True, size=size)
+		self.array = numpy.ndarray(shape, dtype=dtype, buffer=self._shm.buf)
+
+	@classmethod
+	def fromArray(cls, X):
+		"""
+		Allocate a shared block and copy *X* into it.
+
+		:param numpy.ndarray X: Array to share
+		:return: Shared copy of *X*
+		:rtype: _SharedArray
+		"""
+		shared = cls(X.shape, dtype=X.dtype)
+		shared.array[...] = X
+
+		return shared
+
+	@property
+	def spec(self):
+		"""
+		Picklable description of the block, ``(name, shape, dtype)``.
+		"""
+		return (self._shm.name, self.array.shape, self.array.dtype.str)
+
+	def release(self):
+		"""
+		Close and unlink the shared block, views of :py:attr:`array` must not be used afterwards.
+		"""
+		if self._shm is not None:
+			del self.array
+			self._shm.close()
+			self._shm.unlink()
+			self._shm = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.release()
+
+
+def _attachSharedArray(spec):
+	"""
+	Attach to a shared block created by :py:class:`_SharedArray`.
+
+	The returned :py:class:`~multiprocessing.shared_memory.SharedMemory` handle must be kept alive as long as the array is in use, and closed (not unlinked) by the worker once done.
+
+	:param tuple spec: :py:attr:`_SharedArray.spec` of the block
+	:return: Tuple of (shared memory handle, array view)
+	:rtype: tuple
+	"""
+	(name, shape, dtype) = spec
+
+	shm = shared_memory.SharedMemory(name=name)
+	array = numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=shm.buf)
+
+	return shm, array
+
+
+@contextlib.contextmanager
+def _workerPool(nJobs=None, initializer=None, initargs=()):
+	"""
+	Context manager yielding a :py:class:`multiprocessing.pool.Pool` of :py:func:`_noWorkers` processes.
+
+	On leaving the context the pool is closed and joined, so workers have exited (and released any shared blocks they attached) before the parent unlinks them. If an exception is raised the workers are terminated instead.
+
+	:param nJobs: Number of workers, see :py:func:`_noWorkers`
+	:type nJobs: None or int
+	:param initializer: Callable run once in each worker on startup
+	:param tuple initargs: Arguments to *initializer*
+	"""
+	pool = multiprocessing.Pool(processes=_noWorkers(nJobs), initializer=initializer, initargs=initargs)
+
+	try:
+		yield pool
+	except BaseException:
+		pool.terminate()
+		raise
+	else:
+		pool.close()
+	finally:
+		pool.join()
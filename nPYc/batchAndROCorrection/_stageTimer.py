@@ -0,0 +1,122 @@
+"""
+Timing of the stages of run-order correction, reported by :py:func:`~nPYc.batchAndROCorrection.correctMSdataset`.
+"""
+
+import contextlib
+import sys
+import time
+from collections import OrderedDict
+
+try:
+	import resource
+except ImportError:
+	# Not available on Windows
+	resource = None
+
+
+class _StageTimer:
+	"""
+	Accumulate the wall time spent in named stages of the correction.
+
+	Stages may be entered many times (for instance once per feature), and their times are summed. Worker processes return the times they record with :py:meth:`drain`, to be added to :py:attr:`workerStages` in the parent with :py:meth:`addWorker`.
+	"""
+
+	def __init__(self):
+
+		self.reset()
+
+	def reset(self):
+		"""
+		Forget all times recorded.
+		"""
+		self.stages = OrderedDict()
+		"""Seconds spent in each stage in this process"""
+		self.workerStages = OrderedDict()
+		"""Seconds spent in each stage, summed over worker processes"""
+		self.workers = OrderedDict()
+		"""Tasks, features and seconds spent correcting them for each worker process, keyed by process id"""
+
+	@contextlib.contextmanager
+	def stage(self, name):
+		"""
+		Context manager adding the time spent in its body to stage *name*.
+		"""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name, time.perf_counter() - start)
+
+	def add(self, name, seconds):
+
+		self.stages[name] = self.stages.get(name, 0.) + seconds
+
+	def drain(self):
+		"""
+		Return and forget the stage times recorded in this process.
+		"""
+		(stages, self.stages) = (self.stages, OrderedDict())
+
+		return stages
+
+	def addWorker(self, pid, noFeatures, seconds, stages):
+		"""
+		Add a task of *noFeatures* features, completed by worker *pid* in *seconds*, and the stage times it recorded.
+		"""
+		worker = self.workers.setdefault(pid, {'tasks': 0, 'features': 0, 'seconds': 0.})
+		worker['tasks'] += 1
+		worker['features'] += noFeatures
+		worker['seconds'] += seconds
+
+		for (name, stageSeconds) in stages.items():
+			self.workerStages[name] = self.workerStages.get(name, 0.) + stageSeconds
+
+	def summary(self, noSamples, noFeatures, seconds):
+		"""
+		Machine-readable summary of the times recorded for the correction of a *noSamples* × *noFeatures* dataset taking *seconds*.
+
+		Worker throughput counts each feature once for every batch it was corrected in.
+
+		:return: Dictionary of stage times, worker throughput and peak memory
+		:rtype: dict
+		"""
+		from .. import __version__
+
+		(peakMemory, peakWorkerMemory) = _peakMemory()
+
+		workers = list()
+		for (pid, worker) in self.workers.items():
+			workers.append({'pid': pid,
+							'tasks': worker['tasks'],
+							'features': worker['features'],
+							'seconds': worker['seconds'],
+							'featuresPerSecond': worker['features'] / worker['seconds'] if worker['seconds'] > 0 else None})
+
+		return {'version': __version__,
+				'samples': noSamples,
+				'features': noFeatures,
+				'seconds': seconds,
+				'featuresPerSecond': noFeatures / seconds if seconds > 0 else None,
+				'stages': dict(self.stages),
+				'workerStages': dict(self.workerStages),
+				'workers': workers,
+				'peakMemory': peakMemory,
+				'peakWorkerMemory': peakWorkerMemory}
+
+
+def _peakMemory():
+	"""
+	Peak resident memory of this process, and of the largest of its finished worker processes, in bytes, or ``None`` where this cannot be measured.
+	"""
+	if resource is None:
+		return (None, None)
+
+	# ru_maxrss is in bytes on macOS, kilobytes elsewhere
+	scale = 1 if sys.platform == 'darwin' else 1024
+
+	return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+			resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+stageTimer = _StageTimer()
+"""Times recorded by the current correction"""
@@ -12,11 +12,14 @@ import numbers
 from datetime import datetime, timedelta
 import logging
 import copy
-import networkx
+import hashlib
+import weakref
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
 from .._toolboxPath import toolboxPath
 from ._dataset import Dataset
 from ..utilities import rsd
-from ..utilities._internal import _vcorrcoef
+from ..utilities._internal import _vcorrcoef, _vcorrcoefSubsets, _vcorrcoefResampled, _blockSize, _BLOCKVALUES
 from ..utilities.extractParams import extractParams
 from ..enumerations import VariableType, DatasetLevel, AssayRole, SampleType
 from ..utilities import removeTrailingColumnNumbering
@@ -75,6 +78,10 @@ class MSDataset(Dataset):
 			pass
 		self._tempArtifactualLinkageMatrix = pandas.DataFrame(None)
 		self._artifactualLinkageMatrix = pandas.DataFrame(None)
+		self._artifactualCandidateEdges = pandas.DataFrame(None)
+		self._artifactualCandidateKey = None
+		self._artifactualMeanIntensity = None
+		self._statisticsCache = dict()
 		self.Attributes['Raw Data Path'] = None
 		self.Attributes['Feature Names'] = 'Feature Name'
 		self.filePath, fileName = os.path.split(datapath)
@@ -87,6 +94,7 @@ class MSDataset(Dataset):
 											 'correlationToDilutionFilter': False,
 											 'artifactualFilter': False, 'blankFilter': False}
 		self.Attributes['filterParameters'] = {'rsdThreshold': None, 'corrMethod': None, 'corrThreshold': None,
+											   'corrConfidence': None, 'corrPValue': None,
 											   'varianceRatio': None, 'blankThreshold': None,
 											   'overlapThresholdArtifactual': None, 'corrThresholdArtifactual': None,
 											   'deltaMzArtifactual': None}
@@ -179,9 +187,29 @@ class MSDataset(Dataset):
 				setattr(result, k, copy.deepcopy(v, memo))
 		result._tempArtifactualLinkageMatrix = pandas.DataFrame(None)
 		result._artifactualLinkageMatrix = pandas.DataFrame(None)
+		result._artifactualCandidateEdges = pandas.DataFrame(None)
+		result._artifactualCandidateKey = None
+		result._artifactualMeanIntensity = None
+		result._statisticsCache = dict()
 
 		return (result)
 
+	# Cached statistics and artifactual candidates hold weak references to the intensity data, so are recalculated after unpickling
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		for cache in ('_artifactualCandidateEdges', '_artifactualCandidateKey', '_artifactualMeanIntensity', '_statisticsCache'):
+			state.pop(cache, None)
+
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		# Datasets pickled by earlier versions may also lack the caches
+		self._artifactualCandidateEdges = pandas.DataFrame(None)
+		self._artifactualCandidateKey = None
+		self._artifactualMeanIntensity = None
+		self._statisticsCache = dict()
+
 	@property
 	def correlationToDilution(self):
 		"""
@@ -202,28 +230,104 @@ class MSDataset(Dataset):
 			print('No StudyPool samples defined with AssayRole equal to LinearityReference')
 		else:
 
-			if not self._correlationToDilution.any():
-
-				self._correlationToDilution = self.__correlateToDilution(method=self.Attributes['corrMethod'],
-																		 exclusions=self.corrExclusions)
-
-				self.__corrMethod = self.Attributes['corrMethod']
-				self.__corrExclusions = self.corrExclusions
-
-			elif (self.__corrMethod != self.Attributes['corrMethod']) | (
-					numpy.array_equal(self.__corrExclusions, self.corrExclusions) == False):
-
-				self._correlationToDilution = self.__correlateToDilution(method=self.Attributes['corrMethod'],
-																		 exclusions=self.corrExclusions)
+			# Recalculated when the method, exclusions or data change
+			corrMethod = self.Attributes['corrMethod']
+			corrExclusions = copy.deepcopy(self.corrExclusions)
+			self._correlationToDilution = self.__cachedStatistic('correlationToDilution',
+																 (corrMethod, numpy.asarray(corrExclusions, dtype=bool).tobytes()),
+																 lambda: self.__correlateToDilution(method=corrMethod, exclusions=corrExclusions))
 
-				self.__corrMethod = self.Attributes['corrMethod']
-				self.__corrExclusions = copy.deepcopy(self.corrExclusions)
+			self.__corrMethod = corrMethod
+			self.__corrExclusions = corrExclusions
 
 		return self._correlationToDilution
 
 	@correlationToDilution.deleter
 	def correlationToDilution(self):
 		self._correlationToDilution = numpy.array(None)
+		self._statisticsCache.pop('correlationToDilution', None)
+		self._statisticsCache.pop('correlationToDilutionConfidence', None)
+
+	def correlationToDilutionConfidence(self, bootstrap=1000, permutations=1000, confidence=0.95, randomSeed=None, parallelise=True, nJobs=None):
+		"""
+		Returns the uncertainty of the correlation of features to dilution, as bootstrap confidence intervals, permutation *p*-values, or both.
+
+		Correlations are calculated as by :py:attr:`correlationToDilution`, with *Attributes['corrMethod']* and :py:attr:`corrExclusions`. Samples are resampled with replacement, or dilutions permuted, within each 'Dilution Series', and the correlations of each resample averaged over the series. Confidence intervals are the percentiles of the bootstrap correlations, *p*-values the one-sided probability of an average correlation at least that observed were intensities unrelated to dilution.
+
+		Results are cached when *randomSeed* is set.
+
+		:param int bootstrap: Number of bootstrap resamples, if 0 do not calculate confidence intervals
+		:param int permutations: Number of permutations, if 0 do not calculate *p*-values
+		:param float confidence: Width of the confidence intervals, between 0 and 1
+		:param randomSeed: Seed of the random resamples, if ``None`` draw a new seed
+		:type randomSeed: None or int
+		:param bool parallelise: If ``True`` calculate blocks of features in parallel threads
+		:param nJobs: Number of threads when *parallelise* is ``True``, by default the number of CPU cores
+		:type nJobs: None or int
+		:return: Table of the 'correlationToDilution' of each feature, and its 'correlationToDilutionLower' and 'correlationToDilutionUpper' confidence limits and 'correlationToDilutionPValue' where calculated
+		:rtype: pandas.DataFrame
+		:raises TypeError: if *bootstrap* or *permutations* are not integers
+		:raises ValueError: if *bootstrap* or *permutations* are negative, or *confidence* is not between 0 and 1
+		"""
+		for (name, value) in [('bootstrap', bootstrap), ('permutations', permutations)]:
+			if not isinstance(value, numbers.Integral):
+				raise TypeError('%s must be an integer, %s provided' % (name, type(value)))
+			elif value < 0:
+				raise ValueError('%s must be zero or a positive integer, %i provided' % (name, value))
+		if not isinstance(confidence, numbers.Number):
+			raise TypeError('confidence must be a number in the range 0 to 1, %s provided' % (type(confidence)))
+		elif (confidence <= 0) or (confidence >= 1):
+			raise ValueError('confidence must be a number in the range 0 to 1, %f provided' % (confidence))
+
+		if self.corrExclusions is None:
+			self.corrExclusions = copy.deepcopy(self.sampleMask)
+			self.__corrExclusions = copy.deepcopy(self.corrExclusions)
+
+		columns = {'correlation': 'correlationToDilution', 'lower': 'correlationToDilutionLower',
+				   'upper': 'correlationToDilutionUpper', 'pValue': 'correlationToDilutionPValue'}
+
+		lrMask = numpy.logical_and(self.sampleMetadata['SampleType'] == SampleType.StudyPool,
+								   self.sampleMetadata['AssayRole'] == AssayRole.LinearityReference)
+
+		if sum(lrMask) == 0:
+			# As correlationToDilution, pass all features
+			print('No StudyPool samples defined with AssayRole equal to LinearityReference')
+			values = {'correlation': numpy.ones(self.noFeatures)}
+			if bootstrap > 0:
+				values['lower'] = numpy.ones(self.noFeatures)
+				values['upper'] = numpy.ones(self.noFeatures)
+			if permutations > 0:
+				values['pValue'] = numpy.zeros(self.noFeatures)
+		else:
+			corrMethod = self.Attributes['corrMethod']
+			corrExclusions = copy.deepcopy(self.corrExclusions)
+
+			def calculate():
+				lrMasks = self.__dilutionSeriesMasks(method=corrMethod, exclusions=corrExclusions)
+
+				self.Attributes['Log'].append([datetime.now(),
+											   'Feature correlation to dilution confidence calculated with : method(%s); exclusions(%s); bootstrap(%i); permutations(%i); confidence(%s); randomSeed(%s)' % (
+											   corrMethod, corrExclusions, bootstrap, permutations, confidence, randomSeed)])
+
+				return _vcorrcoefResampled(self._intensityData,
+										   self.sampleMetadata['Dilution'].values,
+										   lrMasks,
+										   method=corrMethod,
+										   bootstrap=bootstrap,
+										   permutations=permutations,
+										   confidence=confidence,
+										   randomSeed=randomSeed,
+										   parallelise=parallelise,
+										   nJobs=nJobs)
+
+			if randomSeed is None:
+				values = calculate()
+			else:
+				values = self.__cachedStatistic('correlationToDilutionConfidence',
+												(corrMethod, numpy.asarray(corrExclusions, dtype=bool).tobytes(), bootstrap, permutations, confidence, randomSeed),
+												calculate)
+
+		return pandas.DataFrame({columns[key]: value for (key, value) in values.items()}, index=self.featureMetadata.index)
 
 	@property
 	def artifactualLinkageMatrix(self):
@@ -237,6 +341,9 @@ class MSDataset(Dataset):
 	def artifactualLinkageMatrix(self):
 		self._artifactualLinkageMatrix = pandas.DataFrame(None)
 		self._tempArtifactualLinkageMatrix = pandas.DataFrame(None)
+		self._artifactualCandidateEdges = pandas.DataFrame(None)
+		self._artifactualCandidateKey = None
+		self._artifactualMeanIntensity = None
 
 	@property
 	def rsdSP(self):
@@ -252,10 +359,7 @@ class MSDataset(Dataset):
 		if not sum(self.sampleMetadata['AssayRole'].values == AssayRole.PrecisionReference) > 1:
 			raise ValueError('More than one precision reference is required to calculate RSDs.')
 
-		mask = numpy.logical_and(self.sampleMetadata['AssayRole'].values == AssayRole.PrecisionReference,
-								 self.sampleMetadata['SampleType'].values == SampleType.StudyPool)
-
-		return rsd(self._intensityData[mask & self.sampleMask])
+		return self.__rsd(AssayRole.PrecisionReference, SampleType.StudyPool)
 
 	@property
 	def rsdSS(self):
@@ -271,32 +375,100 @@ class MSDataset(Dataset):
 		if not sum(self.sampleMetadata['AssayRole'].values == AssayRole.Assay) > 1:
 			raise ValueError('More than one assay sample is required to calculate RSDs.')
 
-		mask = numpy.logical_and(self.sampleMetadata['AssayRole'].values == AssayRole.Assay,
-								 self.sampleMetadata['SampleType'].values == SampleType.StudySample)
+		return self.__rsd(AssayRole.Assay, SampleType.StudySample)
+
+	def __rsd(self, assayRole, sampleType):
+		"""
+		Percentage :term:`RSD<RSD>` of each feature in the samples of *assayRole* and *sampleType* included by :py:attr:`~Dataset.sampleMask`, see :py:meth:`__cachedStatistic`.
+		"""
+		def calculate():
+			mask = numpy.logical_and(self.sampleMetadata['AssayRole'].values == assayRole,
+									 self.sampleMetadata['SampleType'].values == sampleType)
+
+			return rsd(self._intensityData[mask & self.sampleMask])
+
+		return self.__cachedStatistic('rsd', (assayRole, sampleType), calculate)
+
+	def _blankFilter(self, threshold):
+		"""
+		Features above the blank *threshold*, with the blank level and ratio of each feature, as by :py:func:`~nPYc.utilities._filters.blankFilter`, see :py:meth:`__cachedStatistic`.
+
+		:param float threshold: Multiple of the blank level feature intensities must exceed
+		:return: Tuple of (boolean mask of features passing, blank level, ratio of the blank level to the mean intensity in study samples), NaN levels if there are no blanks
+		:rtype: tuple
+		"""
+		def calculate():
+			filtered = blankFilter(self, threshold=threshold, withRatio=True)
+			if not isinstance(filtered, tuple):
+				# No blanks to filter on
+				filtered = (filtered, numpy.full(self.noFeatures, numpy.nan), numpy.full(self.noFeatures, numpy.nan))
+			return filtered
+
+		return self.__cachedStatistic('blankFilter', (threshold,), calculate)
+
+	def __statisticsVersion(self):
+		"""
+		Digest of the sample mask, normalisation, and the sample roles, dilutions and dilution series the cached QC statistics depend on.
+		"""
+		digest = hashlib.blake2b(digest_size=20)
+		digest.update(numpy.asarray(self.sampleMask, dtype=bool).tobytes())
+		digest.update(str(self.Normalisation).encode())
+
+		columns = [column for column in ['AssayRole', 'SampleType', 'Dilution', 'Dilution Series'] if column in self.sampleMetadata.columns]
+		digest.update(repr(columns).encode())
+		if columns:
+			digest.update(pandas.util.hash_pandas_object(self.sampleMetadata[columns], index=False).values.tobytes())
+
+		return digest.digest()
+
+	def __cachedStatistic(self, name, parameters, function):
+		"""
+		Return the QC statistic *name* calculated by *function* for *parameters*, calculating it only if the data have changed since it was last requested.
+
+		Statistics are kept until :py:attr:`~Dataset.intensityData` is replaced, or :py:attr:`~Dataset.Normalisation`, :py:attr:`~Dataset.sampleMask` or the sample roles, dilutions or dilution series in :py:attr:`~Dataset.sampleMetadata` change. Changes made to the intensity data in place are not detected.
+
+		:param str name: Name of the statistic
+		:param tuple parameters: Hashable parameters the statistic is calculated with, one value is cached for each
+		:param function: Callable taking no arguments returning the statistic
+		:return: Copy of the statistic
+		"""
+		version = self.__statisticsVersion()
+
+		cached = self._statisticsCache.get(name)
+		if (cached is None) or (cached['intensityData']() is not self._intensityData) or (cached['Normalisation'] is not self.Normalisation) or (cached['version'] != version):
+			cached = {'intensityData': weakref.ref(self._intensityData), 'Normalisation': self.Normalisation, 'version': version, 'values': dict()}
+			self._statisticsCache[name] = cached
+
+		if parameters not in cached['values']:
+			cached['values'][parameters] = function()
 
-		return rsd(self._intensityData[mask & self.sampleMask])
+		return copy.deepcopy(cached['values'][parameters])
 
 	def applyMasks(self):
 		"""
 		Permanently delete elements masked (those set to ``False``) in :py:attr:`~Dataset.sampleMask` and :py:attr:`~Dataset.featureMask`, from :py:attr:`~Dataset.featureMetadata`, :py:attr:`~Dataset.sampleMetadata`, and :py:attr:`~Dataset.intensityData`.
 
-		Resets feature linkage matrix and feature correlations.
+		Re-indexes the artifactual candidate pairs to the remaining features, updates the feature linkage matrix and resets feature correlations.
 		"""
 		changeFeature = sum(self.featureMask == False) != 0  # True if featuresMask has a feature set to False
+		changeSample = sum(self.sampleMask == False) != 0  # True if sampleMask has a sample set to False
+		featureIndex = self.featureMetadata.index
+		featureMask = numpy.array(self.featureMask, dtype=bool)
+		sampleMask = numpy.array(self.sampleMask, dtype=bool)
+		# Features the artifactual candidate pairs must have been found for to be carried over
+		featureKey = self.__artifactualFeatureKey() if (changeFeature and self._artifactualCandidateKey is not None) else None
 
 		if changeFeature:
 			if hasattr(self, 'fit'):
 				self.fit = self.fit[:, self.featureMask]
 
-		# if a change is made to the features, the whole artifactualLinkageMatrix must be updated (feature IDs change), else only correlation calculation
+		# if a change is made to the features, the artifactual candidate pairs are re-indexed (feature IDs change), if samples change their correlations are recalculated
 		super().applyMasks()  # applyMasks
+		if changeFeature:
+			self.__reindexArtifactualCandidates(featureIndex, featureMask, sampleMask, featureKey)
 		if self.Attributes['featureFilters']['artifactualFilter'] == True:
 			if not self._artifactualLinkageMatrix.empty:
-				if changeFeature:
-					self._artifactualLinkageMatrix = self.__generateArtifactualLinkageMatrix()  # change features, recalculate all
-				else:
-					self._artifactualLinkageMatrix = self.__generateArtifactualLinkageMatrix(
-						corrOnly=True)  # change samples, recalculate correlation only
+				self._artifactualLinkageMatrix = self.__generateArtifactualLinkageMatrix(corrOnly=changeSample)
 		# Reset correlations
 		del self.correlationToDilution
 
@@ -333,6 +505,13 @@ class MSDataset(Dataset):
 		:type corrThresholdArtifactual: None or float
 		:param blankThreshold: Mask features thats median intesity falls below *blankThreshold x the level in the blank*. If ``False`` do not filter, if ``None`` use the cutoff from *Attributes['blankThreshold']*, otherwise us the cutoff scaling factor provided
 		:type blankThreshold: None, False, or float
+		:param corrConfidence: If not ``None``, also mask features where the lower limit of the *corrConfidence* bootstrap confidence interval of the correlation to dilution is below *corrThreshold*, see :py:meth:`correlationToDilutionConfidence`
+		:type corrConfidence: None or float
+		:param corrPValue: If not ``None``, also mask features where the permutation *p*-value of the correlation to dilution is above *corrPValue*
+		:type corrPValue: None or float
+		:param int corrResamples: Number of bootstrap resamples and permutations for *corrConfidence* and *corrPValue*
+		:param corrRandomSeed: Seed of the resamples for *corrConfidence* and *corrPValue*
+		:type corrRandomSeed: None or int
 		"""
 
 		if any([type(x) is not bool for x in featureFilters.values()]):
@@ -380,6 +559,26 @@ class MSDataset(Dataset):
 		if not isinstance(blankThreshold, numbers.Number):
 			raise TypeError('blankThreshold must be a number, %s provided' % (type(blankThreshold)))
 
+		corrConfidence = kwargs.get('corrConfidence', None)
+		if corrConfidence is not None:
+			if not isinstance(corrConfidence, numbers.Number):
+				raise TypeError('corrConfidence must be a number in the range 0 to 1, %s provided' % (type(corrConfidence)))
+			elif (corrConfidence <= 0) or (corrConfidence >= 1):
+				raise ValueError('corrConfidence must be a number in the range 0 to 1, %f provided' % (corrConfidence))
+
+		corrPValue = kwargs.get('corrPValue', None)
+		if corrPValue is not None:
+			if not isinstance(corrPValue, numbers.Number):
+				raise TypeError('corrPValue must be a number in the range 0 to 1, %s provided' % (type(corrPValue)))
+			elif (corrPValue <= 0) or (corrPValue > 1):
+				raise ValueError('corrPValue must be a number in the range 0 to 1, %f provided' % (corrPValue))
+
+		corrResamples = kwargs.get('corrResamples', 1000)
+		if not isinstance(corrResamples, numbers.Integral):
+			raise TypeError('corrResamples must be an integer, %s provided' % (type(corrResamples)))
+		elif corrResamples < 1:
+			raise ValueError('corrResamples must be a positive integer, %i provided' % (corrResamples))
+
 		if featureFilters['artifactualFilter'] is True:
 			if 'deltaMzArtifactual' in kwargs.keys():
 				deltaMzArtifactual = kwargs['deltaMzArtifactual']
@@ -420,6 +619,7 @@ class MSDataset(Dataset):
 												 'correlationToDilutionFilter': False,
 												 'artifactualFilter': False, 'blankFilter': False}
 			self.Attributes['filterParameters'] = {'rsdThreshold': None, 'corrMethod': None, 'corrThreshold': None,
+												   'corrConfidence': None, 'corrPValue': None,
 												   'varianceRatio': None, 'blankThreshold': None,
 												   'overlapThresholdArtifactual': None,
 												   'corrThresholdArtifactual': None,
@@ -429,46 +629,62 @@ class MSDataset(Dataset):
 			featureMask = numpy.copy(~self.featureMetadata['User Excluded'].values)
 
 			if featureFilters['rsdFilter'] is True:
-				self.featureMetadata['rsdFilter'] = (self.rsdSP <= rsdThreshold)
+				rsdSP = self.rsdSP
+				self.featureMetadata['rsdFilter'] = (rsdSP <= rsdThreshold)
 				featureMask &= self.featureMetadata['rsdFilter'].values
-				self.featureMetadata['rsdSP'] = self.rsdSP
+				self.featureMetadata['rsdSP'] = rsdSP
 
 				self.Attributes['featureFilters']['rsdFilter'] = True
 				self.Attributes['filterParameters']['rsdThreshold'] = rsdThreshold
 
 			if featureFilters['varianceRatioFilter'] is True:
-				mask = numpy.logical_and(self.sampleMetadata['AssayRole'].values == AssayRole.Assay,
-										 self.sampleMetadata['SampleType'].values == SampleType.StudySample)
-
-				mask = numpy.logical_and(mask, self.sampleMask)
+				rsdSP = self.rsdSP
+				rsdSS = self.__rsd(AssayRole.Assay, SampleType.StudySample)
 
-				rsdSS = rsd(self._intensityData[mask, :])
-
-				self.featureMetadata['varianceRatioFilter'] = ((self.rsdSP * varianceRatio) <= rsdSS)
-				self.featureMetadata['rsdSS/rsdSP'] = rsdSS / self.rsdSP
+				self.featureMetadata['varianceRatioFilter'] = ((rsdSP * varianceRatio) <= rsdSS)
+				self.featureMetadata['rsdSS/rsdSP'] = rsdSS / rsdSP
 				featureMask &= self.featureMetadata['varianceRatioFilter'].values
 				self.Attributes['featureFilters']['varianceRatioFilter'] = True
 				self.Attributes['filterParameters']['varianceRatio'] = varianceRatio
 
 			if featureFilters['correlationToDilutionFilter'] is True:
+				correlationToDilution = self.correlationToDilution
 				self.featureMetadata['correlationToDilutionFilter'] = (
-							self.correlationToDilution >= correlationThreshold)
-				self.featureMetadata['correlationToDilution'] = self.correlationToDilution
+							correlationToDilution >= correlationThreshold)
+				self.featureMetadata['correlationToDilution'] = correlationToDilution
+
+				# Bootstrap and permutation confidence in the correlations
+				if (corrConfidence is not None) or (corrPValue is not None):
+					correlationConfidence = self.correlationToDilutionConfidence(bootstrap=corrResamples if corrConfidence is not None else 0,
+																				 permutations=corrResamples if corrPValue is not None else 0,
+																				 confidence=corrConfidence if corrConfidence is not None else 0.95,
+																				 randomSeed=kwargs.get('corrRandomSeed', None))
+					for column in correlationConfidence.columns.drop('correlationToDilution'):
+						self.featureMetadata[column] = correlationConfidence[column].values
+
+					if corrConfidence is not None:
+						self.featureMetadata['correlationToDilutionFilter'] &= (correlationConfidence['correlationToDilutionLower'].values >= correlationThreshold)
+					if corrPValue is not None:
+						self.featureMetadata['correlationToDilutionFilter'] &= (correlationConfidence['correlationToDilutionPValue'].values <= corrPValue)
 
 				featureMask &= self.featureMetadata['correlationToDilutionFilter'].values
 
 				self.Attributes['featureFilters']['correlationToDilutionFilter'] = True
 				self.Attributes['filterParameters']['corThreshold'] = correlationThreshold
 				self.Attributes['filterParameters']['corrMethod'] = self.Attributes['corrMethod']
+				self.Attributes['filterParameters']['corrConfidence'] = corrConfidence
+				self.Attributes['filterParameters']['corrPValue'] = corrPValue
 
 			# Save for reporting
 			if (featureFilters['blankFilter'] is True) & (
 					sum(self.sampleMetadata['SampleType'] == SampleType.ProceduralBlank) >= 2):
-				blankMask, blankValue = blankFilter(self, threshold=blankThreshold)
+				blankMask, blankValue, blankRatio = self._blankFilter(blankThreshold)
 
 				featureMask &= numpy.logical_and(featureMask, blankMask)
 				self.featureMetadata['blankValue'] = blankValue
+				self.featureMetadata['blankRatio'] = blankRatio
 				self.Attributes['featureFilters']['blankFilter'] = True
+				self.Attributes['filterParameters']['blankThreshold'] = blankThreshold
 				self.featureMetadata['blankFilter'] = blankMask
 			# self.Attributes['blankThreshold'] = blankThreshold
 
@@ -1476,15 +1692,17 @@ class MSDataset(Dataset):
 
 		self.sampleMetadata.loc[:, 'Correction Batch'] = newBatch
 
-	def __correlateToDilution(self, method='pearson', sampleType=SampleType.StudyPool,
+	def __dilutionSeriesMasks(self, method='pearson', sampleType=SampleType.StudyPool,
 							  assayRole=AssayRole.LinearityReference, exclusions=True):
 		"""
-		Calculates correlation of feature intesities to dilution.
+		Masks of the samples in each dilution series correlations to dilution are calculated on.
 
-		If a 'Dilution Series' column is present in sampleMetadata, correlation are calcualted on each sub-series, then averaged, otherwise they are
+		If a 'Dilution Series' column is present in sampleMetadata, one mask is returned for each sub-series, otherwise a single mask of all *sampleType* samples with an AssayRole of *assayRole*.
 
 		:params str method: 'pearson' or 'spearman'
 		:params list exclusion: list of Linarity Reference sample subsets to mask from correlation calculation
+		:return: List of boolean sample masks
+		:rtype: list
 		"""
 
 		# Check inputs
@@ -1505,32 +1723,42 @@ class MSDataset(Dataset):
 			if sum(lrMask) == 0:
 				raise ValueError('No %s samples defined with an AssayRole of %s' % (sampleType, assayRole))
 
+			return [numpy.asarray(lrMask, dtype=bool)]
+
+		##
+		# If sub-series are defined, calcuate corrs for each then average
+		##
+		batches = self.sampleMetadata['Dilution Series'].unique()
+		mask = pandas.notnull(batches)
+		batches = batches[mask]
+
+		return [numpy.logical_and(self.sampleMetadata['Dilution Series'].values == batch, exclusions) for batch in batches]
+
+	def __correlateToDilution(self, method='pearson', sampleType=SampleType.StudyPool,
+							  assayRole=AssayRole.LinearityReference, exclusions=True):
+		"""
+		Calculates correlation of feature intesities to dilution.
+
+		If a 'Dilution Series' column is present in sampleMetadata, correlation are calcualted on each sub-series, then averaged, otherwise they are
+
+		:params str method: 'pearson' or 'spearman'
+		:params list exclusion: list of Linarity Reference sample subsets to mask from correlation calculation
+		"""
+
+		lrMasks = self.__dilutionSeriesMasks(method=method, sampleType=sampleType, assayRole=assayRole, exclusions=exclusions)
+
+		if not 'Dilution Series' in self.sampleMetadata.columns:
 			returnValues = _vcorrcoef(self._intensityData,
 									  self.sampleMetadata['Dilution'].values,
 									  method=method,
-									  sampleMask=lrMask)
+									  sampleMask=lrMasks[0])
 
 		else:
-			##
-			# If sub-series are defined, calcuate corrs for each then average
-			##
-			batches = self.sampleMetadata['Dilution Series'].unique()
-			mask = pandas.notnull(batches)
-			batches = batches[mask]
-
-			correlations = numpy.zeros((len(batches), self.noFeatures))
-			index = 0
-			for batch in batches:
-				lrMask = self.sampleMetadata['Dilution Series'].values == batch
-				lrMask = numpy.logical_and(lrMask,
-										   exclusions)
-
-				correlations[index, :] = _vcorrcoef(self._intensityData,
-													self.sampleMetadata['Dilution'].values,
-													method=method,
-													sampleMask=lrMask)
-
-				index += 1
+			# All series in one pass
+			correlations = _vcorrcoefSubsets(self._intensityData,
+											 self.sampleMetadata['Dilution'].values,
+											 lrMasks,
+											 method=method)
 
 			returnValues = numpy.mean(correlations, axis=0)
 
@@ -1551,71 +1779,112 @@ class MSDataset(Dataset):
 				deltaCorr				 minimum correlation between two grouped features
 				corrOnly				  recalculate the correlation but not the overlap
 			output:
-				artifactualLinkageMatrix  feature pairs (row)(feature index), feature1-feature2 (col)
+				artifactualLinkageMatrix  feature pairs (row)(feature index), feature1-feature2 and their correlation (col)
 			raise:
 				ValueError if self.Attributes['artifactualFilter'] = False
 				LookupError if the Feature Name, Retention Time, m/z or Peak Width are missing.
 		"""
 
-		def find_similar_peakwidth(featureMetadata, deltaMZ, deltaOverlap):
-			"""Find 'identical' features based on m/z and peakwidth overlap
+		def find_similar_peakwidth(featureMetadata, deltaMZ):
+			"""Find candidate 'identical' features based on m/z and peakwidth overlap
+				Candidate pairs are found by sweeping a window of deltaMZ along the features sorted by m/z, so each feature is only compared to its neighbours in m/z, then tested for peak overlap
 				input:
 					featureMetada   msDataset.featureMetadata
 					deltaMZ		 m/z distance to consider two features identical [ <= ] (same unit as m/z)
-					delta overlap   minimum peak overlap between two grouped features (0-100%)
 				output:
-					pandas.DataFrame listing matched features based on deltaMZ and deltaOverlap
+					pandas.DataFrame listing features within deltaMZ with overlapping peaks, with their m/z distance and peak overlap (0-100%)
 			"""
-
-			def get_match(i, ds, deltaMZ):
-				"""Find identical features for a given variable
-					output:
-						pandas.DataFrames listing the matching features based overlap of peakwidth
-				"""
-				match = (abs(ds.loc[i, 'Retention Time'] - ds.loc[:, 'Retention Time']) <= (
-							ds.loc[i, 'Peak Width'] + ds.loc[:, 'Peak Width']) / 2) & (
-									abs(ds.loc[i, 'm/z'] - ds.loc[:, 'm/z']) <= deltaMZ)  # find match
-				return (pandas.DataFrame(data={'node1': ds.index[i], 'node2': ds.index[match], 'Peak Overlap': ((((
-																															  ds.loc[
-																																  i, 'Peak Width'] +
-																															  ds.loc[
-																																  match, 'Peak Width']) / 2) - abs(
-					ds.loc[i, 'Retention Time'] - ds.loc[match, 'Retention Time'])) / ((ds.loc[i, 'Peak Width'] +
-																						ds.loc[
-																							match, 'Peak Width']) / 2)) * 100}))  # return the matching rows
-
-			# get feature overlap
-			ds = featureMetadata[['Feature Name', 'Retention Time', 'm/z', 'Peak Width']]
-			# By concatenating all the matches once, save ~22% compared to do it at each loop round
-			matches = [get_match(i, ds, deltaMZ) for i in range(ds.shape[0])]  # get a list of matches
-			res = pandas.concat(matches)
-			res = res.loc[res.node1 < res.node2]  # keeps feat1-feat2, removes feat1-feat1 and feat2-feat1
-
-			# filter interactions by overlap
-			res = res.loc[res.loc[:, 'Peak Overlap'] >= deltaOverlap, ['node1', 'node2']]
-			res.reset_index(drop=True, inplace=True)
+			mz = featureMetadata['m/z'].values.astype(float)
+			retentionTime = featureMetadata['Retention Time'].values.astype(float)
+			peakWidth = featureMetadata['Peak Width'].values.astype(float)
+			labels = featureMetadata.index.values
+
+			# Sort by m/z, features without an m/z never match
+			order = numpy.argsort(mz, kind='stable')
+			order = order[~numpy.isnan(mz[order])]
+			sortedMZ = mz[order]
+
+			# Each feature is paired with the features following it in m/z up to deltaMZ away, the window is widened by a few ulp so no pair passing the exact test below is lost to rounding
+			windowEnd = sortedMZ + deltaMZ
+			windowEnd = numpy.searchsorted(sortedMZ, windowEnd + 4 * numpy.spacing(numpy.abs(windowEnd)), side='right')
+			noCandidates = numpy.maximum(windowEnd - numpy.arange(1, len(order) + 1), 0)
+
+			# Generate candidates for blocks of features at a time to bound memory
+			candidateEnd = numpy.cumsum(noCandidates)
+			blockBounds = numpy.searchsorted(candidateEnd, numpy.arange(0, candidateEnd[-1] if len(order) else 0, _BLOCKVALUES), side='right')
+			blockBounds = numpy.unique(numpy.concatenate(([0], blockBounds, [len(order)])))
+
+			node1 = list()
+			node2 = list()
+			mzDistances = list()
+			overlaps = list()
+			for (start, stop) in zip(blockBounds[:-1], blockBounds[1:]):
+				counts = noCandidates[start:stop]
+				first = numpy.repeat(numpy.arange(start, stop), counts)
+				offsets = numpy.arange(first.shape[0]) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+				i = order[first]
+				j = order[first + 1 + offsets]
+
+				# Same tests as comparing every feature to every other
+				halfWidth = (peakWidth[i] + peakWidth[j]) / 2
+				distance = numpy.abs(retentionTime[i] - retentionTime[j])
+				with numpy.errstate(divide='ignore', invalid='ignore'):
+					overlap = ((halfWidth - distance) / halfWidth) * 100
+				mzDistance = numpy.abs(mz[i] - mz[j])
+				match = (mzDistance <= deltaMZ) & (distance <= halfWidth)
+
+				node1.append(i[match])
+				node2.append(j[match])
+				mzDistances.append(mzDistance[match])
+				overlaps.append(overlap[match])
+
+			node1 = numpy.concatenate(node1) if node1 else numpy.array([], dtype=int)
+			node2 = numpy.concatenate(node2) if node2 else numpy.array([], dtype=int)
+			mzDistances = numpy.concatenate(mzDistances) if mzDistances else numpy.array([], dtype=float)
+			overlaps = numpy.concatenate(overlaps) if overlaps else numpy.array([], dtype=float)
+
+			# Keep feat1-feat2, where feat1 has the lower index, listed in order of feature position
+			swap = labels[node1] > labels[node2]
+			(node1[swap], node2[swap]) = (node2[swap], node1[swap])
+			keep = labels[node1] != labels[node2]
+			sortOrder = numpy.where(keep)[0][numpy.lexsort((node2[keep], node1[keep]))]
+
+			res = pandas.DataFrame(data={'node1': labels[node1[sortOrder]], 'node2': labels[node2[sortOrder]],
+										 'm/z Distance': mzDistances[sortOrder], 'Peak Overlap': overlaps[sortOrder]})
 
 			return (res)
 
 		# end find_similar_peakwidth
 
-		def remove_min_corr_overlap(overlappingFeatures, intensityData, corrCutoff):
-			""" Return the overlap match DataFrame with overlap of metabolites correlated < cut-off removed (and correlation added)
+		def overlap_correlation(overlappingFeatures, intensityData):
+			""" Return the correlation of the intensities of each pair of overlapping features
+				Features in a pair are standardised (mean-centred, unit norm) once, and the correlations calculated as dot products of their standardised intensities, for blocks of pairs at a time
 				input:
 					overlappingFeatures pandas.DataFrame as generated by find_similar_peakwidth
-					intensityData	   pandas.DataFrame of data value for each sample (row) / feature (column)
-					corrCutoff		  minimum percentage of overlap (0-1)
+					intensityData	   numpy.ndarray of data value for each sample (row) / feature (column)
 				output:
-					overlapping features filtered
+					numpy.ndarray of the Pearson correlation of each pair, NaN where undefined
 			"""
-			link_corr = numpy.zeros([overlappingFeatures.shape[0]])
-			for jrow in range(0, len(link_corr)):
-				link_corr[jrow] = numpy.corrcoef(intensityData[:, overlappingFeatures.loc[jrow, 'node1']],
-												 intensityData[:, overlappingFeatures.loc[jrow, 'node2']])[0, 1]
+			node1 = overlappingFeatures['node1'].values.astype(int)
+			node2 = overlappingFeatures['node2'].values.astype(int)
+
+			(features, featureIndex) = numpy.unique(numpy.concatenate((node1, node2)), return_inverse=True)
+			(index1, index2) = (featureIndex[:node1.shape[0]], featureIndex[node1.shape[0]:])
 
-			return (overlappingFeatures.loc[link_corr >= corrCutoff,])
+			standardised = numpy.array(intensityData[:, features], dtype=float)
+			standardised -= standardised.mean(axis=0)
+			with numpy.errstate(divide='ignore', invalid='ignore'):
+				standardised /= numpy.sqrt(numpy.sum(standardised ** 2, axis=0))
 
-		# end remove_min_corr_overlap
+			link_corr = numpy.empty(node1.shape[0])
+			blockSize = _blockSize(standardised.shape[0])
+			for blockStart in range(0, node1.shape[0], blockSize):
+				block = slice(blockStart, blockStart + blockSize)
+				link_corr[block] = numpy.einsum('ij,ij->j', standardised[:, index1[block]], standardised[:, index2[block]])
+
+			return (numpy.clip(link_corr, -1, 1))
+
+		# end overlap_correlation
 
 		# check required info in featureMetadata for artifactual filtering. If missing, sets self.Attributes['artifactualFilter'] to False
 		if self.Attributes['featureFilters']['artifactualFilter'] == False:
@@ -1638,18 +1907,80 @@ class MSDataset(Dataset):
 			raise LookupError(
 				'Missing feature metadata \"Peak Width\". Artifactual filtering cannot be run, set MSDataset.Attributes[\'artifactualFilter\'] = \'False\', or use \'updateMasks(withArtifactualFiltering=False)\' and \'generateReport(data, reportType=\'feature selection\', withArtifactualFiltering=False)\'')
 
-		if ((not corrOnly) | (corrOnly & self._tempArtifactualLinkageMatrix.empty)):
-			self._tempArtifactualLinkageMatrix = find_similar_peakwidth(featureMetadata=self.featureMetadata,
-																		deltaMZ=self.Attributes['filterParameters'][
-																			'deltaMzArtifactual'], deltaOverlap=
-																		self.Attributes['filterParameters'][
-																			'overlapThresholdArtifactual'])
-		artifactualLinkageMatrix = remove_min_corr_overlap(self._tempArtifactualLinkageMatrix, self._intensityData,
-														   self.Attributes['filterParameters'][
-															   'corrThresholdArtifactual'])
+		deltaMZ = self.Attributes['filterParameters']['deltaMzArtifactual']
+		deltaOverlap = self.Attributes['filterParameters']['overlapThresholdArtifactual']
+		corrCutoff = self.Attributes['filterParameters']['corrThresholdArtifactual']
+
+		# Candidate pairs, with their m/z distance, peak overlap and correlation, are kept for the widest deltaMZ used so far and any overlap or correlation
+		# Tighter parameters only filter them, new features or a wider deltaMZ find them again, and new samples recalculate the correlations
+		featureKey = self.__artifactualFeatureKey()
+		candidateKey = self._artifactualCandidateKey
+		if (candidateKey is None) or (candidateKey[0] != featureKey) or (candidateKey[1] < deltaMZ):
+			self._artifactualCandidateEdges = find_similar_peakwidth(featureMetadata=self.featureMetadata, deltaMZ=deltaMZ)
+			self._artifactualCandidateEdges['Correlation'] = overlap_correlation(self._artifactualCandidateEdges, self._intensityData)
+			self._artifactualCandidateKey = (featureKey, deltaMZ, weakref.ref(self._intensityData))
+		elif corrOnly or (candidateKey[2]() is not self._intensityData):
+			self._artifactualCandidateEdges['Correlation'] = overlap_correlation(self._artifactualCandidateEdges, self._intensityData)
+			self._artifactualCandidateKey = (featureKey, candidateKey[1], weakref.ref(self._intensityData))
+
+		candidates = self._artifactualCandidateEdges
+		match = (candidates['m/z Distance'].values <= deltaMZ) & (candidates['Peak Overlap'].values >= deltaOverlap)
+		self._tempArtifactualLinkageMatrix = candidates.loc[match, ].reset_index(drop=True)
+		artifactualLinkageMatrix = self._tempArtifactualLinkageMatrix.loc[self._tempArtifactualLinkageMatrix['Correlation'] >= corrCutoff, ]
 
 		return (artifactualLinkageMatrix)
 
+	def __artifactualFeatureKey(self):
+		"""
+		Digest of the feature index, m/z, retention time and peak width, identifying the features artifactual candidate pairs were found for.
+		"""
+		digest = hashlib.blake2b(digest_size=20)
+		digest.update(numpy.ascontiguousarray(self.featureMetadata.index.values).tobytes())
+		for column in ['m/z', 'Retention Time', 'Peak Width']:
+			digest.update(numpy.ascontiguousarray(self.featureMetadata[column].values, dtype=float).tobytes())
+
+		return digest.digest()
+
+	def __reindexArtifactualCandidates(self, featureIndex, featureMask, sampleMask, featureKey):
+		"""
+		Carry the artifactual candidate pairs over the removal of the features and samples masked by :py:meth:`applyMasks`.
+
+		Pairs including a removed feature are dropped and the others re-indexed to the remaining features, which finds the same pairs as a new search. The correlations of the remaining pairs are kept if no samples were removed, otherwise they are recalculated when the linkage matrix is next generated. If the features were edited since the pairs were found, the pairs are dropped, to be searched for again.
+
+		:param pandas.Index featureIndex: Index of :py:attr:`~Dataset.featureMetadata` before the features were removed
+		:param numpy.ndarray featureMask: Feature mask applied (``True`` for features kept)
+		:param numpy.ndarray sampleMask: Sample mask applied (``True`` for samples kept)
+		:param bytes featureKey: :py:meth:`__artifactualFeatureKey` of the features before they were removed
+		"""
+		if self._artifactualCandidateKey is None:
+			return
+
+		# Pairs found for features since edited are stale
+		if self._artifactualCandidateKey[0] != featureKey:
+			self._artifactualCandidateEdges = pandas.DataFrame(None)
+			self._artifactualCandidateKey = None
+			return
+
+		newIndex = numpy.cumsum(featureMask) - 1
+		newIndex[~featureMask] = -1
+
+		candidates = self._artifactualCandidateEdges
+		node1 = newIndex[featureIndex.get_indexer(candidates['node1'].values)]
+		node2 = newIndex[featureIndex.get_indexer(candidates['node2'].values)]
+		kept = (node1 >= 0) & (node2 >= 0)
+
+		# The map preserves feature order, so the pairs stay sorted
+		candidates = candidates.loc[kept, ].reset_index(drop=True)
+		candidates['node1'] = node1[kept]
+		candidates['node2'] = node2[kept]
+		self._artifactualCandidateEdges = candidates
+
+		if numpy.all(sampleMask):
+			intensityData = weakref.ref(self._intensityData)
+		else:
+			intensityData = self._artifactualCandidateKey[2]
+		self._artifactualCandidateKey = (self.__artifactualFeatureKey(), self._artifactualCandidateKey[1], intensityData)
+
 	def updateArtifactualLinkageMatrix(self):
 		self._artifactualLinkageMatrix = self.__generateArtifactualLinkageMatrix()
 		return
@@ -1672,21 +2003,35 @@ class MSDataset(Dataset):
 			newFeatureMask = copy.deepcopy(self.featureMask)
 
 		# remove features in LinkageMatrix previously filtered (in newFeatMask)
-		tmpLinkage = copy.deepcopy(self.artifactualLinkageMatrix)
-		keptPreviousFilter = self.featureMetadata.index[newFeatureMask]  # index of previously kept features
-		tmpLinkage = tmpLinkage[tmpLinkage.node1.isin(keptPreviousFilter) & tmpLinkage.node2.isin(keptPreviousFilter)]
-
-		meanIntensity = self._intensityData.mean(axis=0)
-
-		# make graphs
-		g = networkx.from_pandas_edgelist(df=tmpLinkage, source='node1', target='node2')  # , edge_attr=True)
-		graphs = list((g.subgraph(c).copy() for c in networkx.connected_components(g)))  # a list of clusters
-
-		# update FeatureMask with features to remove (all but max intensity)
-		for i in range(0, len(graphs)):
-			newFeatureMask[list(graphs[i].nodes)] = False  # remove  all nodes in a cluster
-			newFeatureMask[
-				list(graphs[i].nodes)[meanIntensity[list(graphs[i].nodes)].argmax()]] = True  # keep max intensity
+		linkage = self.artifactualLinkageMatrix
+		node1 = self.featureMetadata.index.get_indexer(linkage['node1'].values)
+		node2 = self.featureMetadata.index.get_indexer(linkage['node2'].values)
+		keptPreviousFilter = newFeatureMask[node1] & newFeatureMask[node2]
+		(node1, node2) = (node1[keptPreviousFilter], node2[keptPreviousFilter])
+
+		# Mean intensities are kept until the intensity data is replaced
+		if (self._artifactualMeanIntensity is None) or (self._artifactualMeanIntensity[0]() is not self._intensityData):
+			self._artifactualMeanIntensity = (weakref.ref(self._intensityData), self._intensityData.mean(axis=0))
+		meanIntensity = self._artifactualMeanIntensity[1]
+
+		# label the clusters of linked features
+		noFeatures = newFeatureMask.shape[0]
+		graph = scipy.sparse.coo_matrix((numpy.ones(node1.shape[0], dtype=int), (node1, node2)), shape=(noFeatures, noFeatures))
+		(_, clusters) = connected_components(graph, directed=False)
+
+		linked = numpy.zeros(noFeatures, dtype=bool)
+		linked[node1] = True
+		linked[node2] = True
+		linked = numpy.where(linked)[0]
+
+		# update FeatureMask with features to remove (all but max intensity), sorting each cluster by decreasing intensity, NaN first as argmax and lowest index first on ties
+		intensity = numpy.where(numpy.isnan(meanIntensity[linked]), -numpy.inf, -meanIntensity[linked])
+		order = linked[numpy.lexsort((linked, intensity, clusters[linked]))]
+		keep = numpy.ones(order.shape[0], dtype=bool)
+		keep[1:] = clusters[order[1:]] != clusters[order[:-1]]
+
+		newFeatureMask[linked] = False  # remove  all nodes in a cluster
+		newFeatureMask[order[keep]] = True  # keep max intensity
 
 		return (newFeatureMask)
 
@@ -2472,7 +2817,8 @@ class MSDataset(Dataset):
 							   'sampleMetadataExcluded', 'intensityDataExcluded', 'featureMetadataExcluded',
 							   'excludedFlag',
 							   'corrExclusions', '_correlationToDilution', '_artifactualLinkageMatrix',
-							   '_tempArtifactualLinkageMatrix'})
+							   '_tempArtifactualLinkageMatrix', '_artifactualCandidateEdges', '_artifactualCandidateKey',
+							   '_artifactualMeanIntensity', '_statisticsCache'})
 			objectSet = set(self.__dict__.keys())
 			additionalAttributes = objectSet - expectedSet
 			if len(additionalAttributes) > 0:
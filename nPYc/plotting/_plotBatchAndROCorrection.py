@@ -65,7 +65,6 @@ def plotBatchAndROCorrection(msData, msDatacorrected, featureList, addViolin=Tru
 
 	sortedRO = numpy.argsort(localRO)
 	sortedRO2 = localRO[sortedRO]
-	fitSorted = localFit[sortedRO,:]
 	localBatch = localBatch[sortedRO]
 	
 	batches = (numpy.unique(localBatch[~numpy.isnan(localBatch)])).astype(int)
@@ -162,10 +161,11 @@ def plotBatchAndROCorrection(msData, msDatacorrected, featureList, addViolin=Tru
 			ax.plot_date([pandas.to_datetime(d) for d in msData.sampleMetadata.loc[LRmask, 'Acquired Time']], msData.intensityData[LRmask, feature], c=sTypeColourDict[SampleType.MethodReference], fmt='s', ms=4, alpha=0.9, label='Serial Dilution')
 
 
-		# Plot fit coloured by batch
+		# Plot fit coloured by batch, only rebuilding the fit for this feature
+		fitSorted = localFit[sortedRO, feature]
 		colIX = 1
 		for i in batches:
-			ax.plot([pandas.to_datetime(d) for d in sortedRO2[localBatch==i]], fitSorted[localBatch==i,feature], c=colors[colIX], alpha=0.9, label='Fit for batch ' + str(colIX))
+			ax.plot([pandas.to_datetime(d) for d in sortedRO2[localBatch==i]], fitSorted[localBatch==i], c=colors[colIX], alpha=0.9, label='Fit for batch ' + str(colIX))
 			colIX = colIX + 1
 						
 		# Add sample annotation if required
@@ -10,7 +10,7 @@ import plotly.graph_objs as go
 
 from .. import Dataset, MSDataset, NMRDataset
 from ..enumerations import VariableType, SampleType, AssayRole
-from ..utilities import rsd
+from ..utilities import rsd, groupedStatistics
 from ._plotVariableScatter import plotVariableScatter
 
 
@@ -190,20 +190,15 @@ def _plotRSDsHelper(dataset, featureName='Feature Name', ratio=False, withExclus
 	finiteMask = (rsdVal[SampleType.StudyPool] < numpy.finfo(numpy.float64).max)
 	finiteMask = finiteMask & (rsdVal[SampleType.StudySample] < numpy.finfo(numpy.float64).max)
 
-	for sType in sTypes:
-		if not sTypes == SampleType.StudyPool:
-			sTypeMask = dataset.sampleMetadata.loc[:, 'SampleType'].values == sType
-			# precRefMask limits to Precision Reference and dataset.sampleMask
-			sTypeMask = numpy.logical_and(sTypeMask, precRefMask)
-
-			# minimum 3 points needed
-			if sum(sTypeMask) >= 3:
-				rsdList = rsd(dataset.intensityData[sTypeMask, :])
-				if withExclusions:
-					rsdVal[sType] = rsdList[dataset.featureMask]
-				else:
-					rsdVal[sType] = rsdList
-				finiteMask = finiteMask & (rsdVal[sType] < numpy.finfo(numpy.float64).max)
+	# precRefMask limits to Precision Reference and dataset.sampleMask, minimum 3 points needed
+	statistics = groupedStatistics(dataset, 'SampleType', statistics=['rsd'], sampleMask=precRefMask, minSamples=3, byGroup=True)
+	for (sType, groupStatistics) in statistics.items():
+		rsdList = groupStatistics['rsd']
+		if withExclusions:
+			rsdVal[sType] = rsdList[dataset.featureMask]
+		else:
+			rsdVal[sType] = rsdList
+		finiteMask = finiteMask & (rsdVal[sType] < numpy.finfo(numpy.float64).max)
 
 	## apply finiteMask
 	for sType in rsdVal.keys():
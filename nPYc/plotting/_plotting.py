@@ -5,7 +5,7 @@ import numpy
 import pandas
 from ..objects._msDataset import MSDataset
 from ..utilities import generateLRmask
-from ..utilities._internal import _vcorrcoef 
+from ..utilities._internal import _vcorrcoefSubsets
 from ._violinPlot import _violinPlotHelper
 from ..enumerations import AssayRole, SampleType
 import matplotlib.dates as mdates
@@ -462,13 +462,10 @@ def plotCorrelationToLRbyFeature(msData, featureMask=None, title='', maxNo=5, sa
 	
 	# Generate LRbatchmask (list of all sample LR subsets) and correlation to dilution for each
 	LRbatchmask = generateLRmask(msData)
-	corALL = numpy.zeros([len(LRbatchmask), len(msData.featureMask)])
+	corALL = _vcorrcoefSubsets(msData.intensityData, msData.sampleMetadata['Dilution'].values, list(LRbatchmask.values()), method=msData.Attributes['corrMethod'])
 	corLRbyBatch = {}
-	i = 0
-	for key in LRbatchmask:
-		corALL[i,:] = _vcorrcoef(msData.intensityData, msData.sampleMetadata['Dilution'].values, method=msData.Attributes['corrMethod'], sampleMask = LRbatchmask[key])
+	for (i, key) in enumerate(LRbatchmask):
 		corLRbyBatch[key] = corALL[i,:]
-		i = i+1
 	
 	LRbatchmask['MeanOverall'] = LRmask
 	corLRbyBatch['MeanOverall'] = numpy.mean(corALL, axis=0)	
@@ -2,6 +2,8 @@ import sys
 import os
 import numpy
 import pandas
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
 from collections import OrderedDict
 import matplotlib.pyplot as plt
 from matplotlib.ticker import FuncFormatter
@@ -18,12 +20,11 @@ from pyChemometrics.ChemometricsPCA import ChemometricsPCA
 from ..plotting import plotTIC, histogram, plotLRTIC, jointplotRSDvCorrelation, plotRSDs, plotIonMap, plotBatchAndROCorrection, plotScores, plotLoadings, plotTargetedFeatureDistribution
 from ._generateSampleReport import _generateSampleReport
 from ..utilities import generateLRmask, rsd
-from ..utilities._internal import _vcorrcoef
+from ..utilities._internal import _vcorrcoefSubsets
 from ..utilities._internal import _copyBackingFiles as copyBackingFiles
 from ..enumerations import AssayRole, SampleType
 from ._generateBasicPCAReport import generateBasicPCAReport
 from ..reports._finalReportPeakPantheR import _finalReportPeakPantheR
-from ..utilities._filters import blankFilter
 
 from pandas.plotting import register_matplotlib_converters
 register_matplotlib_converters()
@@ -859,8 +860,9 @@ def _featureSelectionReport(dataset, destinationPath=None, withArtifactualFilter
     if (dataset.Attributes['featureFilters']['blankFilter'] is True) & (sum(Blankmask) >= 2):
         item['BlankThreshold'] = dataset.Attributes['filterParameters']['blankThreshold'] if dataset.Attributes['filterParameters']['blankThreshold'] is not None else dataset.Attributes['blankThreshold']
 
-        blankMask = blankFilter(dataset, item['BlankThreshold'])
-        passMask = numpy.logical_and(passMask, blankMask)[0]
+        # Reuse the filter calculated by updateMasks, unless the data, masks or sample roles have changed since
+        blankMask = dataset._blankFilter(item['BlankThreshold'])[0]
+        passMask = numpy.logical_and(passMask, blankMask)
 
         item['BlankPassed'] = sum(blankMask)
 
@@ -874,46 +876,25 @@ def _featureSelectionReport(dataset, destinationPath=None, withArtifactualFilter
     # Heatmap of the number of features passing selection with different RSD and correlation to dilution thresholds
     rsdVals = numpy.array([5, 10, 15, 20, 25, 30, 35, 40, 45, 50])
     rVals = numpy.array([0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 1])
-    rValsRep = numpy.tile(rVals, [1, len(rsdVals)])
-    rsdValsRep = numpy.reshape(numpy.tile(rsdVals, [len(rVals), 1]), rValsRep.shape, order='F')
 
-    featureNos = numpy.zeros(rValsRep.shape, dtype=numpy.int)
+    heatmapMask = ((dataset.rsdSP * item['rsdSPvsSSvarianceRatio']) <= rsdSS) & (dataset.featureMask == True)
+    # with blankThreshold in heatmap
+    if (dataset.Attributes['featureFilters']['blankFilter'] is True) & (sum(Blankmask) >= 2):
+        heatmapMask &= (blankMask == True)
+
     if withArtifactualFiltering:
-        # with blankThreshold in heatmap
-        if (dataset.Attributes['featureFilters']['blankFilter'] is True) & (sum(Blankmask) >= 2):
-            for rsdNo in range(rValsRep.shape[1]):
-                featureNos[0, rsdNo] = sum(dataset.artifactualFilter(featMask=(
-                            (dataset.correlationToDilution >= rValsRep[0, rsdNo]) & (
-                                dataset.rsdSP <= rsdValsRep[0, rsdNo]) & (
-                                        (dataset.rsdSP * item['rsdSPvsSSvarianceRatio']) <= rsdSS) & (
-                                        dataset.featureMask == True) & (blankMask == True))))
-        # without blankThreshold
-        else:
-            for rsdNo in range(rValsRep.shape[1]):
-                featureNos[0, rsdNo] = sum(dataset.artifactualFilter(featMask=(
-                            (dataset.correlationToDilution >= rValsRep[0, rsdNo]) & (
-                                dataset.rsdSP <= rsdValsRep[0, rsdNo]) & (
-                                        (dataset.rsdSP * item['rsdSPvsSSvarianceRatio']) <= rsdSS) & (
-                                        dataset.featureMask == True))))
+        linkage = dataset.artifactualLinkageMatrix
+        node1 = dataset.featureMetadata.index.get_indexer(linkage['node1'].values)
+        node2 = dataset.featureMetadata.index.get_indexer(linkage['node2'].values)
     else:
-        # with blankThreshold in heatmap
-        if (dataset.Attributes['featureFilters']['blankFilter'] is True) & (sum(Blankmask) >= 2):
-            for rsdNo in range(rValsRep.shape[1]):
-                featureNos[0, rsdNo] = sum(
-                    (dataset.correlationToDilution >= rValsRep[0, rsdNo]) & (dataset.rsdSP <= rsdValsRep[0, rsdNo]) & (
-                                (dataset.rsdSP * item['rsdSPvsSSvarianceRatio']) <= rsdSS) & (
-                                dataset.featureMask == True) & (blankMask == True))
-        # without blankThreshold
-        else:
-            for rsdNo in range(rValsRep.shape[1]):
-                featureNos[0, rsdNo] = sum(
-                    (dataset.correlationToDilution >= rValsRep[0, rsdNo]) & (dataset.rsdSP <= rsdValsRep[0, rsdNo]) & (
-                                (dataset.rsdSP * item['rsdSPvsSSvarianceRatio']) <= rsdSS) & (
-                                dataset.featureMask == True))
+        node1 = None
+        node2 = None
 
-    test = pandas.DataFrame(data=numpy.transpose(numpy.concatenate([rValsRep, rsdValsRep, featureNos])),
-                            columns=['Correlation to dilution', 'RSD', 'nFeatures'])
-    test = test.pivot('Correlation to dilution', 'RSD', 'nFeatures')
+    featureNos = _featureSelectionCounts(dataset.correlationToDilution, dataset.rsdSP, heatmapMask, rVals, rsdVals, node1=node1, node2=node2)
+
+    test = pandas.DataFrame(data=featureNos,
+                            index=pandas.Index(rVals, name='Correlation to dilution'),
+                            columns=pandas.Index(rsdVals, name='RSD'))
 
     fig, ax = plt.subplots(1, figsize=dataset.Attributes['figureSize'], dpi=dataset.Attributes['dpi'])
     sns.heatmap(test, annot=True, fmt='g', cbar=False)
@@ -968,6 +949,68 @@ def _featureSelectionReport(dataset, destinationPath=None, withArtifactualFilter
     return None
 
 
+def _featureSelectionCounts(correlation, rsdSP, featureMask, corrThresholds, rsdThresholds, node1=None, node2=None):
+    """
+    Count the features in *featureMask* passing every combination of correlation to dilution and RSD thresholds in one pass.
+
+    Features are binned by the number of thresholds they pass, and the bins accumulated over both axes. If the linkage between artifactual features is given in *node1* and *node2*, linked features passing a combination are counted once per group, as they would be kept by :py:meth:`~nPYc.objects.MSDataset.artifactualFilter`.
+
+    :param numpy.ndarray correlation: Correlation to dilution of each feature
+    :param numpy.ndarray rsdSP: RSD of each feature in study reference samples
+    :param numpy.ndarray featureMask: Features considered (``True`` for inclusion)
+    :param numpy.ndarray corrThresholds: Minimum correlations to dilution, in increasing order
+    :param numpy.ndarray rsdThresholds: Maximum RSDs, in increasing order
+    :param node1: Positions of the first feature of each pair of linked artifactual features, if ``None`` count features without artifactual filtering
+    :type node1: None or numpy.ndarray
+    :param node2: Positions of the second feature of each pair
+    :type node2: None or numpy.ndarray
+    :return: Number of features passing, with a row for each correlation and a column for each RSD threshold
+    :rtype: numpy.ndarray
+    """
+    featureMask = numpy.asarray(featureMask, dtype=bool) & ~numpy.isnan(correlation) & ~numpy.isnan(rsdSP)
+
+    # Features pass the correlation thresholds below corrBin, and the RSD thresholds from rsdBin on
+    corrBin = numpy.searchsorted(corrThresholds, correlation, side='right')
+    rsdBin = numpy.searchsorted(rsdThresholds, rsdSP, side='left')
+
+    # Linked features are counted separately
+    if node1 is not None:
+        kept = featureMask[node1] & featureMask[node2]
+        (node1, node2) = (node1[kept], node2[kept])
+        (linked, linkedIndex) = numpy.unique(numpy.concatenate((node1, node2)), return_inverse=True)
+    else:
+        linked = numpy.array([], dtype=int)
+    single = featureMask.copy()
+    single[linked] = False
+
+    bins = numpy.zeros((len(corrThresholds) + 1, len(rsdThresholds) + 1), dtype=int)
+    numpy.add.at(bins, (corrBin[single], rsdBin[single]), 1)
+    counts = numpy.cumsum(numpy.cumsum(bins[::-1, :], axis=0)[::-1, :], axis=1)[1:, :-1]
+
+    # Each group of linked features passing counts once. Groups of the full linkage passing whole count once, only groups partly passing are split again
+    if linked.shape[0] > 0:
+        (index1, index2) = (linkedIndex[:node1.shape[0]], linkedIndex[node1.shape[0]:])
+        graph = scipy.sparse.coo_matrix((numpy.ones(node1.shape[0], dtype=int), (index1, index2)), shape=(linked.shape[0], linked.shape[0]))
+        (noGroups, groups) = connected_components(graph, directed=False)
+        groupSize = numpy.bincount(groups, minlength=noGroups)
+
+        for i in range(len(corrThresholds)):
+            for j in range(len(rsdThresholds)):
+                passed = (corrBin[linked] > i) & (rsdBin[linked] <= j)
+                groupPassed = numpy.bincount(groups, weights=passed, minlength=noGroups)
+                counts[i, j] += numpy.sum(groupPassed == groupSize)
+
+                partial = (groupPassed > 0) & (groupPassed < groupSize)
+                if numpy.any(partial):
+                    nodes = passed & partial[groups]
+                    edges = nodes[index1] & nodes[index2]
+                    graph = scipy.sparse.coo_matrix((numpy.ones(numpy.sum(edges), dtype=int), (index1[edges], index2[edges])), shape=(linked.shape[0], linked.shape[0]))
+                    (noComponents, _) = connected_components(graph, directed=False)
+                    counts[i, j] += noComponents - numpy.sum(~nodes)
+
+    return counts
+
+
 def _batchCorrectionAssessmentReport(dataset, destinationPath=None, batch_correction_window=11, logy=True):
     """
     Generates a report before batch correction showing TIC overall and intensity and batch correction fit for a subset of features, to aid specification of batch start and end points.
@@ -1399,9 +1442,12 @@ def _featureCorrelationToDilutionReport(dataset, destinationPath=None):
     else:
         figuresCorLRbyBatch = None
 
-    for key in sorted(LRmask):
-        corLRbyBatch[key] = _vcorrcoef(dataset.intensityData, dataset.sampleMetadata['Dilution'].values,
-                                       method=dataset.Attributes['corrMethod'], sampleMask=LRmask[key])
+    # Correlations for all subsets in one pass
+    subsetCorrelations = _vcorrcoefSubsets(dataset.intensityData, dataset.sampleMetadata['Dilution'].values,
+                                           [LRmask[key] for key in sorted(LRmask)], method=dataset.Attributes['corrMethod'])
+
+    for (key, correlations) in zip(sorted(LRmask), subsetCorrelations):
+        corLRbyBatch[key] = correlations
         corLRsummary[key] = sum(corLRbyBatch[key] >= dataset.Attributes['corrThreshold'])
         figuresCorLRbyBatch = _localLRPlots(dataset,
                                             LRmask[key],
@@ -1716,6 +1762,8 @@ def batchCorrectionTest(dataset, nFeatures=10, window=11):
     parameters['window'] = window
     parameters['method'] = 'LOWESS'
     parameters['align'] = 'median'
+    # Keep the fits, to be reused when the dataset is corrected
+    parameters['cacheFits'] = True
 
     for feature in maskNum:
         correctedP = _batchCorrection(dataset.intensityData[:, feature],
@@ -1,20 +1,28 @@
 import numpy
 import warnings
 from ..enumerations import SampleType, AssayRole
+from ._internal import _blockSize
 
 
-def blankFilter(dataset, threshold=None):
+def blankFilter(dataset, threshold=None, approximate=False, blockSize=None, withRatio=False):
 	"""
 	Generates a boolean mask of the features in *dataset* that is true where the average intensity is greater than that seen in procedural blank injections.
 
+	The blank level of each feature is the 95th percentile of its intensity in procedural blanks, found by selection (:py:func:`numpy.partition`) rather than a full sort. If the normaliser of *dataset* is a :py:class:`~nPYc.utilities.normalisation.NullNormaliser`, the raw *_intensityData* is read in blocks of *blockSize* features, so that datasets backed by a memory-mapped array (see :py:func:`numpy.load`) are streamed rather than loaded. Otherwise the normalised :py:attr:`~nPYc.objects.Dataset.intensityData` is read once.
+
 	If no procedural blank samples are present in *dataset* all features are marked as ``True``.
 
 	:param MSDataset dataset: Dataset object to process
 	:param threshold: If ``None`` attempt to read the theshold multiplier from *dataset.Attributes['threshold']*, otherwise use the value specified.
 	:type threshold: None, False, or float
-	:returns: Boolean mask where ``True`` indicates features above the blank threshold
-	:rtype: numpy.ndarray
+	:param bool approximate: If ``True`` take the blank intensity nearest the 95th percentile, with a single selection, instead of interpolating between the two either side of it
+	:param blockSize: Number of features read at a time, by default about 2\ :sup:`22` values, or all features if the intensities are in memory
+	:type blockSize: None or int
+	:param bool withRatio: If ``True`` also return the ratio of the blank level to the mean intensity in study samples of each feature
+	:returns: Boolean mask where ``True`` indicates features above the blank threshold, and the blank level (and ratio) of each feature if filtered
+	:rtype: numpy.ndarray or tuple
 	"""
+	from ..utilities.normalisation import NullNormaliser
 
 	if not (isinstance(threshold, float) or isinstance(threshold, bool)):
 		raise TypeError("threshold must be either None, False, or a float, %s provided." % (type(threshold)))
@@ -35,15 +43,74 @@ def blankFilter(dataset, threshold=None):
 		sampleMask = numpy.logical_and(dataset.sampleMetadata['AssayRole'].values == AssayRole.Assay,
 							 dataset.sampleMetadata['SampleType'].values == SampleType.StudySample)
 
-		if sum(blanksMask) > 1:
-			p95 = numpy.percentile(dataset.intensityData[blanksMask, :], 95, axis=0)
+		blankRows = numpy.where(blanksMask)[0]
+		sampleRows = numpy.where(sampleMask)[0]
+
+		# Normalise once, unless there is no normalisation to apply
+		if isinstance(dataset.Normalisation, NullNormaliser):
+			intensityData = dataset._intensityData
 		else:
-			p95 = dataset.intensityData[blanksMask, :]
+			intensityData = dataset.intensityData
+
+		noFeatures = intensityData.shape[1]
+		if blockSize is None:
+			if isinstance(intensityData, numpy.memmap):
+				blockSize = _blockSize(blankRows.shape[0] + sampleRows.shape[0])
+			else:
+				blockSize = max(noFeatures, 1)
+
+		p95 = numpy.empty(noFeatures)
+		sampleMean = numpy.empty(noFeatures)
+		for start in range(0, noFeatures, blockSize):
+			block = slice(start, start + blockSize)
 
-		mask = numpy.mean(dataset.intensityData[sampleMask,:], axis=0) >= (p95 * threshold)
+			p95[block] = _percentile(numpy.asarray(intensityData[blankRows, block], dtype=float), 95, approximate=approximate)
+			sampleMean[block] = numpy.mean(intensityData[sampleRows, block], axis=0)
 
+		mask = sampleMean >= (p95 * threshold)
+
+		if withRatio:
+			with numpy.errstate(divide='ignore', invalid='ignore'):
+				return mask, p95, p95 / sampleMean
 		return mask, p95
 	else:
 		mask = numpy.squeeze(numpy.ones([dataset.noFeatures, 1], dtype=bool), axis=1)
 
 		return mask
+
+
+def _percentile(X, q, approximate=False):
+	"""
+	*q*\ th percentile of each column of *X*, as :py:func:`numpy.percentile` with linear interpolation, found by partial sorting with :py:func:`numpy.partition`.
+
+	:param numpy.ndarray X: *n* × *m* matrix, partitioned in place
+	:param float q: Percentile, from 0 to 100
+	:param bool approximate: If ``True`` return the value nearest the percentile, rather than interpolating
+	:return: *m* vector of percentiles, NaN for columns containing NaN
+	:rtype: numpy.ndarray
+	"""
+	position = q / 100 * (X.shape[0] - 1)
+	lower = int(numpy.floor(position))
+	upper = min(lower + 1, X.shape[0] - 1)
+
+	# Partitioning only orders values about the selected indices, so find NaN beforehand
+	missing = numpy.isnan(X).any(axis=0)
+
+	if approximate:
+		nearest = int(numpy.round(position))
+		X.partition(nearest, axis=0)
+		percentile = X[nearest].copy()
+	else:
+		X.partition([lower, upper], axis=0)
+
+		# Interpolate as numpy.percentile does
+		fraction = position - lower
+		difference = X[upper] - X[lower]
+		if fraction < 0.5:
+			percentile = X[lower] + difference * fraction
+		else:
+			percentile = X[upper] - difference * (1 - fraction)
+
+	percentile[missing] = numpy.nan
+
+	return percentile
@@ -0,0 +1,164 @@
+"""
+Statistics of every feature in each group of samples of a dataset, calculated in one pass over the data.
+"""
+import warnings
+import numpy
+import pandas
+from .ms import rsd, sequentialPrecision
+from ._internal import _noWorkers, _mapBlocks
+
+
+def _count(data):
+	return numpy.sum(~numpy.isnan(data), axis=0)
+
+
+def _std(data):
+	return numpy.nanstd(data, axis=0)
+
+
+def _mean(data):
+	return numpy.nanmean(data, axis=0)
+
+
+def _median(data):
+	return numpy.nanmedian(data, axis=0)
+
+
+_statistics = {'count': _count,
+			   'mean': _mean,
+			   'std': _std,
+			   'rsd': rsd,
+			   'median': _median,
+			   'sequentialPrecision': sequentialPrecision}
+
+
+def groupedStatistics(dataset, groupBy, statistics=('count', 'mean', 'std', 'rsd'), percentiles=None, sampleMask=None, minSamples=1, parallelise=False, nJobs=None, blockSize=None, byGroup=False):
+	"""
+	Calculate statistics of every feature in each group of samples defined by the columns *groupBy* of :py:attr:`~nPYc.objects.Dataset.sampleMetadata`.
+
+	Samples are sorted into their groups once, so each statistic is calculated for all features of a group at a time. Statistics available are:
+
+	* **'count'** Number of values measured (not NaN)
+	* **'mean'**, **'std'**, **'median'** Mean, standard deviation and median of the values measured
+	* **'rsd'** Percentage :term:`relative standard deviation`, as by :py:func:`~nPYc.utilities.rsd`
+	* **'sequentialPrecision'** Percentage sequential precision, as by :py:func:`~nPYc.utilities.sequentialPrecision`, with samples in the order they are in the dataset
+
+	Samples with a missing value in any of the *groupBy* columns are not included in any group.
+
+	The table returned has a row for each feature in each group, ordered by group (in the order groups first appear in the dataset) then by feature. With *byGroup* the statistics are instead returned as vectors of all features, keyed by group.
+
+	:param Dataset dataset: Dataset to calculate statistics for, on its :py:attr:`~nPYc.objects.Dataset.intensityData`
+	:param groupBy: Column, or list of columns, of *sampleMetadata* defining the groups
+	:type groupBy: str or list[str,]
+	:param statistics: Statistics to calculate
+	:type statistics: list[str,]
+	:param percentiles: Percentiles to calculate, from 0 to 100, as columns 'percentile *q*'
+	:type percentiles: None or list[float,]
+	:param sampleMask: Samples to include (``True`` for inclusion), if ``None`` use :py:attr:`~nPYc.objects.Dataset.sampleMask`
+	:type sampleMask: None or numpy.ndarray
+	:param int minSamples: Only report groups with at least this many samples
+	:param bool parallelise: If ``True`` calculate blocks of features in parallel threads
+	:param nJobs: Number of threads when *parallelise* is ``True``, by default one less than the number of CPU cores, negative values count back from the number of cores
+	:type nJobs: None or int
+	:param blockSize: Number of features in each block, by default the features are split evenly between threads
+	:type blockSize: None or int
+	:param bool byGroup: If ``True`` return a dictionary of the statistics of each group instead of a table
+	:return: Table of the *groupBy* values of each group, its number of 'Samples', the 'Feature' position (and 'Feature Name' if defined), and the statistics requested, or if *byGroup* a dictionary keyed by the *groupBy* value of each group (a tuple of values if grouped by more than one column), of dictionaries of the *m* values of each statistic
+	:rtype: pandas.DataFrame or dict
+	:raises TypeError: if *dataset* is not a Dataset, or *nJobs* is not ``None`` or a non-zero integer
+	:raises KeyError: if a *groupBy* column is not in *sampleMetadata*
+	:raises ValueError: if a statistic is not known or a percentile is out of range
+	"""
+	from ..objects import Dataset
+
+	if not isinstance(dataset, Dataset):
+		raise TypeError('dataset must be an instance of Dataset.')
+
+	if isinstance(groupBy, str):
+		groupBy = [groupBy]
+	for column in groupBy:
+		if not column in dataset.sampleMetadata.columns:
+			raise KeyError("%s is not a column in sampleMetadata." % (column))
+
+	statistics = list(statistics)
+	for statistic in statistics:
+		if not statistic in _statistics:
+			raise ValueError('%s is not a known statistic, must be one of %s.' % (statistic, ', '.join(_statistics.keys())))
+
+	percentiles = list() if percentiles is None else list(percentiles)
+	if any((percentile < 0) or (percentile > 100) for percentile in percentiles):
+		raise ValueError('percentiles must be in the range 0 to 100.')
+
+	if not isinstance(minSamples, int) or (minSamples < 1):
+		raise ValueError('minSamples must be a positive integer.')
+
+	noWorkers = _noWorkers(nJobs) if parallelise else 1
+
+	if sampleMask is None:
+		sampleMask = dataset.sampleMask
+	sampleMask = numpy.asarray(sampleMask, dtype=bool)
+
+	# Index the groups once, samples in each group keep their order in the dataset
+	codes = dataset.sampleMetadata.groupby(groupBy, sort=False, dropna=True).ngroup().values
+	codes = numpy.where(pandas.isnull(codes) | ~sampleMask, -1, codes).astype(int)
+
+	order = numpy.argsort(codes, kind='stable')
+	order = order[codes[order] >= 0]
+	(_, starts, sizes) = numpy.unique(codes[order], return_index=True, return_counts=True)
+
+	keep = sizes >= minSamples
+	(starts, sizes) = (starts[keep], sizes[keep])
+
+	intensityData = dataset.intensityData[order, :]
+	noFeatures = intensityData.shape[1]
+	noGroups = starts.shape[0]
+
+	# Split the features into blocks, each calculated for every group
+	if blockSize is None:
+		blockSize = max(-(-noFeatures // noWorkers), 1)
+	blocks = [slice(start, min(start + blockSize, noFeatures)) for start in range(0, noFeatures, blockSize)]
+
+	def calculate(block):
+		width = block.stop - block.start
+		values = dict()
+		for statistic in statistics:
+			values[statistic] = numpy.array([_statistics[statistic](intensityData[start:start + size, block]) for (start, size) in zip(starts, sizes)], dtype=float).reshape(noGroups, width)
+		if percentiles:
+			groupPercentiles = numpy.array([numpy.nanpercentile(intensityData[start:start + size, block], percentiles, axis=0) for (start, size) in zip(starts, sizes)], dtype=float).reshape(noGroups, len(percentiles), width)
+			for (i, percentile) in enumerate(percentiles):
+				values['percentile %g' % percentile] = groupPercentiles[:, i, :]
+		return values
+
+	# Features with no values measured in a group return NaN
+	with warnings.catch_warnings():
+		warnings.simplefilter('ignore', category=RuntimeWarning)
+		results = _mapBlocks(calculate, blocks, parallelise=parallelise, nJobs=nJobs)
+
+	columns = statistics + ['percentile %g' % percentile for percentile in percentiles]
+
+	# g × m values of each statistic
+	values = dict()
+	for column in columns:
+		values[column] = numpy.concatenate([result[column] for result in results], axis=1) if results else numpy.zeros((noGroups, 0))
+		if column == 'count':
+			values[column] = values[column].astype(int)
+
+	groups = dataset.sampleMetadata.loc[:, groupBy].iloc[order[starts]]
+
+	if byGroup:
+		if len(groupBy) == 1:
+			keys = groups[groupBy[0]].values
+		else:
+			keys = list(groups.itertuples(index=False, name=None))
+
+		return {key: {column: values[column][i, :] for column in columns} for (i, key) in enumerate(keys)}
+
+	table = groups.iloc[numpy.repeat(numpy.arange(noGroups), noFeatures)].reset_index(drop=True)
+	table['Samples'] = numpy.repeat(sizes, noFeatures)
+	table['Feature'] = numpy.tile(numpy.arange(noFeatures), noGroups)
+	if 'Feature Name' in dataset.featureMetadata.columns:
+		table['Feature Name'] = numpy.tile(dataset.featureMetadata['Feature Name'].values, noGroups)
+	for column in columns:
+		table[column] = values[column].ravel()
+
+	return table
@@ -1,5 +1,10 @@
 import os
 
+
+_BLOCKVALUES = 2**22
+"""Approximate number of values held at once by calculations made over blocks of features"""
+
+
 def _copyBackingFiles(toolboxPath, output):
 	"""
 	Copy templates files to the 'graphics' sub-directory of the output directory when needed.
@@ -11,6 +16,68 @@ def _copyBackingFiles(toolboxPath, output):
 	shutil.copy(os.path.join(toolboxPath, 'Templates', 'toolbox_logo.png'), os.path.join(output, 'toolbox_logo.png'))
 
 
+def _noWorkers(nJobs=None):
+	"""
+	Number of workers to start, by default one less than the number of CPU cores.
+
+	:param nJobs: Requested number of workers, if negative count back from the number of cores (-1 for all cores)
+	:type nJobs: None or int
+	:return: Number of workers, at least one
+	:rtype: int
+	:raises TypeError: if *nJobs* is not ``None`` or a non-zero integer
+	"""
+	if (nJobs is not None) and (isinstance(nJobs, bool) or not isinstance(nJobs, int) or (nJobs == 0)):
+		raise TypeError('nJobs must be None or a non-zero integer')
+
+	cores = os.cpu_count() or 1
+
+	if nJobs is None:
+		nJobs = cores - 1
+	elif nJobs < 0:
+		nJobs = cores + 1 + nJobs
+
+	return max(int(nJobs), 1)
+
+
+def _blockSize(valuesPerFeature, blockSize=None):
+	"""
+	Number of features to calculate at once, *blockSize* if given, otherwise enough features of *valuesPerFeature* values each to hold about :py:data:`_BLOCKVALUES` values.
+
+	:param int valuesPerFeature: Number of values held for each feature
+	:param blockSize: Number of features requested, if ``None`` calculate it
+	:type blockSize: None or int
+	:return: Number of features in each block, at least one
+	:rtype: int
+	"""
+	if blockSize is not None:
+		return blockSize
+
+	return max(_BLOCKVALUES // max(int(valuesPerFeature), 1), 1)
+
+
+def _mapBlocks(function, blocks, parallelise=False, nJobs=None):
+	"""
+	Apply *function* to each of *blocks*, in parallel threads if *parallelise* is ``True`` and there is more than one block.
+
+	:param function: Callable taking a block
+	:param list blocks: Blocks, for instance slices of the features
+	:param bool parallelise: If ``True`` run blocks in parallel threads
+	:param nJobs: Number of threads, see :py:func:`_noWorkers`
+	:type nJobs: None or int
+	:return: Results of *function* for each block, in order
+	:rtype: list
+	"""
+	from concurrent.futures import ThreadPoolExecutor
+
+	noWorkers = _noWorkers(nJobs) if parallelise else 1
+
+	if (noWorkers > 1) and (len(blocks) > 1):
+		with ThreadPoolExecutor(max_workers=noWorkers) as executor:
+			return list(executor.map(function, blocks))
+
+	return [function(block) for block in blocks]
+
+
 def _vcorrcoef(X, Y, method='pearson', sampleMask=None, featureMask=None):
 	"""
 	Calculate correlation between each column in *X* and the vector *Y*. Correlations may be calculated either as Pearson's *r* [#]_ or Spearman's rho [#]_ .
@@ -27,36 +94,256 @@ def _vcorrcoef(X, Y, method='pearson', sampleMask=None, featureMask=None):
 	:type featureMask: None or numpy.ndarray of bool
 	"""
 	import numpy
-	import scipy
 
 	if sampleMask is None:
-		pass
-	else:
-		Y = Y[sampleMask]
-		X = X[sampleMask,:]
+		sampleMask = numpy.ones(numpy.shape(X)[0], dtype=bool)
+
+	return _vcorrcoefSubsets(X, Y, [sampleMask], method=method, featureMask=featureMask)[0]
+
+
+def _vcorrcoefSubsets(X, Y, sampleMasks, method='pearson', featureMask=None, blockSize=None):
+	"""
+	Calculate correlation between each column in *X* and the vector *Y* in each of the subsets of samples in *sampleMasks*, as :py:func:`_vcorrcoef` would for each mask.
+
+	All subsets are calculated in one pass over blocks of features, slicing, ranking (for Spearman's rho) and centring each block of each subset once.
+
+	:param numpy.ndarray X: *n* × *m* matrix of features
+	:param numpy.ndarray Y: *n* vector to correlate the features to
+	:param sampleMasks: *k* boolean masks of the *n* samples in each subset
+	:type sampleMasks: list of numpy.ndarray of bool
+	:param str method: Correlation method to use, may be 'pearson', or 'spearman'
+	:param featureMask: If ``None`` calculate correlations for all features
+	:type featureMask: None or numpy.ndarray of bool
+	:param blockSize: Number of features in each block, by default about 2\ :sup:`22` values of each subset
+	:type blockSize: None or int
+	:return: *k* × *m* array of correlations, zero where they cannot be calculated
+	:rtype: numpy.ndarray
+	"""
+	import numpy
+	import scipy.stats
+
+	X = numpy.asarray(X)
+	Y = numpy.asarray(Y, dtype=float)
+
+	if featureMask is not None:
+		X = X[:, featureMask]
+
+	sampleRows = [numpy.where(numpy.asarray(sampleMask, dtype=bool))[0] for sampleMask in sampleMasks]
+
+	# Centred (ranked) Y of each subset
+	centredY = list()
+	for rows in sampleRows:
+		y = Y[rows]
+		if method == 'spearman':
+			y = scipy.stats.rankdata(y)
+		centredY.append(y - numpy.mean(y))
+
+	blockSize = _blockSize(max([rows.shape[0] for rows in sampleRows], default=1), blockSize)
+
+	r = numpy.zeros((len(sampleRows), X.shape[1]))
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		for start in range(0, X.shape[1], blockSize):
+			block = slice(start, start + blockSize)
+
+			for (i, (rows, y)) in enumerate(zip(sampleRows, centredY)):
+				x = X[rows, block]
+				if method == 'spearman':
+					x = _rankColumns(x)
+				x = x - numpy.mean(x, axis=0)
+
+				r[i, block] = numpy.dot(y, x) / numpy.sqrt(numpy.sum(x ** 2, axis=0) * numpy.sum(y ** 2))
+
+	# Set NaNs to zero correlation
+	r[numpy.isnan(r)] = 0
+
+	return r
+
+
+def _rankColumns(X):
+	"""
+	Rank the values in each column of *X*, ties are given their average rank, as :py:func:`scipy.stats.rankdata` would for each column.
+
+	:param numpy.ndarray X: *n* × *m* matrix
+	:return: *n* × *m* matrix of ranks, from 1 to *n*
+	:rtype: numpy.ndarray
+	"""
+	import numpy
+
+	noRows = X.shape[0]
+	order = numpy.argsort(X, axis=0, kind='mergesort')
+	sortedX = numpy.take_along_axis(X, order, axis=0)
+
+	# Runs of tied values, from the first to the last position of each run
+	position = numpy.arange(1, noRows + 1, dtype=float)[:, numpy.newaxis]
+	runStart = numpy.ones(X.shape, dtype=bool)
+	runStart[1:] = sortedX[1:] != sortedX[:-1]
+	runEnd = numpy.ones(X.shape, dtype=bool)
+	runEnd[:-1] = runStart[1:]
+
+	first = numpy.maximum.accumulate(numpy.where(runStart, position, 0), axis=0)
+	last = numpy.minimum.accumulate(numpy.where(runEnd, position, noRows + 1)[::-1], axis=0)[::-1]
+
+	ranks = numpy.empty(X.shape)
+	numpy.put_along_axis(ranks, order, (first + last) / 2, axis=0)
+
+	return ranks
+
+
+def _bootstrapCorrelations(X, Y, counts, method='pearson'):
+	"""
+	Correlation between each column in *X* and the vector *Y* in each bootstrap resample of the samples, as :py:func:`_vcorrcoef` would calculate on the resampled rows.
+
+	Resamples are given as the number of times each sample is drawn, so the sums over every resample are matrix products of *counts* with the (ranked and) centred data. For Spearman's rho, ties created by samples drawn more than once are given their average rank.
+
+	:param numpy.ndarray X: *n* × *m* matrix of features
+	:param numpy.ndarray Y: *n* vector to correlate the features to
+	:param numpy.ndarray counts: *b* × *n* matrix of the number of times each sample is drawn in each resample
+	:param str method: Correlation method to use, may be 'pearson', or 'spearman'
+	:return: *b* × *m* array of correlations, zero where they cannot be calculated
+	:rtype: numpy.ndarray
+	"""
+	import numpy
+
+	X = numpy.asarray(X, dtype=float)
+	Y = numpy.asarray(Y, dtype=float)
+	counts = numpy.asarray(counts, dtype=float)
+	noSamples = X.shape[0]
+
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		if method == 'spearman':
+			# The rank of sample i in a resample is the number of samples drawn below it, plus the average position of those tied with it.
+			# As counts sum to n, comparisons shifted by -n / 2 / n give ranks centred on their average of (n + 1) / 2
+			comparisons = (X[:, numpy.newaxis, :] < X[numpy.newaxis, :, :]) + 0.5 * (X[:, numpy.newaxis, :] == X[numpy.newaxis, :, :]) - 0.5
+			x = numpy.dot(counts, comparisons.reshape(noSamples, -1)).reshape(counts.shape[0], noSamples, X.shape[1])
+
+			yComparisons = (Y[:, numpy.newaxis] < Y[numpy.newaxis, :]) + 0.5 * (Y[:, numpy.newaxis] == Y[numpy.newaxis, :]) - 0.5
+			y = numpy.dot(counts, yComparisons)
+
+			covariance = numpy.matmul((counts * y)[:, numpy.newaxis, :], x)[:, 0, :]
+			varianceX = numpy.matmul(counts[:, numpy.newaxis, :], x * x)[:, 0, :]
+			varianceY = numpy.sum(counts * y ** 2, axis=1)
+
+		else:
+			# Centre on the full data before summing, to limit cancellation
+			x = X - numpy.mean(X, axis=0)
+			y = Y - numpy.mean(Y)
+
+			sumX = numpy.dot(counts, x)
+			sumY = numpy.dot(counts, y)
+			covariance = numpy.dot(counts * y, x) - sumX * sumY[:, numpy.newaxis] / noSamples
+			varianceX = numpy.dot(counts, x ** 2) - sumX ** 2 / noSamples
+			varianceY = numpy.dot(counts, y ** 2) - sumY ** 2 / noSamples
+
+			# Features or dilutions constant in a resample up to rounding
+			varianceX[varianceX <= 1e-10 * numpy.dot(counts, x ** 2)] = 0
+			varianceY[varianceY <= 1e-10 * numpy.dot(counts, y ** 2)] = 0
+
+		r = covariance / numpy.sqrt(varianceX * varianceY[:, numpy.newaxis])
+
+	# Where a variance was rounded to zero the covariance may not have been
+	r[~numpy.isfinite(r)] = 0
+
+	return r
+
+
+def _permutationCorrelations(X, Y, permutations, method='pearson'):
+	"""
+	Correlation between each column in *X* and the vector *Y* with its values permuted amongst the samples, as :py:func:`_vcorrcoef` would calculate with each permutation of *Y*.
 
-	if featureMask is None:
-		pass
-	else:
-		X = X[:,featureMask]
+	The (ranked) features are centred once, and all permutations are correlated with a single matrix product.
+
+	:param numpy.ndarray X: *n* × *m* matrix of features
+	:param numpy.ndarray Y: *n* vector to correlate the features to
+	:param numpy.ndarray permutations: *p* × *n* matrix of indices of *Y*, each row a permutation of the samples
+	:param str method: Correlation method to use, may be 'pearson', or 'spearman'
+	:return: *p* × *m* array of correlations, zero where they cannot be calculated
+	:rtype: numpy.ndarray
+	"""
+	import numpy
+	import scipy.stats
+
+	X = numpy.asarray(X, dtype=float)
+	Y = numpy.asarray(Y, dtype=float)
 
 	if method == 'spearman':
-		rankedMat = numpy.zeros_like(X)
-		for col in range(X.shape[1]):
-			rankedMat[:, col] = scipy.stats.rankdata(X[:,col])
-		X = rankedMat
+		X = _rankColumns(X)
 		Y = scipy.stats.rankdata(Y)
 
-	X = X.T
+	x = X - numpy.mean(X, axis=0)
+	y = Y - numpy.mean(Y)
 
-	# From https://waterprogramming.wordpress.com/2014/06/13/numpy-vectorized-correlation-coefficient/
-	Xm = numpy.reshape(numpy.mean(X,axis=1),(X.shape[0],1))
-	ym = numpy.mean(Y)
-	r_num = numpy.sum((X-Xm)*(Y-ym),axis=1)
-	r_den = numpy.sqrt(numpy.sum(numpy.power((X-Xm), 2),axis=1)*numpy.sum(numpy.power((Y-ym), 2)))
-	r = r_num/r_den
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		r = numpy.dot(y[permutations], x) / numpy.sqrt(numpy.sum(x ** 2, axis=0) * numpy.sum(y ** 2))
 
-	# Set NaNs to zero correlation
 	r[numpy.isnan(r)] = 0
 
 	return r
+
+
+def _vcorrcoefResampled(X, Y, sampleMasks, method='pearson', bootstrap=1000, permutations=1000, confidence=0.95, randomSeed=None, parallelise=False, nJobs=None, blockSize=None):
+	"""
+	Bootstrap confidence intervals and permutation *p*-values of the correlation between each column in *X* and the vector *Y*, averaged over the subsets of samples in *sampleMasks*.
+
+	Samples are resampled, or *Y* permuted, within each subset, and the correlations of each resample averaged over the subsets, as the correlations themselves are. The same resamples are used for every feature. Features are calculated in blocks, which may be run in parallel threads.
+
+	Confidence intervals are the percentiles of the bootstrap correlations. *p*-values are one-sided, the proportion of permutations (counting the data as observed as one) with an average correlation at least that observed.
+
+	:param numpy.ndarray X: *n* × *m* matrix of features
+	:param numpy.ndarray Y: *n* vector to correlate the features to
+	:param sampleMasks: *k* boolean masks of the *n* samples in each subset
+	:type sampleMasks: list of numpy.ndarray of bool
+	:param str method: Correlation method to use, may be 'pearson', or 'spearman'
+	:param int bootstrap: Number of bootstrap resamples, if 0 do not calculate confidence intervals
+	:param int permutations: Number of permutations, if 0 do not calculate *p*-values
+	:param float confidence: Width of the confidence intervals, between 0 and 1
+	:param randomSeed: Seed of the random resamples, if ``None`` draw a new seed
+	:type randomSeed: None or int
+	:param bool parallelise: If ``True`` calculate blocks of features in parallel threads
+	:param nJobs: Number of threads when *parallelise* is ``True``, see :py:func:`_noWorkers`
+	:type nJobs: None or int
+	:param blockSize: Number of features in each block, by default about 2\ :sup:`22` values of each resample
+	:type blockSize: None or int
+	:return: Dictionary of *m* vectors of the 'correlation', and the 'lower' and 'upper' confidence limits and 'pValue' where calculated
+	:rtype: dict
+	"""
+	import numpy
+
+	X = numpy.asarray(X)
+	Y = numpy.asarray(Y, dtype=float)
+
+	sampleRows = [numpy.where(numpy.asarray(sampleMask, dtype=bool))[0] for sampleMask in sampleMasks]
+
+	# Resamples of each subset, drawn once for all features, permutations independently of the number of bootstrap resamples
+	(bootstrapState, permutationState) = [numpy.random.default_rng(seed) for seed in numpy.random.SeedSequence(randomSeed).spawn(2)]
+	resampleCounts = list()
+	resamplePermutations = list()
+	for rows in sampleRows:
+		noSamples = rows.shape[0]
+		counts = numpy.zeros((bootstrap, noSamples))
+		numpy.add.at(counts, (numpy.arange(bootstrap)[:, numpy.newaxis], bootstrapState.integers(0, noSamples, size=(bootstrap, noSamples))), 1)
+		resampleCounts.append(counts)
+		resamplePermutations.append(permutationState.permuted(numpy.tile(numpy.arange(noSamples), (permutations, 1)), axis=1))
+
+	blockSize = _blockSize(max([rows.shape[0] for rows in sampleRows], default=1) * max(bootstrap, permutations, 1), blockSize)
+	noFeatures = X.shape[1]
+	blocks = [slice(start, min(start + blockSize, noFeatures)) for start in range(0, noFeatures, blockSize)]
+
+	def calculate(block):
+		correlation = numpy.mean(_vcorrcoefSubsets(X[:, block], Y, sampleMasks, method=method), axis=0)
+		values = {'correlation': correlation}
+
+		if bootstrap > 0:
+			resampled = sum(_bootstrapCorrelations(X[rows, block], Y[rows], counts, method=method) for (rows, counts) in zip(sampleRows, resampleCounts)) / len(sampleRows)
+			(values['lower'], values['upper']) = numpy.percentile(resampled, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
+
+		if permutations > 0:
+			permuted = sum(_permutationCorrelations(X[rows, block], Y[rows], permutation, method=method) for (rows, permutation) in zip(sampleRows, resamplePermutations)) / len(sampleRows)
+			values['pValue'] = (numpy.sum(permuted >= correlation, axis=0) + 1) / (permutations + 1)
+
+		return values
+
+	results = _mapBlocks(calculate, blocks, parallelise=parallelise, nJobs=nJobs)
+
+	keys = ['correlation'] + (['lower', 'upper'] if bootstrap > 0 else []) + (['pValue'] if permutations > 0 else [])
+
+	return {key: numpy.concatenate([result[key] for result in results]) if results else numpy.zeros(0) for key in keys}
@@ -124,6 +124,7 @@ def rsdsBySampleType(dataset, onlyPrecisionReferences=True, useColumn='SampleTyp
 	"""
 	from ..enumerations import AssayRole
 	from ..objects import Dataset
+	from ._groupedStatistics import groupedStatistics
 
 	if not isinstance(dataset, Dataset):
 		raise TypeError('dataset must be an instance of Dataset.')
@@ -131,21 +132,15 @@ def rsdsBySampleType(dataset, onlyPrecisionReferences=True, useColumn='SampleTyp
 	if not useColumn in dataset.sampleMetadata.columns:
 		raise KeyError("%s is not a column in sampleMetadata." % (useColumn))
 
-	rsds = dict()
-	sampleTypes = dataset.sampleMetadata[useColumn].unique()
-	for sampleType in sampleTypes:
-
-		if onlyPrecisionReferences:
-			mask = numpy.logical_and(dataset.sampleMetadata[useColumn].values == sampleType,
-									 dataset.sampleMetadata['AssayRole'].values == AssayRole.PrecisionReference)
-		else:
-			mask = dataset.sampleMetadata[useColumn].values == sampleType
+	mask = numpy.asarray(dataset.sampleMask, dtype=bool)
+	if onlyPrecisionReferences:
+		mask = numpy.logical_and(mask, dataset.sampleMetadata['AssayRole'].values == AssayRole.PrecisionReference)
 
-		mask = numpy.logical_and(mask, dataset.sampleMask)
+	# All classes in one pass, classes with fewer than two samples are skipped
+	statistics = groupedStatistics(dataset, useColumn, statistics=['rsd'], sampleMask=mask, minSamples=2, byGroup=True)
 
-		if sum(mask) < 2:
-			continue
-
-		rsds[str(sampleType)] = rsd(dataset.intensityData[mask, :])
+	rsds = dict()
+	for (sampleType, groupStatistics) in statistics.items():
+		rsds[str(sampleType)] = groupStatistics['rsd']
 
 	return rsds
\ No newline at end of file